@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+from pathlib import Path
+
+from stub_shop import StubShopSettings, start_stub_shop
+
+
+ROOT_DIR = Path(__file__).parent.parent
+SRC_DIR = ROOT_DIR / 'src'
+
+# every shop gets its own loopback address, see start_stub_shop
+STUB_SHOPS = {
+    'Amazon.ae': ('127.0.0.1', 'amazon'),
+    'Carrefour UAE': ('127.0.0.2', 'carrefour'),
+    'DubaiStore': ('127.0.0.3', 'dubai_store'),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the scrape -> result sheet flow')
+    parser.add_argument('--items', type=int, default=1000, help='product items per shop')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--throttle-rps', type=float, default=0.0, help='per shop, 0 disables throttling')
+    parser.add_argument('--page-kb', type=int, default=200)
+    parser.add_argument(
+        '--compression',
+        action='store_true',
+        help='serve compressed pages, the stub compresses them in the benchmark process',
+    )
+    parser.add_argument(
+        '--shop-limits',
+        action='store_true',
+        help='keep the production per-shop rate limits instead of lifting them',
+    )
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+
+def prepare_root_dir(items: int, port: int) -> Path:
+    root_dir = Path(tempfile.mkdtemp(prefix='goods_scrapper_bench_'))
+    assets_dir = root_dir / 'src' / 'assets'
+    assets_dir.mkdir(parents=True)
+
+    db_path = assets_dir / 'goods_scrapper.db'
+    shutil.copy(SRC_DIR / 'assets' / 'goods_scrapper.db', db_path)
+
+    connection = sqlite3.connect(db_path)
+    connection.execute('delete from product_item;')
+    connection.execute('delete from product;')
+    connection.execute('delete from shop;')
+    connection.executemany(
+        'insert into shop(id, name) values (?, ?)',
+        enumerate(STUB_SHOPS, start=1)
+    )
+    connection.executemany(
+        'insert into product(id, name) values (?, ?)',
+        ((i, f'Benchmark product {i}') for i in range(1, items + 1))
+    )
+    connection.executemany(
+        'insert into product_item(product_id, shop_id, url) values (?, ?, ?)',
+        ((
+            product_id,
+            shop_id,
+            f'http://{host}:{port}/{path}/{product_id}',
+        ) for shop_id, (host, path) in enumerate(STUB_SHOPS.values(), start=1)
+          for product_id in range(1, items + 1))
+    )
+    connection.commit()
+    connection.close()
+
+    return root_dir
+
+
+def timed(stage: str, timings: dict[str, list[float]], coroutine_function):
+    async def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await coroutine_function(*args, **kwargs)
+        finally:
+            timings[stage].append(time.perf_counter() - started_at)
+    return wrapper
+
+
+def get_percentiles(values: list[float]) -> dict[str, float]:
+    if len(values) < 2:
+        return {'p50': values[0] * 1000 if values else 0.0, 'p95': 0.0, 'p99': 0.0}
+    cut_points = statistics.quantiles(values, n=100)
+    return {
+        'p50': cut_points[49] * 1000,
+        'p95': cut_points[94] * 1000,
+        'p99': cut_points[98] * 1000,
+    }
+
+
+def get_peak_rss_mb() -> dict[str, float]:
+    # ru_maxrss is in kilobytes on Linux, parse processes are counted as children
+    return {
+        'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    stub_shop, runner, port = await start_stub_shop(StubShopSettings(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        throttle_rps=args.throttle_rps,
+        page_size=args.page_kb * 1024,
+        compress=args.compression,
+    ))
+
+    root_dir = prepare_root_dir(args.items, port)
+    # config reads the paths once on import
+    os.environ['ROOT_DIR'] = f'{root_dir}/'
+    sys.path.insert(0, str(SRC_DIR))
+
+    import config
+    import db_handlers
+    import main_funcs
+    import metrics
+    import parsers
+
+    if not args.shop_limits:
+        for shop_name, settings in config.SHOP_FETCH_SETTINGS.items():
+            config.SHOP_FETCH_SETTINGS[shop_name] = settings._replace(
+                rate=1000.0, max_rate=1000.0, burst=1000, concurrency=16, max_concurrency=16,
+            )
+        for shop_name, profile in config.SHOP_CLIENT_PROFILES.items():
+            config.SHOP_CLIENT_PROFILES[shop_name] = profile._replace(limit=16, limit_per_host=16)
+
+    timings: dict[str, list[float]] = defaultdict(list)
+    parsers.fetch_page = timed('fetch', timings, parsers.fetch_page)
+    parsers.ParsePool.parse = timed('parse', timings, parsers.ParsePool.parse)
+    db_handlers.PriceWriter.flush = timed('write', timings, db_handlers.PriceWriter.flush)
+
+    try:
+        started_at = time.perf_counter()
+        await main_funcs.save_prices_to_db()
+        scrape_time = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        await main_funcs.create_result_execel_sheet()
+        sheet_time = time.perf_counter() - started_at
+    finally:
+        await runner.cleanup()
+
+    connection = sqlite3.connect(root_dir / 'src' / 'assets' / 'goods_scrapper.db')
+    saved_prices = connection.execute(
+        'select count(*) from product_item where selling_price is not null'
+    ).fetchone()[0]
+    connection.close()
+    shutil.rmtree(root_dir)
+
+    items = args.items * len(STUB_SHOPS)
+    return {
+        'items': items,
+        'saved_prices': saved_prices,
+        'scrape_seconds': scrape_time,
+        'items_per_second': items / scrape_time,
+        'result_sheet_seconds': sheet_time,
+        'requests': stub_shop.requests,
+        'throttled_responses': stub_shop.throttled,
+        'failed_responses': stub_shop.failed,
+        'latency_ms': {stage: get_percentiles(values) for stage, values in timings.items()},
+        'peak_rss_mb': get_peak_rss_mb(),
+        'metrics': metrics.METRICS.snapshot(),
+        'summary': metrics.format_summary(),
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"items:              {report['items']} ({report['saved_prices']} prices saved)")
+    print(f"scrape:             {report['scrape_seconds']:.2f} s, {report['items_per_second']:.1f} items/s")
+    print(f"result sheet:       {report['result_sheet_seconds']:.2f} s")
+    print(
+        f"stub requests:      {report['requests']} "
+        f"({report['throttled_responses']} throttled, {report['failed_responses']} failed)"
+    )
+    for stage, percentiles in report['latency_ms'].items():
+        print(
+            f'{stage + " latency:":<20}'
+            f"p50 {percentiles['p50']:.1f} ms, p95 {percentiles['p95']:.1f} ms, p99 {percentiles['p99']:.1f} ms"
+        )
+    print(
+        f"peak RSS:           {report['peak_rss_mb']['main']:.1f} MB, "
+        f"parse processes {report['peak_rss_mb']['children']:.1f} MB"
+    )
+    print(report['summary'])
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+
+SRC_DIR = Path(__file__).parent.parent / 'src'
+
+# what runs in a fresh interpreter before the menu or an action can start
+STARTUP_SCRIPTS = {
+    'interpreter': 'pass',
+    'menu': 'import tui; tui.print_menu()',
+    'add products': 'import tui; from main_funcs import add_new_products_for_monitoring; import excel_handlers',
+    'scrape': 'import tui; import main_funcs, parsers, page_cache, web_utils; web_utils.load_user_agents()',
+    'result sheet': 'import tui; from main_funcs import create_result_execel_sheet; import openpyxl, excel_handlers',
+}
+
+HEAVY_MODULES = ('aiohttp', 'openpyxl', 'lxml')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Startup time of the tui and its actions')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+
+def run_script(script: str, env: dict) -> float:
+    started_at = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=SRC_DIR,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - started_at
+
+
+def get_menu_imports(env: dict) -> list[str]:
+    script = f'import sys, tui; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    output = subprocess.run(
+        [sys.executable, '-c', script], cwd=SRC_DIR, env=env, check=True, capture_output=True, text=True
+    ).stdout.strip()
+    return output.split(',') if output else []
+
+
+def run_benchmark(runs: int) -> dict:
+    env = {**os.environ, 'ROOT_DIR': os.environ.get('ROOT_DIR', f'{SRC_DIR.parent}/')}
+    # the first run of every script warms the bytecode cache and is not counted
+    timings = {}
+    for name, script in STARTUP_SCRIPTS.items():
+        run_script(script, env)
+        timings[name] = [run_script(script, env) for _ in range(runs)]
+
+    interpreter = statistics.median(timings.pop('interpreter'))
+    return {
+        'interpreter_ms': interpreter * 1000,
+        'startup_ms': {
+            name: (statistics.median(values) - interpreter) * 1000 for name, values in timings.items()
+        },
+        'heavy_modules_before_menu': get_menu_imports(env),
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"interpreter:        {report['interpreter_ms']:.1f} ms (subtracted below)")
+    for name, startup in report['startup_ms'].items():
+        print(f'{name + ":":<20}{startup:.1f} ms')
+    print(f"imported with menu: {', '.join(report['heavy_modules_before_menu']) or 'no heavy modules'}")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_benchmark(args.runs)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,130 @@
+import asyncio
+import random
+import time
+
+from pathlib import Path
+from typing import NamedTuple
+
+from aiohttp import web
+
+
+FIXTURES_DIR = Path(__file__).parent.parent / 'tests' / 'fixtures'
+
+# fixtures that contain prices, served for every product of the shop
+SHOP_FIXTURES = {
+    'amazon': ('amazon_sns_base_price.html', 'amazon_a_price.html', 'amazon_price_whole.html'),
+    'carrefour': ('carrefour_price.html', 'carrefour_discount.html'),
+    'dubai_store': ('dubai_store_price.html', 'dubai_store_discount.html'),
+}
+
+FILLER_BLOCK = (
+    '<div class="a-section a-spacing-small"><span class="a-size-base">'
+    'Customers who viewed this item also viewed</span><a href="/dp/B000000000">link</a></div>\n'
+)
+
+
+class StubShopSettings(NamedTuple):
+    latency: float = 0.05
+    jitter: float = 0.02
+    error_rate: float = 0.0
+    throttle_rps: float = 0.0
+    page_size: int = 200 * 1024
+    compress: bool = False
+
+
+def pad_page(html_page: str, page_size: int) -> str:
+    if (missing := page_size - len(html_page)) <= 0:
+        return html_page
+    filler = FILLER_BLOCK * (missing // len(FILLER_BLOCK) + 1)
+    # product pages carry most of their markup after the price block
+    return html_page.replace('</body>', filler + '</body>', 1)
+
+
+class StubShop:
+    def __init__(self, settings: StubShopSettings) -> None:
+        self.settings = settings
+        self.pages = {
+            shop: tuple(
+                pad_page((FIXTURES_DIR / fixture).read_text(encoding='utf-8'), settings.page_size)
+                for fixture in fixtures
+            ) for shop, fixtures in SHOP_FIXTURES.items()
+        }
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self._tokens: dict[str, float] = {}
+        self._updated: dict[str, float] = {}
+
+    def is_throttled(self, shop: str) -> bool:
+        if not self.settings.throttle_rps:
+            return False
+
+        now = time.monotonic()
+        tokens = min(
+            self.settings.throttle_rps,
+            self._tokens.get(shop, self.settings.throttle_rps)
+            + (now - self._updated.get(shop, now)) * self.settings.throttle_rps
+        )
+        self._updated[shop] = now
+
+        if tokens < 1:
+            self._tokens[shop] = tokens
+            return True
+        self._tokens[shop] = tokens - 1
+        return False
+
+    async def handle_product_page(self, request: web.Request) -> web.Response:
+        shop = request.match_info['shop']
+        item_id = int(request.match_info['item_id'])
+        self.requests += 1
+
+        if shop not in self.pages:
+            raise web.HTTPNotFound()
+
+        if self.is_throttled(shop):
+            self.throttled += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+
+        await asyncio.sleep(max(0.0, random.gauss(self.settings.latency, self.settings.jitter)))
+
+        if random.random() < self.settings.error_rate:
+            self.failed += 1
+            return web.Response(status=503)
+
+        pages = self.pages[shop]
+        response = web.Response(text=pages[item_id % len(pages)], content_type='text/html')
+        if self.settings.compress:
+            # follows the accept-encoding of the request, as the shops do
+            response.enable_compression()
+        return response
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/{shop}/{item_id}', self.handle_product_page)
+        return app
+
+
+async def start_stub_shop(settings: StubShopSettings, port: int = 0) -> tuple[StubShop, web.AppRunner, int]:
+    stub_shop = StubShop(settings)
+    runner = web.AppRunner(stub_shop.make_app(), access_log=None)
+    await runner.setup()
+
+    # listening on every address lets each shop get its own loopback host,
+    # so the scraper keeps a separate rate limiter per shop as in production
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    return stub_shop, runner, port
+
+
+if __name__ == '__main__':
+    async def main():
+        _, runner, port = await start_stub_shop(StubShopSettings(), port=8080)
+        print(f'Stub shop is serving http://127.0.0.1:{port}/<shop>/<item_id>')
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
@@ -1,6 +1,8 @@
 import os
 from dotenv import load_dotenv
 
+from data_types import ClientProfile, FetchSettings
+
 
 load_dotenv()
 
@@ -11,3 +13,139 @@ DB_PATH = os.environ['ROOT_DIR'] + 'src/assets/goods_scrapper.db'
 EXCEL_INPUT_PATH = os.environ['ROOT_DIR'] + 'src/assets/test_product_links.xlsx'
 
 EXCEL_RESULT_PATH = os.environ['ROOT_DIR'] + 'src/assets/result_sheet.xlsx'
+
+EXPORT_PATH = os.environ['ROOT_DIR'] + 'src/assets/prices'
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 10000))
+
+# bundled with the code rather than kept with the data under ROOT_DIR
+USER_AGENTS_PATH = os.path.join(os.path.dirname(__file__), 'assets', 'user_agents.txt')
+
+# prices without a currency sign on the page are taken in this currency
+DEFAULT_CURRENCY = os.environ.get('DEFAULT_CURRENCY', 'AED')
+
+SCRAP_CONCURRENCY = int(os.environ.get('SCRAP_CONCURRENCY', 16))
+
+SCRAP_QUEUE_SIZE = int(os.environ.get('SCRAP_QUEUE_SIZE', 100))
+
+DEFAULT_FETCH_SETTINGS = FetchSettings(
+    rate=1.0,
+    min_rate=0.2,
+    max_rate=4.0,
+    burst=2,
+    concurrency=1,
+    max_concurrency=2,
+    timeout=20.0,
+    deadline=90.0,
+    retries=3,
+    backoff_base=1.0,
+    backoff_max=30.0,
+    max_bytes=2 * 1024 * 1024,
+)
+
+SHOP_FETCH_SETTINGS = {
+    'Amazon.ae': DEFAULT_FETCH_SETTINGS._replace(
+        rate=1.0, max_rate=3.0, concurrency=2, max_concurrency=4, max_bytes=4 * 1024 * 1024,
+    ),
+    'Carrefour UAE': DEFAULT_FETCH_SETTINGS._replace(
+        rate=2.0, max_rate=6.0, concurrency=2, max_concurrency=4,
+    ),
+    'DubaiStore': DEFAULT_FETCH_SETTINGS._replace(
+        rate=2.0, max_rate=8.0, concurrency=2, max_concurrency=4,
+    ),
+}
+
+DEFAULT_CLIENT_PROFILE = ClientProfile(
+    limit=8,
+    limit_per_host=4,
+    keepalive_timeout=60.0,
+    ttl_dns_cache=3600,
+    headers={
+        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'accept-language': 'en-US,en;q=0.9',
+    },
+)
+
+# pools are sized to the largest number of requests the shop limiter lets in flight
+SHOP_CLIENT_PROFILES = {
+    'Amazon.ae': DEFAULT_CLIENT_PROFILE._replace(
+        headers={**DEFAULT_CLIENT_PROFILE.headers, 'accept-language': 'en-AE,en;q=0.9'},
+    ),
+    'Carrefour UAE': DEFAULT_CLIENT_PROFILE._replace(
+        headers={**DEFAULT_CLIENT_PROFILE.headers, 'accept-language': 'en-AE,en;q=0.9,ar;q=0.8'},
+    ),
+    'DubaiStore': DEFAULT_CLIENT_PROFILE,
+}
+
+DB_WRITE_BATCH_SIZE = int(os.environ.get('DB_WRITE_BATCH_SIZE', 500))
+
+DB_READ_BATCH_SIZE = int(os.environ.get('DB_READ_BATCH_SIZE', 1000))
+
+DB_FLUSH_INTERVAL = float(os.environ.get('DB_FLUSH_INTERVAL', 2.0))
+
+PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '0') == '1'
+
+PAGE_CACHE_PATH = os.environ['ROOT_DIR'] + 'src/assets/page_cache.db'
+
+PAGE_CACHE_MAX_SIZE = int(os.environ.get('PAGE_CACHE_MAX_SIZE', 512 * 1024 * 1024))
+
+# fetched product pages are appended to compressed segments, so the prices
+# can be extracted again from them after a fix of the selectors
+PAGE_ARCHIVE_ENABLED = os.environ.get('PAGE_ARCHIVE_ENABLED', '0') == '1'
+
+PAGE_ARCHIVE_PATH = os.environ['ROOT_DIR'] + 'src/assets/page_archive'
+
+PAGE_ARCHIVE_SEGMENT_SIZE = int(os.environ.get('PAGE_ARCHIVE_SEGMENT_SIZE', 1024 * 1024 * 1024))
+
+# product pages are parsed while they download and the download stops at the prices,
+# streamed pages are not kept in the page cache
+STREAM_PAGES = os.environ.get('STREAM_PAGES', '0') == '1'
+
+# items found on the listing pages of LISTING_PAGES_PATH take their prices from there,
+# only the others have their product pages fetched
+LISTING_MODE = os.environ.get('LISTING_MODE', '0') == '1'
+
+# one '<shop name><tab><listing page url>' per line
+LISTING_PAGES_PATH = os.environ.get('LISTING_PAGES_PATH', os.environ['ROOT_DIR'] + 'src/assets/listing_pages.txt')
+
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))
+
+PARSE_BACKLOG = int(os.environ.get('PARSE_BACKLOG', 2 * PARSE_WORKERS))
+
+PRICE_HISTORY_DOWNSAMPLE_AFTER = int(os.environ.get('PRICE_HISTORY_DOWNSAMPLE_AFTER', 30 * 24 * 3600))
+
+PRICE_HISTORY_RETENTION = int(os.environ.get('PRICE_HISTORY_RETENTION', 2 * 365 * 24 * 3600))
+
+SCRAP_FAILURE_RETENTION = int(os.environ.get('SCRAP_FAILURE_RETENTION', 30 * 24 * 3600))
+
+SCRAP_MIN_INTERVAL = int(os.environ.get('SCRAP_MIN_INTERVAL', 6 * 3600))
+
+SCRAP_MAX_INTERVAL = int(os.environ.get('SCRAP_MAX_INTERVAL', 7 * 24 * 3600))
+
+# items failed with a transient error (timeout, connection error, 5xx, 429) are
+# scraped again at the end of the run, the delay before a round doubles every round
+SCRAP_RETRY_ROUNDS = int(os.environ.get('SCRAP_RETRY_ROUNDS', 2))
+
+SCRAP_RETRY_DELAY = float(os.environ.get('SCRAP_RETRY_DELAY', 30.0))
+
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 30.0))
+
+# in KiB, per connection
+DB_CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', 20000))
+
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+SCRAP_JOB_BATCH_SIZE = int(os.environ.get('SCRAP_JOB_BATCH_SIZE', 50))
+
+SCRAP_JOB_LEASE = float(os.environ.get('SCRAP_JOB_LEASE', 300.0))
+
+SCRAP_JOB_MAX_ATTEMPTS = int(os.environ.get('SCRAP_JOB_MAX_ATTEMPTS', 3))
+
+SCRAP_WORKERS = int(os.environ.get('SCRAP_WORKERS', os.cpu_count() or 1))
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+
+# the metrics are served to the local machine only, unless another address is given
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+
+METRICS_SNAPSHOT_PATH = os.environ['ROOT_DIR'] + 'src/assets/metrics.json'
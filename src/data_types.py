@@ -34,11 +34,67 @@ class PricesForSave(NamedTuple):
     id: int
 
 
+class UnchangedPrices(NamedTuple):
+    id: int
+    selling_price: str | None
+    net_price: str | None
+
+
+class ScrapFailure(NamedTuple):
+    id: int
+    shop_name: ShopName
+    stage: str
+    reason: str
+    status: int | None = None
+    received_bytes: int | None = None
+    transient: bool = False
+    attempt: int = 1
+
+
+class ListingPage(NamedTuple):
+    shop_name: ShopName
+    url: str
+
+
+class ListingPrice(NamedTuple):
+    url: str
+    selling_price: str | None
+    net_price: str | None
+
+
+class Price(NamedTuple):
+    amount: int
+    currency: str
+
+
 class ScrappedPrices(NamedTuple):
     selling_price: str
     net_price: str
 
 
+class FetchSettings(NamedTuple):
+    rate: float
+    min_rate: float
+    max_rate: float
+    burst: int
+    concurrency: int
+    max_concurrency: int
+    timeout: float
+    deadline: float
+    retries: int
+    backoff_base: float
+    backoff_max: float
+    max_bytes: int
+
+
+class ClientProfile(NamedTuple):
+    limit: int
+    limit_per_host: int
+    keepalive_timeout: float
+    ttl_dns_cache: int
+    headers: dict[str, str]
+
+
 @dataclass(slots=True, frozen=True)
 class InfoForDb:
     shop_names: list[ShopName]
@@ -52,4 +108,60 @@ class ProductItemForResultSheet:
     product_name: ProductName
     product_item_link: ProductItemLink
     selling_price: str
-    net_price: str
\ No newline at end of file
+    net_price: str
+    selling_price_minor: int | None
+    net_price_minor: int | None
+    currency: str | None
+
+
+class CachedPage(NamedTuple):
+    etag: str | None
+    last_modified: str | None
+    body_hash: str
+    # the prices extracted from the cached body, none until they are
+    prices: ScrappedPrices | None = None
+
+
+class FetchedPage(NamedTuple):
+    text: str | None
+    modified: bool
+    etag: str | None = None
+    last_modified: str | None = None
+    size: int | None = None
+    prices: ScrappedPrices | None = None
+
+
+class ArchivedPage(NamedTuple):
+    product_item_id: int
+    shop_name: ShopName
+    archived_at: int
+    segment: str
+    offset: int
+    length: int
+    latest: bool
+
+
+class ReplayedPrices(NamedTuple):
+    id: int
+    archived_at: int
+    latest: bool
+    prices: ScrappedPrices | None
+
+
+class PriceObservation(NamedTuple):
+    product_item_id: int
+    scraped_at: int
+    selling_price: int | None
+    net_price: int | None
+
+
+class QueryPlanCheck(NamedTuple):
+    query: str
+    params: tuple | dict
+    allowed_scans: tuple[str, ...] = ()
+
+
+class PriceWindow(NamedTuple):
+    min_selling_price: int | None
+    max_selling_price: int | None
+    observations: int
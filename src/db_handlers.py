@@ -1,10 +1,13 @@
-from typing import Iterator
-from sqlite3 import Connection, Cursor, connect
+import asyncio
+import json
+import sys
+import time
 
-from aiosqlite import (
-        Connection as ConnectionAsync,
-        connect as connect_async
-    )
+from contextlib import suppress
+from typing import AsyncIterator, Iterator
+from sqlite3 import Connection, Cursor
+
+from aiosqlite import Connection as ConnectionAsync
 
 from data_types import (
         InfoForDb,
@@ -15,66 +18,121 @@ from data_types import (
         ProductName,
         PricesForSave,
         ItemForScrap,
+        PriceObservation,
+        PriceWindow,
+        QueryPlanCheck,
+        ReplayedPrices,
+        ScrapFailure,
+        UnchangedPrices,
+    )
+from metrics import DB_WRITE_SECONDS, DB_WRITES
+from prices import parse_price
+from urls import canonicalize_url
+from page_archive import clear_page_archive
+from schema import connect_db, connect_db_async, find_full_scans, open_db_async
+from config import (
+        DB_PATH,
+        EXCEL_INPUT_PATH,
+        DB_WRITE_BATCH_SIZE,
+        DB_FLUSH_INTERVAL,
+        PRICE_HISTORY_DOWNSAMPLE_AFTER,
+        PRICE_HISTORY_RETENTION,
+        SCRAP_FAILURE_RETENTION,
+        SCRAP_MIN_INTERVAL,
+        SCRAP_MAX_INTERVAL,
+        SCRAP_JOB_MAX_ATTEMPTS,
+        DB_READ_BATCH_SIZE,
     )
-from config import DB_PATH, EXCEL_INPUT_PATH
 
 
-def load_shops_to_db(cursor: Cursor, shops: Iterator[ShopName]) -> None:
-    cursor.executemany(
-        'insert into shop(name) values (?)',
-        tuple((s,) for s in shops)
-    )
+SKIPPED_SHOPS = ('Noon', 'Mumzworld')
+
+SECONDS_IN_DAY = 24 * 3600
 
 
-def load_products_to_db(cursor: Cursor, products: Iterator[ProductName]) -> None:
+def load_shops_to_db(cursor: Cursor, shops: Iterator[ShopName]) -> dict[ShopName, int]:
     cursor.executemany(
-        'insert into product(name) values (?)',
-        tuple((p,) for p in products)
+        'insert into shop(name) values (?) on conflict(name) do nothing',
+        ((s,) for s in shops)
     )
+    return dict(cursor.execute('select name, id from shop'))
 
 
-def load_product_items_to_db(cursor: Cursor, product_items: Iterator[ProductItem]) -> None:
-    for item in product_items:
-        cursor.execute(
-            "select id from shop where name is ?",
-            (item.shop_name,)
-        )
-        shop_id = cursor.fetchone()[0]
-
-        cursor.execute(
-            "select id from product where name is ?",
-            (item.product_name,)
-        )
-        product_id = cursor.fetchone()[0]
+def load_products_to_db(cursor: Cursor, products: Iterator[ProductName]) -> dict[ProductName, int]:
+    cursor.executemany(
+        'insert into product(name) values (?) on conflict(name) do nothing',
+        ((p,) for p in products)
+    )
+    return dict(cursor.execute('select name, id from product'))
+
+
+def get_item_url(item: ProductItem) -> str | None:
+    # a dash in the sheet marks a shop without the product
+    return None if item.url is None or item.url.startswith('-') else item.url
+
+
+# prices of an item are kept only while its link leads to the same product page,
+# a link that differs only in tracking parameters keeps them; a relinked item
+# also loses its scrap state, so it is due at once like a new one
+LOAD_PRODUCT_ITEMS_QUERY = '''
+insert into product_item(product_id, shop_id, url, canonical_url) values (?, ?, ?, ?)
+on conflict(product_id, shop_id) do update set
+    url = excluded.url,
+    canonical_url = excluded.canonical_url,
+    selling_price = case when canonical_url is excluded.canonical_url then selling_price end,
+    net_price = case when canonical_url is excluded.canonical_url then net_price end,
+    selling_price_minor = case when canonical_url is excluded.canonical_url then selling_price_minor end,
+    net_price_minor = case when canonical_url is excluded.canonical_url then net_price_minor end,
+    currency = case when canonical_url is excluded.canonical_url then currency end,
+    last_scraped_at = case when canonical_url is excluded.canonical_url then last_scraped_at end,
+    last_changed_at = case when canonical_url is excluded.canonical_url then last_changed_at end,
+    failure_count = case when canonical_url is excluded.canonical_url then failure_count else 0 end;
+'''
 
-        url = None if item.url.startswith(
-            '-') or item.url == None else item.url
 
-        cursor.execute(
-            "insert into product_item(product_id, shop_id, url) values (?,?,?)",
-            (product_id, shop_id, url)
-        )
+def load_product_items_to_db(
+    cursor: Cursor,
+    product_items: Iterator[ProductItem],
+    shop_ids: dict[ShopName, int],
+    product_ids: dict[ProductName, int],
+) -> None:
+    cursor.executemany(LOAD_PRODUCT_ITEMS_QUERY, ((
+        product_ids[item.product_name],
+        shop_ids[item.shop_name],
+        get_item_url(item),
+        canonicalize_url(item.shop_name, get_item_url(item)),
+    ) for item in product_items))
 
 
 def clear_db(cursor: Cursor) -> None:
+    # sqlite gives the ids of an emptied table out again, the rows keyed
+    # by product item ids would belong to the new items
     cursor.execute('delete from shop;')
     cursor.execute('delete from product;')
     cursor.execute('delete from product_item;')
+    cursor.execute('delete from price_observation;')
+    cursor.execute('delete from scrap_job;')
+    cursor.execute('delete from scrap_failure;')
 
 
 def load_data_to_db(info_for_db: InfoForDb, mode: str = None) -> None:
-    connection: Connection = connect(DB_PATH)
+    connection: Connection = connect_db()
     cursor: Cursor = connection.cursor()
 
-    if mode == 'r':
-        clear_db(cursor)
+    try:
+        if mode == 'r':
+            clear_db(cursor)
 
-    load_shops_to_db(cursor, info_for_db.shop_names)
-    load_products_to_db(cursor, info_for_db.product_names)
-    load_product_items_to_db(cursor, info_for_db.product_item_links)
+        shop_ids = load_shops_to_db(cursor, info_for_db.shop_names)
+        product_ids = load_products_to_db(cursor, info_for_db.product_names)
+        load_product_items_to_db(cursor, info_for_db.product_item_links, shop_ids, product_ids)
 
-    connection.commit()
-    connection.close()
+        connection.commit()
+    finally:
+        connection.close()
+
+    if mode == 'r':
+        clear_page_archive()
 
 
 async def select_shops_from_db(connection: ConnectionAsync) -> tuple[Shop]:
@@ -87,79 +145,741 @@ async def select_products_from_db(connection: ConnectionAsync) -> tuple[Shop]:
     return tuple(Shop(id=i[0], name=i[1]) for i in resp)
 
 
-async def select_shop_name(connection: ConnectionAsync, shop_id: int) -> str:
-    response = await connection.execute_fetchall('select name from shop where id is ?;', (shop_id,))
-    return response[0][0]
+async def start_scrap_run(connection: ConnectionAsync) -> int:
+    # an unfinished run is resumed, so items scraped since it started are skipped
+    resp = await connection.execute_fetchall(
+        'select started_at from scrap_run where finished_at is null order by id desc limit 1;'
+    )
+    if resp:
+        return resp[0][0]
+
+    started_at = int(time.time())
+    await connection.execute('insert into scrap_run(started_at) values (?);', (started_at,))
+    await connection.commit()
+    return started_at
+
 
+async def finish_scrap_run(connection: ConnectionAsync, started_at: int) -> None:
+    await connection.execute(
+        'update scrap_run set finished_at = ? where started_at is ? and finished_at is null;',
+        (int(time.time()), started_at)
+    )
+    await connection.commit()
+
+
+# an item is due once the time since its last scrape exceeds half of the time
+# its prices stayed the same, failing items are retried with exponential backoff.
+# items with the same canonical url are fetched once, for the first of them,
+# the writer copies the result to the others; the duplicate lookup is pinned
+# to the canonical url index, the due indexes would make it scan every earlier item
+DUE_FILTER = '''
+and url is not null
+and shop_id not in (select id from shop where name in (select value from json_each(:skipped_shops)))
+and (
+    last_scraped_at is null
+    or (
+        last_scraped_at < :run_started_at
+        and last_scraped_at + case
+            when failure_count > 0
+                then min(:max_interval, :min_interval << min(failure_count, 10))
+            else min(
+                :max_interval,
+                max(:min_interval, (last_scraped_at - coalesce(last_changed_at, 0)) / 2)
+            )
+        end <= :now
+    )
+)
+and not exists (
+    select 1 from product_item as duplicate indexed by product_item_canonical_url
+    where duplicate.canonical_url = product_item.canonical_url
+    and duplicate.last_scraped_at is product_item.last_scraped_at
+    and duplicate.id < product_item.id
+)
+'''
 
-async def select_product_items(connection: ConnectionAsync, shop_id: int) -> tuple[ItemForScrap]:
-    shop_name = await select_shop_name(connection, shop_id)
-    resp = await connection.execute_fetchall('''
-select product_item.id, url
+# the due items of all shops in the order of their priority: never scraped first,
+# then the recently changed ones, then the ones never changed. every query reads
+# one batch straight from an index, starting after the last row of the previous batch
+DUE_NEW_ITEMS_QUERY = f'''
+select id, shop_id, coalesce(canonical_url, url) as url, last_changed_at
 from product_item
-where url is not null and product_item.shop_id is ?;
-''', (shop_id,))
+where last_scraped_at is null and id > :after_id
+{DUE_FILTER}
+order by id
+limit :batch_size;
+'''
 
-    return tuple(ItemForScrap(id=i[0], url=i[1], shop_name=shop_name, shop_id=shop_id) for i in resp)
+DUE_CHANGED_ITEMS_QUERY = f'''
+select id, shop_id, coalesce(canonical_url, url) as url, last_changed_at
+from product_item
+where last_changed_at < :after_changed_at and last_scraped_at is not null
+{DUE_FILTER}
+order by last_changed_at desc, id desc
+limit :batch_size;
+'''
 
+# a batch often ends inside a group of items changed in the same second, sqlite seeks
+# a row value only on its first column, so the rest of the group is read on its own
+DUE_CHANGED_TOGETHER_ITEMS_QUERY = f'''
+select id, shop_id, coalesce(canonical_url, url) as url, last_changed_at
+from product_item
+where last_changed_at = :after_changed_at and id < :after_id and last_scraped_at is not null
+{DUE_FILTER}
+order by id desc
+limit :batch_size;
+'''
 
-async def write_prices_to_db(prices_for_save: PricesForSave) -> None:
-    async with connect_async(DB_PATH) as connection:
-        await connection.execute('''
-update product_item
-set selling_price = ?, net_price = ?
-where id is ?;
-''', (prices_for_save.selling_price,
-    prices_for_save.net_price,
-    prices_for_save.id)
+DUE_UNCHANGED_ITEMS_QUERY = f'''
+select id, shop_id, coalesce(canonical_url, url) as url, last_changed_at
+from product_item
+where last_changed_at is null and last_scraped_at is not null and id > :after_id
+{DUE_FILTER}
+order by id
+limit :batch_size;
+'''
+
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def get_due_query_params(run_started_at: int) -> dict:
+    return {
+        'skipped_shops': json.dumps(SKIPPED_SHOPS),
+        'run_started_at': run_started_at,
+        'min_interval': SCRAP_MIN_INTERVAL,
+        'max_interval': SCRAP_MAX_INTERVAL,
+        'now': int(time.time()),
+    }
+
+
+async def iter_due_rows(
+    connection: ConnectionAsync,
+    run_started_at: int,
+    batch_size: int = DB_READ_BATCH_SIZE,
+) -> AsyncIterator[list[tuple]]:
+    # a batch is a statement of its own, so the feed holds no read snapshot between batches
+    # and the checkpoints of the writer go through; items the run has scraped since
+    # are not read again, the due filter skips them by their last scrape
+    params = {**get_due_query_params(run_started_at), 'batch_size': batch_size, 'after_id': 0}
+    while rows := await connection.execute_fetchall(DUE_NEW_ITEMS_QUERY, params):
+        yield rows
+        params['after_id'] = rows[-1][0]
+
+    params.update(after_changed_at=MAX_INTEGER, after_id=MAX_INTEGER)
+    while True:
+        rows = await connection.execute_fetchall(DUE_CHANGED_TOGETHER_ITEMS_QUERY, params)
+        if not rows:
+            rows = await connection.execute_fetchall(DUE_CHANGED_ITEMS_QUERY, params)
+        if not rows:
+            break
+        yield rows
+        params.update(after_changed_at=rows[-1][3], after_id=rows[-1][0])
+
+    params['after_id'] = 0
+    while rows := await connection.execute_fetchall(DUE_UNCHANGED_ITEMS_QUERY, params):
+        yield rows
+        params['after_id'] = rows[-1][0]
+
+
+async def iter_prioritized_due_items(
+    connection: ConnectionAsync,
+    run_started_at: int,
+    batch_size: int = DB_READ_BATCH_SIZE,
+) -> AsyncIterator[tuple[int, ItemForScrap]]:
+    # the shops are not taken in turns here, the pipeline keeps a stretch
+    # of items of one shop from holding back the others
+    shop_names = {
+        shop_id: sys.intern(shop_name)
+        for shop_id, shop_name in await connection.execute_fetchall('select id, name from shop;')
+    }
+    priority = 0
+    async for rows in iter_due_rows(connection, run_started_at, batch_size):
+        for item_id, shop_id, url, _ in rows:
+            priority += 1
+            yield priority, ItemForScrap(id=item_id, url=url, shop_id=shop_id, shop_name=shop_names[shop_id])
+
+
+async def iter_due_product_items(
+    connection: ConnectionAsync,
+    run_started_at: int,
+    batch_size: int = DB_READ_BATCH_SIZE,
+) -> AsyncIterator[ItemForScrap]:
+    async for _, item in iter_prioritized_due_items(connection, run_started_at, batch_size):
+        yield item
+
+
+INSERT_SCRAP_JOBS_QUERY = '''
+insert into scrap_job(product_item_id, priority) values (?, ?)
+on conflict(product_item_id) do nothing;
+'''
+
+
+async def enqueue_scrap_jobs(connection: ConnectionAsync, run_started_at: int) -> int:
+    # jobs keep the order of the due feed, the pipeline of every worker
+    # spreads the claimed items over the shops
+    changes_before = connection.total_changes
+    jobs = []
+    async for priority, item in iter_prioritized_due_items(connection, run_started_at):
+        jobs.append((item.id, priority))
+        if len(jobs) >= DB_WRITE_BATCH_SIZE:
+            await connection.executemany(INSERT_SCRAP_JOBS_QUERY, jobs)
+            jobs = []
+
+    await connection.executemany(INSERT_SCRAP_JOBS_QUERY, jobs)
+    await connection.commit()
+    return connection.total_changes - changes_before
+
+
+DROP_EXHAUSTED_JOBS_QUERY = '''
+delete from scrap_job
+where attempts >= ? and (lease_expires_at is null or lease_expires_at < ?);
+'''
+
+CLAIM_SCRAP_JOBS_QUERY = '''
+update scrap_job
+set lease_owner = :worker_id, lease_expires_at = :lease_expires_at, attempts = attempts + 1
+where product_item_id in (
+    select product_item_id from scrap_job
+    where lease_expires_at is null or lease_expires_at < :now
+    order by priority, product_item_id
+    limit :batch_size
+)
+returning product_item_id;
+'''
+
+CLAIMED_ITEMS_QUERY = '''
+select product_item.id, coalesce(canonical_url, url), shop.name, shop.id
+from product_item join shop on shop.id = product_item.shop_id
+where product_item.id in (select value from json_each(?));
+'''
+
+HEARTBEAT_SCRAP_JOBS_QUERY = 'update scrap_job set lease_expires_at = ? where lease_owner is ?;'
+
+RELEASE_SCRAP_JOBS_QUERY = (
+    'update scrap_job set lease_owner = null, lease_expires_at = null where lease_owner is ?;'
+)
+
+
+async def claim_scrap_jobs(
+    connection: ConnectionAsync,
+    worker_id: str,
+    batch_size: int,
+    lease: float,
+) -> tuple[ItemForScrap]:
+    now = time.time()
+    # begin immediate takes the write lock up front, so two workers
+    # can never select the same free jobs
+    await connection.execute('begin immediate;')
+    try:
+        await connection.execute(DROP_EXHAUSTED_JOBS_QUERY, (SCRAP_JOB_MAX_ATTEMPTS, now))
+
+        claimed = await connection.execute_fetchall(CLAIM_SCRAP_JOBS_QUERY, {
+            'worker_id': worker_id,
+            'lease_expires_at': now + lease,
+            'now': now,
+            'batch_size': batch_size,
+        })
+
+        resp = await connection.execute_fetchall(CLAIMED_ITEMS_QUERY, (json.dumps([i[0] for i in claimed]),))
+    except BaseException:
+        await connection.rollback()
+        raise
+
+    await connection.commit()
+    return tuple(ItemForScrap(id=i[0], url=i[1], shop_name=i[2], shop_id=i[3]) for i in resp)
+
+
+QUEUED_ITEMS_QUERY = '''
+select product_item.id, coalesce(canonical_url, url), shop.name, shop.id
+from scrap_job
+join product_item on product_item.id = scrap_job.product_item_id
+join shop on shop.id = product_item.shop_id
+where scrap_job.lease_owner is null;
+'''
+
+
+async def iter_queued_items(connection: ConnectionAsync) -> AsyncIterator[ItemForScrap]:
+    async with connection.execute(QUEUED_ITEMS_QUERY) as cursor:
+        async for i in cursor:
+            yield ItemForScrap(id=i[0], url=i[1], shop_name=i[2], shop_id=i[3])
+
+
+async def drop_scrap_jobs(connection: ConnectionAsync, item_ids: list[int]) -> None:
+    await connection.executemany(
+        'delete from scrap_job where product_item_id is ? and lease_owner is null;',
+        ((item_id,) for item_id in item_ids)
     )
+    await connection.commit()
+
+
+async def heartbeat_scrap_jobs(connection: ConnectionAsync, worker_id: str, lease: float) -> None:
+    await connection.execute(HEARTBEAT_SCRAP_JOBS_QUERY, (time.time() + lease, worker_id))
+    await connection.commit()
+
+
+async def release_scrap_jobs(connection: ConnectionAsync, worker_id: str) -> None:
+    await connection.execute(RELEASE_SCRAP_JOBS_QUERY, (worker_id,))
+    await connection.commit()
+
+
+async def count_scrap_jobs(connection: ConnectionAsync) -> int:
+    resp = await connection.execute_fetchall('select count(*) from scrap_job;')
+    return resp[0][0]
+
+
+# worker ids start with the host name of the worker
+LEASE_HOSTS_QUERY = '''
+select distinct substr(lease_owner, 1, instr(lease_owner, ':') - 1)
+from scrap_job
+where lease_owner is not null;
+'''
+
+
+async def select_lease_hosts(connection: ConnectionAsync) -> list[str]:
+    return [host for host, in await connection.execute_fetchall(LEASE_HOSTS_QUERY)]
 
-        await connection.commit()
 
+UPDATE_PRICES_QUERY = '''
+update product_item
+set
+    last_changed_at = case
+        when selling_price is :selling_price and net_price is :net_price then last_changed_at
+        else :scraped_at
+    end,
+    selling_price = :selling_price,
+    net_price = :net_price,
+    selling_price_minor = :selling_price_minor,
+    net_price_minor = :net_price_minor,
+    currency = :currency,
+    last_scraped_at = :scraped_at,
+    failure_count = 0
+where id is :id or canonical_url = (select canonical_url from product_item where id is :id);
+'''
+
+INSERT_PRICE_OBSERVATIONS_QUERY = '''
+insert or replace into price_observation(product_item_id, scraped_at, selling_price, net_price)
+select id, :scraped_at, :selling_price_minor, :net_price_minor
+from product_item
+where id is :id or canonical_url = (select canonical_url from product_item where id is :id);
+'''
+
+UPDATE_UNCHANGED_QUERY = '''
+update product_item
+set last_scraped_at = :scraped_at, failure_count = 0
+where id is :id or canonical_url = (select canonical_url from product_item where id is :id);
+'''
+
+UPDATE_FAILED_QUERY = '''
+update product_item
+set last_scraped_at = :scraped_at, failure_count = failure_count + 1
+where id is :id or canonical_url = (select canonical_url from product_item where id is :id);
+'''
 
-async def get_items_scrap_from_db() -> Iterator[ItemForScrap]:
-    async with connect_async(DB_PATH) as connection:
-        shops = await select_shops_from_db(connection)
 
-        for shop in shops:
-            if shop.name not in ('Noon', 'Mumzworld'):
-                for item in await select_product_items(connection, shop.id):
-                    yield item
+SAVED_PRICES_QUERY = '''
+select id, selling_price, net_price
+from product_item
+where id in (select value from json_each(?));
+'''
 
 
-async def get_product_items_for_result_sheet(connection: ConnectionAsync) -> tuple[ProductItemForResultSheet]:
-    table_selection = await connection.execute_fetchall('''
-with tmp_table as (
-    select
-        s.name as shop_name,
-        pi.url,
-        pi.selling_price,
-        pi.net_price,
-        pi.product_id
-    from product_item pi
-    inner join shop s on pi.shop_id = s.id
+INSERT_SCRAP_FAILURE_QUERY = '''
+insert into scrap_failure(
+    product_item_id, shop_name, failed_at, stage, reason, status, received_bytes, attempt
 )
+values (?, ?, ?, ?, ?, ?, ?, ?);
+'''
 
-select
-     t.shop_name,
-     pt.name as product_name,
-     t.url,
-     t.selling_price,
-     t.net_price
-from tmp_table t
-inner join product pt on t.product_id = pt.id;
+PRUNE_SCRAP_FAILURES_QUERY = 'delete from scrap_failure where failed_at < ?;'
+
+
+def get_price_params(prices: PricesForSave, scraped_at: int) -> dict:
+    selling_price = parse_price(prices.selling_price)
+    net_price = parse_price(prices.net_price)
+    price = selling_price or net_price
+    return {
+        **prices._asdict(),
+        'scraped_at': scraped_at,
+        'selling_price_minor': selling_price.amount if selling_price is not None else None,
+        'net_price_minor': net_price.amount if net_price is not None else None,
+        'currency': price.currency if price is not None else None,
+    }
+
+
+class PriceWriter:
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        batch_size: int = DB_WRITE_BATCH_SIZE,
+        flush_interval: float = DB_FLUSH_INTERVAL,
+        worker_id: str | None = None,
+    ) -> None:
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.worker_id = worker_id
+        self._buffer: list[tuple[PricesForSave | UnchangedPrices | ScrapFailure, int]] = []
+        self._lock = asyncio.Lock()
+        self._connection: ConnectionAsync | None = None
+        self._flusher: asyncio.Task | None = None
+
+    async def __aenter__(self) -> 'PriceWriter':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        self._connection = await open_db_async(self.db_path)
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def write(self, scrap_result: PricesForSave | UnchangedPrices | ScrapFailure) -> None:
+        self._raise_flusher_error()
+        self._buffer.append((scrap_result, int(time.time())))
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                await self._write_batch(batch)
+            except BaseException:
+                # nothing of a failed batch is kept, it goes back in front of what was written meanwhile
+                # and is written again by the next flush
+                self._buffer[:0] = batch
+                with suppress(Exception):
+                    await self._connection.rollback()
+                raise
+
+    async def _write_batch(self, batch: list[tuple[PricesForSave | UnchangedPrices | ScrapFailure, int]]) -> None:
+        started_at = time.perf_counter()
+        # an item retried at the end of a run can have several results in a batch,
+        # its state is set by the latest of them
+        latest = list({r.id: (r, t) for r, t in batch}.values())
+
+        # an unchanged page whose prices never made it to the database,
+        # or were cleared since, has them saved as a changed one
+        unchanged_ids = [r.id for r, _ in latest if isinstance(r, UnchangedPrices)]
+        if unchanged_ids:
+            saved_prices = {
+                i[0]: (i[1], i[2]) for i in await self._connection.execute_fetchall(
+                    SAVED_PRICES_QUERY, (json.dumps(unchanged_ids),)
+                )
+            }
+            latest = [
+                (PricesForSave(r.selling_price, r.net_price, r.id), t)
+                if isinstance(r, UnchangedPrices) and saved_prices.get(r.id) != (r.selling_price, r.net_price)
+                else (r, t)
+                for r, t in latest
+            ]
+
+        prices_params = [
+            get_price_params(r, t) for r, t in latest if isinstance(r, PricesForSave)
+        ]
+
+        await self._connection.executemany(UPDATE_PRICES_QUERY, prices_params)
+
+        await self._connection.executemany(INSERT_PRICE_OBSERVATIONS_QUERY, prices_params)
+
+        await self._connection.executemany(UPDATE_UNCHANGED_QUERY, (
+            {'id': r.id, 'scraped_at': t} for r, t in latest if isinstance(r, UnchangedPrices)
+        ))
+
+        await self._connection.executemany(UPDATE_FAILED_QUERY, (
+            {'id': r.id, 'scraped_at': t} for r, t in latest if isinstance(r, ScrapFailure)
+        ))
+
+        await self._connection.executemany(INSERT_SCRAP_FAILURE_QUERY, ((
+            r.id, r.shop_name, t, r.stage, r.reason, r.status, r.received_bytes, r.attempt,
+        ) for r, t in batch if isinstance(r, ScrapFailure)))
+
+        # done jobs leave the queue in the same transaction as their results
+        if self.worker_id is not None:
+            await self._connection.executemany(
+                'delete from scrap_job where product_item_id is ? and lease_owner is ?;',
+                ((r.id, self.worker_id) for r, _ in batch)
+            )
+
+        await self._connection.commit()
+        DB_WRITE_SECONDS.observe(time.perf_counter() - started_at)
+        DB_WRITES.inc(amount=len(batch))
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flusher
+            self._flusher = None
+
+        if self._connection is not None:
+            try:
+                await self.flush()
+            finally:
+                await self._connection.close()
+                self._connection = None
+
+        self._raise_flusher_error()
+
+    def _raise_flusher_error(self) -> None:
+        # the periodic flusher stops at its first error, which is raised once, to whoever writes or closes next
+        if self._flusher is not None and self._flusher.done() and not self._flusher.cancelled():
+            flusher, self._flusher = self._flusher, None
+            flusher.result()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+PRICE_AT_QUERY = '''
+select product_item_id, scraped_at, selling_price, net_price
+from price_observation
+where product_item_id is ? and scraped_at <= ?
+order by scraped_at desc
+limit 1;
+'''
+
+PRICE_WINDOW_QUERY = '''
+select min(selling_price), max(selling_price), count(*)
+from price_observation
+where product_item_id is ? and scraped_at between ? and ?;
+'''
+
+# older observations are downsampled to the last one of every day,
+# only the days that crossed the cutoff since the last downsample are read
+DOWNSAMPLE_PRICE_HISTORY_QUERY = '''
+delete from price_observation as po
+where po.scraped_at >= ? and po.scraped_at < ?
+and exists (
+    select 1
+    from price_observation later
+    where later.product_item_id = po.product_item_id
+    and later.scraped_at > po.scraped_at
+    and later.scraped_at < (po.scraped_at / ? + 1) * ?
+);
 '''
+
+
+async def select_latest_price(connection: ConnectionAsync, product_item_id: int) -> PriceObservation | None:
+    return await select_price_at(connection, product_item_id, int(time.time()))
+
+
+async def select_price_at(connection: ConnectionAsync, product_item_id: int, at: int) -> PriceObservation | None:
+    resp = await connection.execute_fetchall(PRICE_AT_QUERY, (product_item_id, at))
+
+    return PriceObservation(*resp[0]) if resp else None
+
+
+async def select_price_window(
+    connection: ConnectionAsync,
+    product_item_id: int,
+    start: int,
+    end: int,
+) -> PriceWindow:
+    resp = await connection.execute_fetchall(PRICE_WINDOW_QUERY, (product_item_id, start, end))
+
+    return PriceWindow(*resp[0])
+
+
+async def prune_price_history(connection: ConnectionAsync, now: int | None = None) -> None:
+    now = int(time.time()) if now is None else now
+
+    await connection.execute(
+        'delete from price_observation where scraped_at < ?;',
+        (now - PRICE_HISTORY_RETENTION,)
+    )
+
+    # the last downsample left one observation in every day before its cutoff,
+    # its last day is read again in case the cutoff fell inside it
+    resp = await connection.execute_fetchall('select max(downsampled_before) from scrap_run;')
+    downsampled_before = resp[0][0] // SECONDS_IN_DAY * SECONDS_IN_DAY if resp[0][0] is not None else 0
+    cutoff = now - PRICE_HISTORY_DOWNSAMPLE_AFTER
+
+    await connection.execute(
+        DOWNSAMPLE_PRICE_HISTORY_QUERY, (downsampled_before, cutoff, SECONDS_IN_DAY, SECONDS_IN_DAY)
+    )
+    await connection.execute(
+        'update scrap_run set downsampled_before = ? where id = (select max(id) from scrap_run);', (cutoff,)
     )
-    return tuple(ProductItemForResultSheet(
-        shop_name=item[0],
-        product_name=item[1],
-        product_item_link=item[2],
-        selling_price=item[3],
-        net_price=item[4],
-    ) for item in table_selection)
 
+    await connection.commit()
+
+
+async def prune_scrap_failures(connection: ConnectionAsync, now: int | None = None) -> None:
+    now = int(time.time()) if now is None else now
+    await connection.execute(PRUNE_SCRAP_FAILURES_QUERY, (now - SCRAP_FAILURE_RETENTION,))
+    await connection.commit()
+
+
+# the writer stamps a result a moment after its page was archived,
+# so a replayed page replaces the observation closest to it within this many seconds
+REPLAY_MATCH_SLACK = 300
+
+REPLAY_PRICE_OBSERVATIONS_QUERY = '''
+insert or replace into price_observation(product_item_id, scraped_at, selling_price, net_price)
+select
+    id,
+    coalesce((
+        select scraped_at from price_observation
+        where product_item_id is product_item.id
+            and scraped_at between :scraped_at - :slack and :scraped_at + :slack
+        order by abs(scraped_at - :scraped_at)
+        limit 1
+    ), :scraped_at),
+    :selling_price_minor,
+    :net_price_minor
+from product_item
+where id is :id or canonical_url = (select canonical_url from product_item where id is :id);
+'''
+
+# pages scraped after the latest archived one, while the archive was off, keep their prices
+REPLAY_CURRENT_PRICES_QUERY = '''
+update product_item
+set
+    selling_price = :selling_price,
+    net_price = :net_price,
+    selling_price_minor = :selling_price_minor,
+    net_price_minor = :net_price_minor,
+    currency = :currency
+where (id is :id or canonical_url = (select canonical_url from product_item where id is :id))
+    and not exists (
+        select 1 from price_observation
+        where product_item_id is product_item.id and scraped_at > :scraped_at + :slack
+    );
+'''
+
+
+def save_replayed_prices(connection: Connection, replayed_prices: list[ReplayedPrices]) -> None:
+    prices_params = [
+        {
+            **get_price_params(PricesForSave(*r.prices, id=r.id), r.archived_at),
+            'slack': REPLAY_MATCH_SLACK,
+            'latest': r.latest,
+        } for r in replayed_prices
+    ]
+    connection.executemany(REPLAY_PRICE_OBSERVATIONS_QUERY, prices_params)
+    connection.executemany(REPLAY_CURRENT_PRICES_QUERY, (p for p in prices_params if p['latest']))
+    connection.commit()
+
+
+async def get_items_scrap_from_db(run_started_at: int) -> AsyncIterator[ItemForScrap]:
+    async with connect_db_async() as connection:
+        async for item in iter_due_product_items(connection, run_started_at):
+            yield item
+
+
+# items come grouped by product in the order of the sheet rows,
+# products without items come once with empty shop and link
+RESULT_SHEET_QUERY = '''
+select
+    s.name as shop_name,
+    p.name as product_name,
+    pi.url,
+    pi.selling_price,
+    pi.net_price,
+    pi.selling_price_minor,
+    pi.net_price_minor,
+    pi.currency
+from product p
+left join product_item pi on pi.product_id = p.id
+left join shop s on pi.shop_id = s.id
+order by p.id;
+'''
+
+
+async def iter_result_sheet_rows(
+    connection: ConnectionAsync,
+    batch_size: int = DB_READ_BATCH_SIZE,
+) -> AsyncIterator[list[tuple]]:
+    async with connection.execute(RESULT_SHEET_QUERY) as cursor:
+        while rows := await cursor.fetchmany(batch_size):
+            yield rows
+
+
+async def get_product_items_for_result_sheet(
+    connection: ConnectionAsync,
+) -> AsyncIterator[ProductItemForResultSheet]:
+    async for rows in iter_result_sheet_rows(connection):
+        for item in rows:
+            yield ProductItemForResultSheet(
+                shop_name=item[0],
+                product_name=item[1],
+                product_item_link=item[2],
+                selling_price=item[3],
+                net_price=item[4],
+                selling_price_minor=item[5],
+                net_price_minor=item[6],
+                currency=item[7],
+            )
+
+
+DUE_CHECK_PARAMS = {**get_due_query_params(0), 'batch_size': 1, 'after_id': 0, 'after_changed_at': 0}
+
+# queries run per item or per batch of a run, none of them may read a whole table
+# except where the query is a pass over all of its rows
+HOT_QUERIES = {
+    'load product items': QueryPlanCheck(LOAD_PRODUCT_ITEMS_QUERY, (1, 1, '', '')),
+    'due new items': QueryPlanCheck(DUE_NEW_ITEMS_QUERY, DUE_CHECK_PARAMS),
+    'due changed items': QueryPlanCheck(DUE_CHANGED_ITEMS_QUERY, DUE_CHECK_PARAMS),
+    'due changed together items': QueryPlanCheck(DUE_CHANGED_TOGETHER_ITEMS_QUERY, DUE_CHECK_PARAMS),
+    'due unchanged items': QueryPlanCheck(DUE_UNCHANGED_ITEMS_QUERY, DUE_CHECK_PARAMS),
+    'drop exhausted jobs': QueryPlanCheck(DROP_EXHAUSTED_JOBS_QUERY, (SCRAP_JOB_MAX_ATTEMPTS, 0)),
+    # the scan follows the priority index and stops at the batch size
+    'claim scrap jobs': QueryPlanCheck(
+        CLAIM_SCRAP_JOBS_QUERY,
+        {'worker_id': '', 'lease_expires_at': 0, 'now': 0, 'batch_size': 1},
+        ('scrap_job',),
+    ),
+    'claimed items': QueryPlanCheck(CLAIMED_ITEMS_QUERY, ('[]',)),
+    'heartbeat scrap jobs': QueryPlanCheck(HEARTBEAT_SCRAP_JOBS_QUERY, (0, '')),
+    'release scrap jobs': QueryPlanCheck(RELEASE_SCRAP_JOBS_QUERY, ('',)),
+    'update prices': QueryPlanCheck(
+        UPDATE_PRICES_QUERY,
+        {
+            'id': 0,
+            'scraped_at': 0,
+            'selling_price': None,
+            'net_price': None,
+            'selling_price_minor': None,
+            'net_price_minor': None,
+            'currency': None,
+        },
+    ),
+    'insert price observations': QueryPlanCheck(
+        INSERT_PRICE_OBSERVATIONS_QUERY,
+        {'id': 0, 'scraped_at': 0, 'selling_price_minor': None, 'net_price_minor': None},
+    ),
+    'update unchanged': QueryPlanCheck(UPDATE_UNCHANGED_QUERY, {'id': 0, 'scraped_at': 0}),
+    'update failed': QueryPlanCheck(UPDATE_FAILED_QUERY, {'id': 0, 'scraped_at': 0}),
+    'price at': QueryPlanCheck(PRICE_AT_QUERY, (0, 0)),
+    'price window': QueryPlanCheck(PRICE_WINDOW_QUERY, (0, 0, 0)),
+    'downsample price history': QueryPlanCheck(DOWNSAMPLE_PRICE_HISTORY_QUERY, (0, 0, 1, 1)),
+    'prune scrap failures': QueryPlanCheck(PRUNE_SCRAP_FAILURES_QUERY, (0,)),
+    # the sheet lists every product
+    'result sheet': QueryPlanCheck(RESULT_SHEET_QUERY, (), ('p',)),
+}
+
+
+def check_query_plans(connection: Connection) -> dict[str, list[str]]:
+    full_scans = {}
+    for name, check in HOT_QUERIES.items():
+        if found := find_full_scans(connection, check.query, check.params, check.allowed_scans):
+            full_scans[name] = found
+    return full_scans
 
 
 if __name__ == '__main__':
-    connection = connect(DB_PATH)
-    print(select_shops_from_db(connection))
+    # migrates the database and fails when a hot query reads a whole table
+    connection = connect_db()
+    try:
+        full_scans = check_query_plans(connection)
+    finally:
+        connection.close()
+
+    for name, details in full_scans.items():
+        print(f'{name}: {"; ".join(details)}')
+    sys.exit(1 if full_scans else 0)
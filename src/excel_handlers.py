@@ -1,13 +1,17 @@
+from contextlib import closing
+from copy import copy
 from datetime import datetime
 from itertools import product
-from typing import Iterator
+from typing import Iterator, TypeAlias
 
 from openpyxl import Workbook, load_workbook
-from openpyxl.worksheet.worksheet import Worksheet
-from openpyxl.cell.cell import Cell
+from openpyxl.worksheet._write_only import WriteOnlyWorksheet
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment, Font, NamedStyle
 from openpyxl.utils.cell import get_column_letter
 
+from prices import get_minor_digits, to_major_units
 from data_types import ProductItem, ShopName, ProductName, InfoForDb, ProductItemForResultSheet
 from config import ROOT_DIR
 
@@ -25,152 +29,162 @@ COMMON_CELL_STYLE = NamedStyle(
     ),
 )
 
+WRAPPED_CELL_STYLE = NamedStyle(
+    name='WRAPPED_CELL_STYLE',
+    alignment=Alignment(
+        horizontal='center',
+        vertical='center',
+        wrap_text=True,
+        indent=10
+    ),
+    font=Font(
+        name='Arial',
+        size=10
+    ),
+)
 
-def delete_empty_cols(worksheet: Worksheet) -> Worksheet:
-    empty_cols = []
-
-    for col in worksheet.iter_cols():
-        cell = col[0]
-        if cell.value == None:
-            empty_cols.append(cell.column)
-
-    for col_index in empty_cols[::-1]:
-        worksheet.delete_cols(col_index)
-
-    return worksheet
 
+ShopColumns: TypeAlias = tuple[tuple[int, ShopName], ...]
 
-def delete_empty_rows(worksheet: Worksheet) -> Worksheet:
-    empty_rows = []
 
-    for row in worksheet.iter_rows():
-        cell = row[0]
-        if cell.value == None:
-            empty_rows.append(cell.row)
+def get_price_number_format(currency: str) -> str:
+    if digits := get_minor_digits(currency):
+        return f'#,##0.{"0" * digits} "{currency}"'
+    return f'#,##0 "{currency}"'
 
-    for row_index in empty_rows[::-1]:
-        worksheet.delete_rows(row_index)
 
-    return worksheet
+def iter_sheet_rows(path_to_excell_file: str) -> Iterator[tuple]:
+    # rows without a product title are skipped, the first row left is the header
+    workbook = load_workbook(path_to_excell_file, read_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            if row and row[0] is not None:
+                yield row
+    finally:
+        workbook.close()
 
 
-def parse_products(worksheet: Worksheet) -> Iterator[ProductName]:
-    for product in worksheet.iter_rows(min_row=2, max_col=1):
-        yield product[0].value
+def parse_shop_columns(header: tuple) -> ShopColumns:
+    # columns without a shop name are skipped
+    return tuple(
+        (indx, shop_name) for indx, shop_name in enumerate(header)
+        if indx > 0 and shop_name is not None
+    )
 
 
-def parse_shops(worksheet: Worksheet) -> Iterator[ShopName]:
-    for shop in worksheet.iter_cols(min_col=2, max_row=1):
-        yield shop[0].value
+def parse_shops(shop_columns: ShopColumns) -> Iterator[ShopName]:
+    for _, shop_name in shop_columns:
+        yield shop_name
 
 
-def parse_product_items(
-    worksheet: Worksheet,
-) -> Iterator[ProductItem]:
+def parse_product_items(row: tuple, shop_columns: ShopColumns) -> Iterator[ProductItem]:
+    for indx, shop_name in shop_columns:
+        yield ProductItem(
+            shop_name=shop_name,
+            product_name=row[0],
+            url=row[indx] if indx < len(row) else None
+        )
 
-    for column in worksheet.iter_cols(min_row=2, min_col=2):
 
-        for cell in column:
-            shop_name = worksheet.cell(column=cell.column, row=1).value
-            product_name = worksheet.cell(column=1, row=cell.row).value
+def parce_excell_file(path_to_excell_file: str) -> InfoForDb:
+    # the sheet is read once, only the titles and the links of the shop columns are kept
+    product_names = []
+    product_item_links = []
 
-            yield ProductItem(
-                shop_name=shop_name,
-                product_name=product_name,
-                url=cell.value
-            )
+    with closing(iter_sheet_rows(path_to_excell_file)) as rows:
+        shop_columns = parse_shop_columns(next(rows, ()))
+        for row in rows:
+            product_names.append(row[0])
+            product_item_links.extend(parse_product_items(row, shop_columns))
 
+    return InfoForDb(list(parse_shops(shop_columns)), product_names, product_item_links)
 
-def parce_excell_file(path_to_excell_file: str) -> InfoForDb:
-    workbook = load_workbook(path_to_excell_file)
-    worksheet = delete_empty_cols(delete_empty_rows(workbook.active))
 
-    shop_names = parse_shops(worksheet)
-    product_names = parse_products(worksheet)
-    product_item_links = parse_product_items(worksheet)
+def make_cell(worksheet: WriteOnlyWorksheet, value, style: NamedStyle = COMMON_CELL_STYLE) -> WriteOnlyCell:
+    cell = WriteOnlyCell(worksheet, value=value)
+    cell.style = style
+    return cell
 
-    return InfoForDb(shop_names, product_names, product_item_links)
 
-
-def create_result_sheet_header(worksheet: Worksheet, shops, products) -> Worksheet:
+def create_result_sheet_header(worksheet: WriteOnlyWorksheet, shops) -> dict[ShopName, int]:
     BASE_COLUMN_WIDTH = 10
     TITLE_COLUMN_WIDTH = 40
 
-    worksheet.merge_cells('A1:A2')
+    worksheet.merged_cells.add('A1:A2')
     worksheet.row_dimensions[1].height = 25
     worksheet.row_dimensions[2].height = 25
-
-
-    title_cell = worksheet.cell(row=1, column=1)
-    title_cell.value = 'Title'
-    title_cell.style = COMMON_CELL_STYLE
+    worksheet.sheet_format.defaultRowHeight = 20
+    worksheet.sheet_format.customHeight = True
     worksheet.column_dimensions['A'].width = TITLE_COLUMN_WIDTH
 
-    columns_count = 1
-    for shop in shops:
-        worksheet.merge_cells(
-            start_row=1,
-            end_row=1,
-            start_column=columns_count + 1,
-            end_column=columns_count + 3
-        )
-
-        shop_name_cell: Cell = worksheet.cell(row=1, column=columns_count + 1)
-        shop_name_cell.value = shop.name
-        shop_name_cell.style = COMMON_CELL_STYLE
-
-        url_cell = worksheet.cell(row=2, column=columns_count + 1)
-        url_cell.value = "URL"
-        url_cell.style = COMMON_CELL_STYLE
-        worksheet.column_dimensions[get_column_letter(columns_count + 1)].width = BASE_COLUMN_WIDTH
-
-        selling_price_cell = worksheet.cell(row=2, column=columns_count + 2)
-        selling_price_cell.value = "Selling price"
-        selling_price_cell.style = COMMON_CELL_STYLE
-        worksheet.column_dimensions[get_column_letter(columns_count + 2)].width = BASE_COLUMN_WIDTH
+    shop_row = [make_cell(worksheet, 'Title')]
+    columns_row = [None]
+    shop_columns = {}
 
-        net_price_cell = worksheet.cell(row=2, column=columns_count + 3)
-        net_price_cell.value = "Price before discount"
-        net_price_cell.style = COMMON_CELL_STYLE
-        net_price_cell.alignment = Alignment(
-                                        horizontal='center',
-                                        vertical='center',
-                                        wrap_text=True,
-                                        indent=10
-                                    )
-
-        worksheet.column_dimensions[get_column_letter(columns_count + 3)].width = BASE_COLUMN_WIDTH
-
-        columns_count += 3
-
-    rows_count = 3
-    for product in products:
-        worksheet.cell(row=rows_count, column=1).value = product.name
-        worksheet.row_dimensions[rows_count].height = 20
-        rows_count += 1
-
-
-def fill_result_sheet(worksheet: Worksheet, product_items: list[ProductItemForResultSheet]):
-    sheet_cols = tuple(worksheet.iter_cols(max_row=1, min_col=2))
-    sheet_rows = tuple(worksheet.iter_rows(min_row=3, max_col=1))
+    for shop in shops:
+        shop_column = len(shop_row) + 1
+        shop_columns[shop.name] = shop_column
+
+        worksheet.merged_cells.add(CellRange(
+            min_row=1,
+            max_row=1,
+            min_col=shop_column,
+            max_col=shop_column + 2
+        ))
+        for column in range(shop_column, shop_column + 3):
+            worksheet.column_dimensions[get_column_letter(column)].width = BASE_COLUMN_WIDTH
+
+        shop_row.extend((make_cell(worksheet, shop.name), None, None))
+        columns_row.extend((
+            make_cell(worksheet, 'URL'),
+            make_cell(worksheet, 'Selling price'),
+            make_cell(worksheet, 'Price before discount', WRAPPED_CELL_STYLE),
+        ))
+
+    worksheet.append(shop_row)
+    worksheet.append(columns_row)
+
+    return shop_columns
+
+
+def append_result_sheet_row(
+    worksheet: WriteOnlyWorksheet,
+    shop_columns: dict[ShopName, int],
+    product_items: list[ProductItemForResultSheet],
+) -> None:
+    # resolving a named style is the slowest part of making a cell,
+    # so it is done once per row and the resulting style is copied
+    style = make_cell(worksheet, None)._style
+
+    def make_styled_cell(value) -> WriteOnlyCell:
+        cell = WriteOnlyCell(worksheet, value=value if value != None else '-')
+        cell._style = copy(style)
+        return cell
+
+    # prices with a known amount go in as numbers, so the sheet can sort and sum them,
+    # a price text that could not be read is shown as it is
+    def make_price_cell(text: str | None, amount: int | None, currency: str | None) -> WriteOnlyCell:
+        if amount is None or currency is None:
+            return make_styled_cell(text)
+
+        cell = make_styled_cell(to_major_units(amount, currency))
+        cell.number_format = get_price_number_format(currency)
+        return cell
+
+    row = [None] * (1 + 3 * len(shop_columns))
+    row[0] = product_items[0].product_name
 
     for item in product_items:
-        for col, col_indx in zip(sheet_cols, range(2, len(sheet_cols) + 3)):
-            if item.shop_name == col[0].value:
-                for row, row_indx in zip(sheet_rows, range(3, len(sheet_rows) + 4)):
-                    if item.product_name == row[0].value:
-                        url_cell = worksheet.cell(column=col_indx, row=row_indx)
-                        url_cell.value = item.product_item_link if item.product_item_link != None else '-'
-                        url_cell.style = COMMON_CELL_STYLE
-
-                        selling_price_cell = worksheet.cell(column=col_indx + 1, row=row_indx)
-                        selling_price_cell.value = item.selling_price if item.selling_price != None else '-'
-                        selling_price_cell.style = COMMON_CELL_STYLE
-
-                        net_price_cell = worksheet.cell(column=col_indx + 2, row=row_indx)
-                        net_price_cell.value = item.net_price if item.net_price != None else '-'
-                        net_price_cell.style = COMMON_CELL_STYLE
+        if (shop_column := shop_columns.get(item.shop_name)) is None:
+            continue
+
+        row[shop_column - 1: shop_column + 2] = (
+            make_styled_cell(item.product_item_link),
+            make_price_cell(item.selling_price, item.selling_price_minor, item.currency),
+            make_price_cell(item.net_price, item.net_price_minor, item.currency),
+        )
 
+    worksheet.append(row)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+import csv
+import json
+
+from typing import AsyncIterator, Iterable
+
+from data_types import Shop, ShopName
+from config import EXPORT_BATCH_SIZE
+
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet', 'arrow')
+
+EXPORT_LAYOUTS = ('long', 'wide')
+
+LONG_COLUMNS = (
+    'product_name',
+    'shop_name',
+    'url',
+    'selling_price',
+    'net_price',
+    'selling_price_minor',
+    'net_price_minor',
+    'currency',
+)
+
+SHOP_COLUMNS = ('url', 'selling_price', 'net_price', 'selling_price_minor', 'net_price_minor', 'currency')
+
+# the amounts of the prices in minor units, every other column is text
+INTEGER_COLUMNS = frozenset(('selling_price_minor', 'net_price_minor'))
+
+
+class ExportError(Exception):
+    pass
+
+
+def is_integer_column(column: str) -> bool:
+    # the columns of the wide layout are prefixed with the shop name
+    return column.rsplit(' ', 1)[-1] in INTEGER_COLUMNS
+
+
+def get_columns(layout: str, shops: Iterable[Shop]) -> list[str]:
+    if layout == 'long':
+        return list(LONG_COLUMNS)
+    return ['product_name'] + [f'{shop.name} {column}' for shop in shops for column in SHOP_COLUMNS]
+
+
+# the batches hold rows of the result sheet query: shop name, product name, url,
+# selling price, net price and then the amounts of the prices with their currency
+async def iter_long_rows(batches: AsyncIterator[list[tuple]]) -> AsyncIterator[list[tuple]]:
+    async for rows in batches:
+        yield [(row[1], row[0], *row[2:]) for row in rows]
+
+
+async def iter_wide_rows(
+    batches: AsyncIterator[list[tuple]],
+    shops: Iterable[Shop],
+) -> AsyncIterator[list[tuple]]:
+    # rows come grouped by product, so only one product row is held across batches
+    shop_offsets: dict[ShopName, int] = {
+        shop.name: 1 + i * len(SHOP_COLUMNS) for i, shop in enumerate(shops)
+    }
+    row_size = 1 + len(shop_offsets) * len(SHOP_COLUMNS)
+    product_row = None
+
+    async for rows in batches:
+        product_rows = []
+        for shop_name, product_name, *shop_values in rows:
+            if product_row is None or product_name != product_row[0]:
+                if product_row is not None:
+                    product_rows.append(tuple(product_row))
+                product_row = [product_name] + [None] * (row_size - 1)
+
+            if (offset := shop_offsets.get(shop_name)) is not None:
+                product_row[offset:offset + len(SHOP_COLUMNS)] = shop_values
+        yield product_rows
+
+    if product_row is not None:
+        yield [tuple(product_row)]
+
+
+class CsvWriter:
+    def __init__(self, path: str, columns: list[str]) -> None:
+        self._file = open(path, 'w', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows: list[tuple]) -> None:
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, path: str, columns: list[str]) -> None:
+        self._file = open(path, 'w', encoding='utf-8')
+        self.columns = columns
+
+    def write(self, rows: list[tuple]) -> None:
+        self._file.writelines(
+            json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + '\n' for row in rows
+        )
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ArrowWriter:
+    def __init__(self, path: str, columns: list[str], file_format: str) -> None:
+        try:
+            import pyarrow as pa
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError(f'{file_format} export needs the pyarrow package') from None
+
+        self._pa = pa
+        # a column of a shop without items stays all null
+        self.schema = pa.schema([
+            (column, pa.int64() if is_integer_column(column) else pa.string()) for column in columns
+        ])
+        if file_format == 'parquet':
+            self._writer = pa.parquet.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self._writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, rows: list[tuple]) -> None:
+        columns = [
+            self._pa.array(column, field.type) for column, field in zip(zip(*rows), self.schema)
+        ]
+        self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def open_writer(path: str, file_format: str, columns: list[str]) -> CsvWriter | JsonLinesWriter | ArrowWriter:
+    match file_format:
+        case 'csv':
+            return CsvWriter(path, columns)
+        case 'jsonl':
+            return JsonLinesWriter(path, columns)
+        case 'parquet' | 'arrow':
+            return ArrowWriter(path, columns, file_format)
+        case _:
+            raise ExportError(f'unknown export format {file_format!r}')
+
+
+async def export_rows(
+    batches: AsyncIterator[list[tuple]],
+    path: str,
+    file_format: str,
+    columns: list[str],
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> int:
+    # small read batches are joined, so parquet row groups do not get tiny
+    writer = open_writer(path, file_format, columns)
+    exported = 0
+    batch = []
+    try:
+        async for rows in batches:
+            batch.extend(rows)
+            if len(batch) >= batch_size:
+                writer.write(batch)
+                exported += len(batch)
+                batch = []
+
+        if batch:
+            writer.write(batch)
+            exported += len(batch)
+    finally:
+        writer.close()
+
+    return exported
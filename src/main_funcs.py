@@ -1,67 +1,374 @@
 import asyncio
-import aiohttp
 
-from typing import Iterator
+from collections import deque
+from contextlib import nullcontext, suppress
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable
 
-from aiosqlite import (
-    connect as connect_async
-)
-from fake_useragent import UserAgent
-from openpyxl import Workbook
-
-from excel_handlers import create_result_sheet_header, fill_result_sheet, parce_excell_file
+# openpyxl and the scraping stack (aiohttp, lxml) are imported by the actions
+# that use them, so the tui menu and the other actions start without them
 from db_handlers import (
     load_data_to_db,
     get_items_scrap_from_db,
-    select_products_from_db,
     select_shops_from_db,
-    write_prices_to_db,
-    get_product_items_for_result_sheet
+    get_product_items_for_result_sheet,
+    iter_result_sheet_rows,
+    PriceWriter,
+    drop_scrap_jobs,
+    iter_queued_items,
+    prune_price_history,
+    prune_scrap_failures,
+    start_scrap_run,
+    finish_scrap_run,
 )
-from parsers import get_prices_for_product_item
-from data_types import PricesForSave
-from config import DB_PATH, EXCEL_RESULT_PATH, EXCEL_INPUT_PATH
+from schema import connect_db_async
+from urls import canonicalize_url
+from metrics import ITEMS, LISTING_HITS, METRICS, save_snapshot, serve_metrics
+from exporters import EXPORT_LAYOUTS, ExportError, export_rows, get_columns, iter_long_rows, iter_wide_rows
+from data_types import ItemForScrap, PricesForSave, ScrapFailure, ScrappedPrices, ShopName, UnchangedPrices
+from config import (
+    DB_PATH,
+    EXCEL_RESULT_PATH,
+    EXCEL_INPUT_PATH,
+    SCRAP_CONCURRENCY,
+    SCRAP_QUEUE_SIZE,
+    SCRAP_RETRY_ROUNDS,
+    SCRAP_RETRY_DELAY,
+    PAGE_CACHE_ENABLED,
+    PAGE_ARCHIVE_ENABLED,
+    STREAM_PAGES,
+    LISTING_MODE,
+    LISTING_PAGES_PATH,
+    PARSE_WORKERS,
+    METRICS_PORT,
+    METRICS_HOST,
+    METRICS_SNAPSHOT_PATH,
+    DEFAULT_FETCH_SETTINGS,
+    SHOP_FETCH_SETTINGS,
+)
+
+
+SCRAP_DONE = object()
+
+SCRAP_OUTCOMES = {
+    PricesForSave: 'saved',
+    UnchangedPrices: 'unchanged',
+    ScrapFailure: 'failed',
+}
 
 
 def add_new_products_for_monitoring(path_to_excell_file: str, mode='a') -> None:
+    from excel_handlers import parce_excell_file
+
     load_data_to_db(parce_excell_file(path_to_excell_file), mode=mode)
 
 
-async def get_prices() -> Iterator[PricesForSave]:
-    ua = UserAgent()
-    async with aiohttp.ClientSession() as session:
-        async for item in get_items_scrap_from_db():
-            yield await get_prices_for_product_item(session, item, ua)
+def get_shop_concurrency(shop_name: ShopName) -> int:
+    return SHOP_FETCH_SETTINGS.get(shop_name, DEFAULT_FETCH_SETTINGS).max_concurrency
+
+
+async def scrap_worker(
+    scrap: Callable[..., Awaitable[PricesForSave | UnchangedPrices | ScrapFailure]],
+    items: asyncio.Queue,
+    results: asyncio.Queue,
+    global_limit: asyncio.Semaphore,
+) -> None:
+    while (item := await items.get()) is not None:
+        try:
+            async with global_limit:
+                prices = await scrap(scrap_item=item)
+        except Exception as error:
+            await results.put(error)
+            return
+
+        ITEMS.inc(item.shop_name, SCRAP_OUTCOMES[type(prices)])
+        await results.put(prices)
+
+
+async def run_scrap_pipeline(
+    scrap: Callable[..., Awaitable[PricesForSave | UnchangedPrices | ScrapFailure]],
+    items: AsyncIterator[ItemForScrap],
+    results: asyncio.Queue,
+    queue_size: int = SCRAP_QUEUE_SIZE,
+) -> None:
+    # every shop gets its own queue and pool of workers, so a slow shop
+    # only holds its own workers while the others keep fetching
+    global_limit = asyncio.Semaphore(SCRAP_CONCURRENCY)
+    shop_queues: dict[ShopName, asyncio.Queue[ItemForScrap | None]] = {}
+    workers: list[asyncio.Task] = []
+    # the feed is in the due order of all shops, items of a shop with a full queue
+    # wait here, so a stretch of one shop doesn't hold back the other shops behind it;
+    # once queue_size items wait, the feed waits for room in the queue of the longest line
+    waiting: dict[ShopName, deque[ItemForScrap]] = {}
+    waiting_count = 0
+
+    def move_waiting() -> None:
+        nonlocal waiting_count
+        for shop_name, shop_items in waiting.items():
+            queue = shop_queues[shop_name]
+            while shop_items and not queue.full():
+                queue.put_nowait(shop_items.popleft())
+                waiting_count -= 1
+
+    async def close_queue(shop_name: ShopName) -> None:
+        queue = shop_queues[shop_name]
+        while waiting[shop_name]:
+            await queue.put(waiting[shop_name].popleft())
+        for _ in range(get_shop_concurrency(shop_name)):
+            await queue.put(None)
+
+    try:
+        async for item in items:
+            if item.shop_name not in shop_queues:
+                queue = asyncio.Queue(maxsize=queue_size)
+                shop_queues[item.shop_name] = queue
+                waiting[item.shop_name] = deque()
+                workers.extend(
+                    asyncio.create_task(
+                        scrap_worker(scrap, queue, results, global_limit)
+                    ) for _ in range(get_shop_concurrency(item.shop_name))
+                )
+
+            waiting[item.shop_name].append(item)
+            waiting_count += 1
+            move_waiting()
+            if waiting_count and waiting_count >= queue_size:
+                shop_name, shop_items = max(waiting.items(), key=lambda shop_waiting: len(shop_waiting[1]))
+                await shop_queues[shop_name].put(shop_items.popleft())
+                waiting_count -= 1
+
+        await asyncio.gather(*(close_queue(shop_name) for shop_name in shop_queues))
+        await asyncio.gather(*workers)
+    except Exception as error:
+        await results.put(error)
+    else:
+        await results.put(SCRAP_DONE)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def iter_items(items: list[ItemForScrap]) -> AsyncIterator[ItemForScrap]:
+    for item in items:
+        yield item
+
+
+async def iter_scrap_results(
+    scrap: Callable[..., Awaitable[PricesForSave | UnchangedPrices | ScrapFailure]],
+    items: AsyncIterator[ItemForScrap],
+    queue_size: int = SCRAP_QUEUE_SIZE,
+) -> AsyncIterator[PricesForSave | UnchangedPrices | ScrapFailure]:
+    results = asyncio.Queue(maxsize=queue_size)
+    pipeline = asyncio.create_task(run_scrap_pipeline(scrap, items, results, queue_size))
+
+    try:
+        while (result := await results.get()) is not SCRAP_DONE:
+            if isinstance(result, Exception):
+                raise result
+            yield result
+
+        await pipeline
+    finally:
+        pipeline.cancel()
+        with suppress(asyncio.CancelledError):
+            await pipeline
+
+
+async def get_listing_prices(
+    get_prices_from_listing_page: Callable[..., Awaitable[list]],
+    listing_pages_path: str = LISTING_PAGES_PATH,
+) -> dict[tuple[ShopName, str], ScrappedPrices]:
+    from parsers import load_listing_pages
+
+    listing_pages = load_listing_pages(listing_pages_path)
+    pages_prices = await asyncio.gather(*(
+        get_prices_from_listing_page(listing_page=listing_page) for listing_page in listing_pages
+    ))
+
+    return {
+        (listing_page.shop_name, listing_price.url): ScrappedPrices(
+            selling_price=listing_price.selling_price,
+            net_price=listing_price.net_price,
+        )
+        for listing_page, listing_prices in zip(listing_pages, pages_prices)
+        for listing_price in listing_prices
+    }
+
+
+def get_listing_result(
+    scrap_item: ItemForScrap,
+    listing_prices: dict[tuple[ShopName, str], ScrappedPrices],
+) -> PricesForSave | None:
+    listing_key = (scrap_item.shop_name, canonicalize_url(scrap_item.shop_name, scrap_item.url))
+    if (prices := listing_prices.get(listing_key)) is None:
+        return None
+
+    LISTING_HITS.inc(scrap_item.shop_name)
+    return PricesForSave(id=scrap_item.id, selling_price=prices.selling_price, net_price=prices.net_price)
+
+
+async def fetch_listing_prices(parse_workers: int = PARSE_WORKERS) -> dict[tuple[ShopName, str], ScrappedPrices]:
+    from parsers import ParsePool, get_prices_from_listing_page
+    from web_utils import ClientSessions, RateLimiters, load_user_agents, make_trace_config
+
+    async with ClientSessions(trace_configs=[make_trace_config()]) as sessions:
+        with ParsePool(workers=parse_workers) if not STREAM_PAGES else nullcontext() as parse_pool:
+            return await get_listing_prices(partial(
+                get_prices_from_listing_page,
+                sessions=sessions,
+                user_agent=load_user_agents(),
+                rate_limiters=RateLimiters(),
+                parse_pool=parse_pool,
+            ))
+
+
+async def save_queued_listing_prices(
+    listing_prices: dict[tuple[ShopName, str], ScrappedPrices],
+    db_path: str = DB_PATH,
+) -> int:
+    # the process that starts a worker run fetches the listings once, saves the prices
+    # of the queued items they show and drops their jobs, the workers never fetch them
+    async with connect_db_async(db_path) as connection:
+        results = [
+            result async for item in iter_queued_items(connection)
+            if (result := get_listing_result(item, listing_prices)) is not None
+        ]
+
+        async with PriceWriter(db_path=db_path) as writer:
+            for result in results:
+                await writer.write(result)
+
+        await drop_scrap_jobs(connection, [result.id for result in results])
+    return len(results)
+
+
+async def get_prices(
+    items: AsyncIterator[ItemForScrap],
+    parse_workers: int = PARSE_WORKERS,
+    queue_size: int = SCRAP_QUEUE_SIZE,
+    listing_mode: bool = LISTING_MODE,
+) -> AsyncIterator[PricesForSave | UnchangedPrices | ScrapFailure]:
+    from parsers import ParsePool, get_prices_for_product_item, get_prices_from_listing_page
+    from page_cache import PageCache
+    from page_archive import PageArchive
+    from web_utils import ClientSessions, RateLimiters, load_user_agents, make_trace_config
+
+    async with (
+        ClientSessions(trace_configs=[make_trace_config()]) as sessions,
+        PageCache() if PAGE_CACHE_ENABLED and not STREAM_PAGES else nullcontext() as page_cache,
+        PageArchive() if PAGE_ARCHIVE_ENABLED and not STREAM_PAGES else nullcontext() as page_archive,
+    ):
+        with ParsePool(workers=parse_workers) if not STREAM_PAGES else nullcontext() as parse_pool:
+            user_agent = load_user_agents()
+            rate_limiters = RateLimiters()
+            scrap = partial(
+                get_prices_for_product_item,
+                sessions=sessions,
+                user_agent=user_agent,
+                rate_limiters=rate_limiters,
+                page_cache=page_cache,
+                parse_pool=parse_pool,
+                stream_pages=STREAM_PAGES,
+                page_archive=page_archive,
+            )
+            retry_items: list[ItemForScrap] = []
+
+            # one listing page prices dozens of items, their product pages are only
+            # fetched for the items the listings do not show
+            listing_prices = {}
+            if listing_mode:
+                listing_prices = await get_listing_prices(partial(
+                    get_prices_from_listing_page,
+                    sessions=sessions,
+                    user_agent=user_agent,
+                    rate_limiters=rate_limiters,
+                    parse_pool=parse_pool,
+                ))
+
+            async def scrap_and_keep_transient_failures(
+                scrap_item: ItemForScrap,
+            ) -> PricesForSave | UnchangedPrices | ScrapFailure:
+                if (listing_result := get_listing_result(scrap_item, listing_prices)) is not None:
+                    return listing_result
+
+                result = await scrap(scrap_item=scrap_item)
+                if isinstance(result, ScrapFailure) and result.transient:
+                    retry_items.append(scrap_item)
+                return result
+
+            # items failed with a transient error are tried again once the others are done,
+            # every failed attempt is saved, so the last result of an item is the one it keeps
+            for attempt in range(1, SCRAP_RETRY_ROUNDS + 2):
+                if attempt > 1:
+                    if not retry_items:
+                        break
+                    items, retry_items = iter_items(retry_items), []
+                    await asyncio.sleep(SCRAP_RETRY_DELAY * 2 ** (attempt - 2))
+
+                async for result in iter_scrap_results(scrap_and_keep_transient_failures, items, queue_size):
+                    if isinstance(result, ScrapFailure):
+                        result = result._replace(attempt=attempt)
+                    yield result
 
 
 async def save_prices_to_db() -> None:
-    async for price in get_prices():
-        await write_prices_to_db(price)
+    # the writer flushes progress as it goes, so an interrupted run
+    # is resumed by the next one instead of starting over
+    METRICS.reset()
+    async with serve_metrics(METRICS_PORT, METRICS_HOST):
+        try:
+            async with PriceWriter() as writer:
+                async with connect_db_async() as connection:
+                    run_started_at = await start_scrap_run(connection)
+
+                async for result in get_prices(get_items_scrap_from_db(run_started_at)):
+                    await writer.write(result)
+        finally:
+            save_snapshot(METRICS_SNAPSHOT_PATH)
+
+    async with connect_db_async() as connection:
+        await finish_scrap_run(connection, run_started_at)
+        await prune_price_history(connection)
+        await prune_scrap_failures(connection)
 
 
 async def create_result_execel_sheet() -> None:
-    async with connect_async(DB_PATH) as connection:
-        shops = await select_shops_from_db(connection)
-        products = await select_products_from_db(connection)
-        product_items_for_result_sheet = await get_product_items_for_result_sheet(connection)
+    from openpyxl import Workbook
+    from excel_handlers import append_result_sheet_row, create_result_sheet_header
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
 
-    workbook = Workbook()
-    worksheet = workbook.active
+    async with connect_db_async() as connection:
+        shop_columns = create_result_sheet_header(
+            worksheet=worksheet,
+            shops=await select_shops_from_db(connection)
+        )
 
-    create_result_sheet_header(
-        worksheet=worksheet,
-        shops=shops,
-        products=products
-    )
+        row_items = []
+        async for item in get_product_items_for_result_sheet(connection):
+            if row_items and item.product_name != row_items[0].product_name:
+                append_result_sheet_row(worksheet, shop_columns, row_items)
+                row_items = []
+            row_items.append(item)
 
-    fill_result_sheet(
-        worksheet=worksheet,
-        product_items=product_items_for_result_sheet
-    )
+        if row_items:
+            append_result_sheet_row(worksheet, shop_columns, row_items)
 
     workbook.save(EXCEL_RESULT_PATH)
 
 
+async def export_prices(path: str, file_format: str = 'csv', layout: str = 'long') -> int:
+    if layout not in EXPORT_LAYOUTS:
+        raise ExportError(f'unknown export layout {layout!r}')
+
+    async with connect_db_async() as connection:
+        shops = await select_shops_from_db(connection)
+        batches = iter_result_sheet_rows(connection)
+        rows = iter_long_rows(batches) if layout == 'long' else iter_wide_rows(batches, shops)
+        return await export_rows(rows, path, file_format, get_columns(layout, shops))
+
 
 if __name__ == '__main__':
     add_new_products_for_monitoring(EXCEL_INPUT_PATH)
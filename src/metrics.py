@@ -0,0 +1,236 @@
+import json
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf')
+)
+
+
+def format_labels(label_names: tuple[str, ...], label_values: tuple, **extra) -> str:
+    labels = {**dict(zip(label_names, label_values)), **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values: dict[tuple, float] = defaultdict(float)
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] += amount
+
+    def reset(self) -> None:
+        self.values.clear()
+
+    def to_prometheus(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label_values, value in self.values.items():
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+    def snapshot(self) -> list[dict]:
+        return [
+            {**dict(zip(self.label_names, label_values)), 'value': value}
+            for label_values, value in self.values.items()
+        ]
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, *label_values) -> None:
+        if label_values not in self.counts:
+            self.counts[label_values] = [0] * len(self.buckets)
+        self.counts[label_values][bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def reset(self) -> None:
+        self.counts.clear()
+        self.sums.clear()
+
+    def get_quantile(self, quantile: float, *label_values) -> float | None:
+        # upper bound of the bucket that holds the quantile
+        if not (counts := self.counts.get(label_values)):
+            return None
+        rank = quantile * sum(counts)
+        seen = 0
+        for bucket, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bucket
+        return self.buckets[-1]
+
+    def to_prometheus(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, counts in self.counts.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                le = '+Inf' if bucket == float('inf') else bucket
+                labels = format_labels(self.label_names, label_values, le=le)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {self.sums[label_values]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+    def get_finite_quantile(self, quantile: float, *label_values) -> float | None:
+        # a quantile past the last finite bucket has no upper bound, json has no infinity for it
+        if (value := self.get_quantile(quantile, *label_values)) == float('inf'):
+            return None
+        return value
+
+    def snapshot(self) -> list[dict]:
+        return [
+            {
+                **dict(zip(self.label_names, label_values)),
+                'count': sum(counts),
+                'sum': self.sums[label_values],
+                'p50': self.get_finite_quantile(0.5, *label_values),
+                'p95': self.get_finite_quantile(0.95, *label_values),
+                'p99': self.get_finite_quantile(0.99, *label_values),
+            } for label_values, counts in self.counts.items()
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Counter | Histogram] = {}
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        self.metrics[name] = Counter(name, help, label_names)
+        return self.metrics[name]
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Histogram:
+        self.metrics[name] = Histogram(name, help, label_names)
+        return self.metrics[name]
+
+    def reset(self) -> None:
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def to_prometheus(self) -> str:
+        return '\n'.join(
+            line for metric in self.metrics.values() for line in metric.to_prometheus()
+        ) + '\n'
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+METRICS = MetricsRegistry()
+
+FETCH_SECONDS = METRICS.histogram(
+    'scrap_fetch_seconds', 'Duration of fetch phases: dns, connect, ttfb and body', ('shop', 'phase')
+)
+PARSE_SECONDS = METRICS.histogram('scrap_parse_seconds', 'Time to build the HTML tree', ('shop',))
+EXTRACT_SECONDS = METRICS.histogram('scrap_extract_seconds', 'Time to run the price selectors', ('shop',))
+DB_WRITE_SECONDS = METRICS.histogram('scrap_db_write_seconds', 'Time to flush a batch of results')
+
+RESPONSES = METRICS.counter('scrap_responses_total', 'HTTP responses by status', ('shop', 'status'))
+RESPONSE_BYTES = METRICS.counter('scrap_response_bytes_total', 'Bytes of product pages read', ('shop',))
+RETRIES = METRICS.counter('scrap_retries_total', 'Retried page requests', ('shop',))
+EXTRACTION_MISSES = METRICS.counter(
+    'scrap_extraction_misses_total', 'Pages without any price found by the selectors', ('shop',)
+)
+LISTING_PAGES = METRICS.counter('scrap_listing_pages_total', 'Listing pages by outcome', ('shop', 'outcome'))
+LISTING_HITS = METRICS.counter('scrap_listing_hits_total', 'Items priced from listing pages', ('shop',))
+ITEMS = METRICS.counter('scrap_items_total', 'Scraped items by outcome', ('shop', 'outcome'))
+DB_WRITES = METRICS.counter('scrap_db_written_rows_total', 'Results written to the database')
+
+
+def format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return '>30s'
+    return f'{seconds * 1000:.0f}ms'
+
+
+def format_summary() -> str:
+    shops = sorted({label_values[0] for label_values in ITEMS.values})
+    lines = ['Итоги парсинга:']
+
+    for shop in shops:
+        outcomes = ', '.join(
+            f'{label_values[1]} {value:.0f}'
+            for label_values, value in sorted(ITEMS.values.items()) if label_values[0] == shop
+        )
+        statuses = ', '.join(
+            f'{label_values[1]}: {value:.0f}'
+            for label_values, value in sorted(RESPONSES.values.items()) if label_values[0] == shop
+        )
+        lines.append(f'- {shop}: {outcomes}')
+        lines.append(
+            f'    HTTP {statuses or "-"}; retries {RETRIES.values[(shop,)]:.0f}; '
+            f'misses {EXTRACTION_MISSES.values[(shop,)]:.0f}; '
+            f'from listings {LISTING_HITS.values[(shop,)]:.0f}; '
+            f'{RESPONSE_BYTES.values[(shop,)] / 1024 / 1024:.1f} MB'
+        )
+        lines.append(
+            f'    ttfb p50 {format_seconds(FETCH_SECONDS.get_quantile(0.5, shop, "ttfb"))}'
+            f' p95 {format_seconds(FETCH_SECONDS.get_quantile(0.95, shop, "ttfb"))}; '
+            f'body p95 {format_seconds(FETCH_SECONDS.get_quantile(0.95, shop, "body"))}; '
+            f'parse p95 {format_seconds(PARSE_SECONDS.get_quantile(0.95, shop))}; '
+            f'extract p95 {format_seconds(EXTRACT_SECONDS.get_quantile(0.95, shop))}'
+        )
+
+    lines.append(
+        f'- DB: {DB_WRITES.values[()]:.0f} rows, '
+        f'flush p95 {format_seconds(DB_WRITE_SECONDS.get_quantile(0.95))}'
+    )
+    return '\n'.join(lines)
+
+
+def save_snapshot(path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as snapshot_file:
+        json.dump(METRICS.snapshot(), snapshot_file, ensure_ascii=False, indent=2, default=str)
+
+
+@asynccontextmanager
+async def serve_metrics(port: int, host: str = '127.0.0.1') -> AsyncIterator[None]:
+    if not port:
+        yield
+        return
+
+    # the server is optional, so aiohttp.web is only loaded when it is enabled
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=METRICS.to_prometheus(), content_type='text/plain')
+
+    async def handle_metrics_json(request: web.Request) -> web.Response:
+        return web.json_response(METRICS.snapshot(), dumps=lambda data: json.dumps(data, default=str))
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/metrics.json', handle_metrics_json)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        yield
+    finally:
+        await runner.cleanup()
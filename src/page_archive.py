@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import gzip
+import mmap
+import os
+import sqlite3
+import time
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import groupby
+from typing import Iterator
+
+from aiosqlite import (
+        Connection as ConnectionAsync,
+        connect as connect_async
+    )
+
+from data_types import ArchivedPage, ItemForScrap, ReplayedPrices, ShopName
+from config import (
+    PAGE_ARCHIVE_PATH,
+    PAGE_ARCHIVE_SEGMENT_SIZE,
+    DB_BUSY_TIMEOUT,
+    DB_WRITE_BATCH_SIZE,
+    PARSE_WORKERS,
+)
+
+
+INDEX_FILE_NAME = 'index.db'
+
+SEGMENT_SUFFIX = '.warc.gz'
+
+INDEX_PRAGMAS = (
+    'pragma journal_mode = wal;',
+    'pragma synchronous = normal;',
+)
+
+# where every record of the segments starts, the records of a run are found without reading the segments
+INDEX_SCHEMA = '''
+create table if not exists archived_page(
+    id integer primary key,
+    product_item_id integer not null,
+    shop_name text not null,
+    url text not null,
+    archived_at integer not null,
+    segment text not null,
+    offset integer not null,
+    length integer not null
+);
+create index if not exists archived_page_archived_at on archived_page(archived_at);
+'''
+
+INSERT_ARCHIVED_PAGE_QUERY = '''
+insert into archived_page(product_item_id, shop_name, url, archived_at, segment, offset, length)
+values (?, ?, ?, ?, ?, ?, ?);
+'''
+
+# read in the order of the segments, the latest page of an item also sets its current prices
+ARCHIVED_PAGES_QUERY = '''
+select
+    product_item_id,
+    shop_name,
+    archived_at,
+    segment,
+    offset,
+    length,
+    archived_at = max(archived_at) over (partition by product_item_id) as latest
+from archived_page
+where archived_at >= :since and (:shop_name is null or shop_name is :shop_name)
+order by segment, offset;
+'''
+
+REPLAY_CHUNK_SIZE = 200
+
+
+def make_record(scrap_item: ItemForScrap, archived_at: int, text: str) -> bytes:
+    # a warc resource record, every record is a gzip member of its own
+    # so it can be decompressed alone from its offset
+    body = text.encode('utf-8')
+    headers = (
+        'WARC/1.1\r\n'
+        'WARC-Type: resource\r\n'
+        f'WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>\r\n'
+        f'WARC-Date: {datetime.fromtimestamp(archived_at, timezone.utc):%Y-%m-%dT%H:%M:%SZ}\r\n'
+        f'WARC-Target-URI: {scrap_item.url}\r\n'
+        f'X-Product-Item-Id: {scrap_item.id}\r\n'
+        f'X-Shop-Name: {scrap_item.shop_name}\r\n'
+        'Content-Type: text/html; charset=utf-8\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        '\r\n'
+    )
+    return gzip.compress(headers.encode('utf-8') + body + b'\r\n\r\n', 6)
+
+
+def read_record(record: bytes) -> str:
+    block = gzip.decompress(record)
+    headers_end = block.index(b'\r\n\r\n') + 4
+    for line in block[:headers_end].split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            return block[headers_end:headers_end + int(line.split(b':', 1)[1])].decode('utf-8')
+    return block[headers_end:].decode('utf-8')
+
+
+class PageArchive:
+    def __init__(self, path: str = PAGE_ARCHIVE_PATH, segment_size: int = PAGE_ARCHIVE_SEGMENT_SIZE) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self._connection: ConnectionAsync | None = None
+        self._segment = None
+        self._segment_name: str | None = None
+        self._segment_length = 0
+        self._index_rows: list[tuple] = []
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self) -> 'PageArchive':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        self._connection = await connect_async(os.path.join(self.path, INDEX_FILE_NAME), timeout=DB_BUSY_TIMEOUT)
+        for pragma in INDEX_PRAGMAS:
+            await self._connection.execute(pragma)
+        await self._connection.executescript(INDEX_SCHEMA)
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self.flush()
+            await self._connection.close()
+            self._connection = None
+
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _open_segment(self) -> None:
+        # every process appends to segments of its own, the index is the only shared file
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_name = f'{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}'
+        self._segment = open(os.path.join(self.path, self._segment_name), 'ab')
+        self._segment_length = 0
+
+    async def put(self, scrap_item: ItemForScrap, text: str) -> None:
+        archived_at = int(time.time())
+        record = await asyncio.to_thread(make_record, scrap_item, archived_at, text)
+
+        async with self._lock:
+            if self._segment is None or self._segment_length + len(record) > self.segment_size:
+                await self._flush_index()
+                self._open_segment()
+
+            self._segment.write(record)
+            self._index_rows.append((
+                scrap_item.id, scrap_item.shop_name, scrap_item.url, archived_at,
+                self._segment_name, self._segment_length, len(record),
+            ))
+            self._segment_length += len(record)
+
+            if len(self._index_rows) >= DB_WRITE_BATCH_SIZE:
+                await self._flush_index()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush_index()
+
+    async def _flush_index(self) -> None:
+        if not self._index_rows:
+            return
+        # the index never points past what reached the segment
+        self._segment.flush()
+        rows, self._index_rows = self._index_rows, []
+        await self._connection.executemany(INSERT_ARCHIVED_PAGE_QUERY, rows)
+        await self._connection.commit()
+
+
+def clear_page_archive(path: str = PAGE_ARCHIVE_PATH) -> None:
+    # the archived pages belong to product item ids the replaced catalog gives out again
+    if not os.path.isdir(path):
+        return
+
+    connection = sqlite3.connect(os.path.join(path, INDEX_FILE_NAME), timeout=DB_BUSY_TIMEOUT)
+    try:
+        connection.executescript(INDEX_SCHEMA)
+        connection.execute('delete from archived_page;')
+        connection.commit()
+    finally:
+        connection.close()
+
+    for file_name in os.listdir(path):
+        if file_name.endswith(SEGMENT_SUFFIX):
+            os.remove(os.path.join(path, file_name))
+
+
+def iter_archived_pages(
+    path: str = PAGE_ARCHIVE_PATH,
+    since: int = 0,
+    shop_name: ShopName | None = None,
+) -> Iterator[ArchivedPage]:
+    connection = sqlite3.connect(os.path.join(path, INDEX_FILE_NAME), timeout=DB_BUSY_TIMEOUT)
+    try:
+        cursor = connection.execute(ARCHIVED_PAGES_QUERY, {'since': since, 'shop_name': shop_name})
+        while rows := cursor.fetchmany(DB_WRITE_BATCH_SIZE):
+            yield from (ArchivedPage._make(row) for row in rows)
+    finally:
+        connection.close()
+
+
+def iter_replay_chunks(pages: Iterator[ArchivedPage]) -> Iterator[list[ArchivedPage]]:
+    # a chunk holds the records of one segment, its process maps the segment once
+    for _, segment_pages in groupby(pages, key=lambda page: page.segment):
+        chunk = []
+        for page in segment_pages:
+            chunk.append(page)
+            if len(chunk) >= REPLAY_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def replay_chunk(path: str, pages: list[ArchivedPage]) -> list[ReplayedPrices]:
+    # parsers archives the pages it fetches, so it is imported where the pages are read back
+    from parsers import parse_prices
+
+    replayed = []
+    with open(os.path.join(path, pages[0].segment), 'rb') as segment:
+        with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as records:
+            for page in pages:
+                try:
+                    prices = parse_prices(
+                        read_record(records[page.offset:page.offset + page.length]), page.shop_name
+                    )
+                except Exception:
+                    prices = None
+                replayed.append(ReplayedPrices(
+                    id=page.product_item_id,
+                    archived_at=page.archived_at,
+                    latest=bool(page.latest),
+                    prices=prices,
+                ))
+    return replayed
+
+
+def iter_replayed_prices(
+    path: str = PAGE_ARCHIVE_PATH,
+    since: int = 0,
+    shop_name: ShopName | None = None,
+    processes: int = PARSE_WORKERS,
+) -> Iterator[ReplayedPrices]:
+    chunks = iter_replay_chunks(iter_archived_pages(path, since, shop_name))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # a bounded number of chunks is in flight, so the results are not all held at once
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(replay_chunk, path, chunk))
+            if len(pending) >= 2 * processes:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Extract the prices again from the archived product pages and save them'
+    )
+    parser.add_argument('--days', type=float, help='only the pages archived in the last days')
+    parser.add_argument('--shop', help='only the pages of the shop')
+    parser.add_argument('--processes', type=int, default=PARSE_WORKERS)
+    parser.add_argument('--dry-run', action='store_true', help='count the prices found without saving them')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from db_handlers import save_replayed_prices
+    from schema import connect_db
+
+    args = parse_args()
+    since = int(time.time() - args.days * 24 * 3600) if args.days else 0
+    started_at = time.perf_counter()
+    pages = found = 0
+
+    connection = connect_db()
+    try:
+        batch = []
+        for replayed in iter_replayed_prices(since=since, shop_name=args.shop, processes=args.processes):
+            pages += 1
+            if replayed.prices is None or replayed.prices == (None, None):
+                continue
+            found += 1
+            batch.append(replayed)
+            if len(batch) >= DB_WRITE_BATCH_SIZE and not args.dry_run:
+                save_replayed_prices(connection, batch)
+                batch = []
+
+        if batch and not args.dry_run:
+            save_replayed_prices(connection, batch)
+    finally:
+        connection.close()
+
+    print(f'Страниц из архива: {pages}, цены найдены на {found}, {time.perf_counter() - started_at:.1f} с')
@@ -0,0 +1,149 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import time
+
+from aiosqlite import (
+        Connection as ConnectionAsync,
+        connect as connect_async
+    )
+
+from data_types import CachedPage, ScrappedPrices
+from config import PAGE_CACHE_PATH, PAGE_CACHE_MAX_SIZE
+
+
+CACHE_PRAGMAS = (
+    'pragma journal_mode = wal;',
+    'pragma synchronous = off;',
+)
+
+
+def hash_page(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def dump_prices(prices: ScrappedPrices | None) -> str | None:
+    return json.dumps(prices) if prices is not None else None
+
+
+class PageCache:
+    def __init__(self, path: str = PAGE_CACHE_PATH, max_size: int = PAGE_CACHE_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+        self._size = 0
+        self._connection: ConnectionAsync | None = None
+
+    async def __aenter__(self) -> 'PageCache':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        self._connection = await connect_async(self.path)
+        for pragma in CACHE_PRAGMAS:
+            await self._connection.execute(pragma)
+
+        await self._connection.executescript('''
+create table if not exists page(
+    url text primary key,
+    etag text,
+    last_modified text,
+    body_hash text not null,
+    body blob not null,
+    size integer not null,
+    accessed_at real not null,
+    prices text
+);
+create index if not exists page_accessed_at on page(accessed_at);
+''')
+        # caches made before the prices were kept next to the pages get the column,
+        # their pages are parsed once more on the next hit
+        columns = {i[1] for i in await self._connection.execute_fetchall('pragma table_info(page);')}
+        if 'prices' not in columns:
+            await self._connection.execute('alter table page add column prices text;')
+        resp = await self._connection.execute_fetchall('select coalesce(sum(size), 0) from page;')
+        self._size = resp[0][0]
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._connection.commit()
+            await self._connection.close()
+            self._connection = None
+
+    async def get(self, url: str) -> CachedPage | None:
+        resp = await self._connection.execute_fetchall(
+            'select etag, last_modified, body_hash, prices from page where url is ?;',
+            (url,)
+        )
+        if not resp:
+            return None
+
+        await self._connection.execute(
+            'update page set accessed_at = ? where url is ?;',
+            (time.time(), url)
+        )
+        await self._connection.commit()
+        return CachedPage(
+            etag=resp[0][0],
+            last_modified=resp[0][1],
+            body_hash=resp[0][2],
+            prices=ScrappedPrices(*json.loads(resp[0][3])) if resp[0][3] is not None else None,
+        )
+
+    async def get_body(self, url: str) -> str | None:
+        resp = await self._connection.execute_fetchall(
+            'select body from page where url is ?;', (url,)
+        )
+        if not resp:
+            return None
+        return gzip.decompress(resp[0][0]).decode('utf-8')
+
+    async def put(
+        self,
+        url: str,
+        text: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        prices: ScrappedPrices | None = None,
+    ) -> None:
+        body = await asyncio.to_thread(gzip.compress, text.encode('utf-8'), 6)
+
+        resp = await self._connection.execute_fetchall(
+            'select size from page where url is ?;', (url,)
+        )
+        self._size -= resp[0][0] if resp else 0
+
+        await self._connection.execute('''
+insert or replace into page(url, etag, last_modified, body_hash, body, size, accessed_at, prices)
+values (?, ?, ?, ?, ?, ?, ?, ?);
+''', (url, etag, last_modified, hash_page(text), body, len(body), time.time(), dump_prices(prices))
+        )
+        self._size += len(body)
+
+        if self._size > self.max_size:
+            await self.evict()
+        await self._connection.commit()
+
+    async def set_prices(self, url: str, prices: ScrappedPrices) -> None:
+        await self._connection.execute(
+            'update page set prices = ? where url is ?;', (dump_prices(prices), url)
+        )
+        await self._connection.commit()
+
+    async def evict(self) -> None:
+        # drop least recently used pages until the cache is a tenth below its limit
+        target_size = self.max_size * 0.9
+        async with self._connection.execute(
+            'select url, size from page order by accessed_at;'
+        ) as cursor:
+            evicted = []
+            async for url, size in cursor:
+                if self._size <= target_size:
+                    break
+                evicted.append((url,))
+                self._size -= size
+
+        await self._connection.executemany('delete from page where url is ?;', evicted)
@@ -1,12 +1,50 @@
 import asyncio
+import time
 import aiohttp
 
-from bs4 import BeautifulSoup
-from aiohttp import ClientSession
-from fake_useragent import UserAgent
-
-from web_utils import get_html_page
-from data_types import ItemForScrap, PricesForSave, ScrappedPrices, ShopName
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from urllib.parse import urljoin
+
+from lxml import etree
+from aiohttp import ClientResponse, ClientSession
+
+from web_utils import (
+    ClientSessions,
+    HostRateLimiter,
+    PageFetchError,
+    RateLimiters,
+    fetch_page,
+    get_fetch_settings,
+    get_html_page,
+    UserAgentPool,
+    load_user_agents,
+    request_with_retries,
+)
+from page_cache import PageCache
+from page_archive import PageArchive
+from urls import canonicalize_url
+from metrics import (
+    EXTRACT_SECONDS,
+    EXTRACTION_MISSES,
+    FETCH_SECONDS,
+    LISTING_PAGES,
+    PARSE_SECONDS,
+    RESPONSE_BYTES,
+)
+from data_types import (
+    FetchSettings,
+    ItemForScrap,
+    ListingPage,
+    ListingPrice,
+    PricesForSave,
+    ScrapFailure,
+    ScrappedPrices,
+    ShopName,
+    UnchangedPrices,
+)
+from config import PARSE_WORKERS, PARSE_BACKLOG
 
 
 '''
@@ -15,8 +53,104 @@ css-168eikn   ->    css-1oh8fze   ->   css-17ctnp | css-1i90gmp + css-1bdwabt
 '''
 
 
-def find_span_by_class(soup, class_name: str):
-    return soup.find('span', class_=class_name)
+def has_class(tag: str, class_name: str) -> str:
+    # the plain substring test is cheap and rejects most elements
+    # before the exact class token comparison
+    return (
+        f"{tag}[contains(@class, '{class_name}')]"
+        f"[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+    )
+
+
+SHOP_SELECTORS: dict[ShopName, dict[str, str]] = {
+    'Amazon.ae': {
+        'basis_price': '//' + has_class('span', 'basisPrice'),
+        'sns_base_price': "//span[@id='sns-base-price']",
+        'price': '//' + has_class('span', 'a-price'),
+        'price_whole': '//' + has_class('span', 'a-price-whole'),
+        'color_price': '//' + has_class('span', 'a-color-price'),
+        'offscreen': './/' + has_class('span', 'a-offscreen'),
+    },
+    'Carrefour UAE': {
+        'price': '//' + has_class('h2', 'css-17ctnp'),
+        'discount_price': '//' + has_class('h2', 'css-1i90gmp'),
+    },
+    'DubaiStore': {
+        'price_box': '//' + has_class('h3', 'main-price'),
+        'price_old': './/' + has_class('span', 'price-old'),
+        'price_new': './/' + has_class('span', 'price-new'),
+    },
+}
+
+# only the first match of every selector is used,
+# so libxml2 can stop at it instead of collecting the whole node set
+SHOP_XPATHS: dict[ShopName, dict[str, etree.XPath]] = {
+    shop_name: {
+        name: etree.XPath(f'({selector})[1]') for name, selector in selectors.items()
+    } for shop_name, selectors in SHOP_SELECTORS.items()
+}
+
+# product tiles of category and search pages, the selectors after 'tile' run inside a tile
+SHOP_LISTING_SELECTORS: dict[ShopName, dict[str, str]] = {
+    'Amazon.ae': {
+        'tile': "//div[@data-component-type='s-search-result'][@data-asin]",
+        'price': './/' + has_class('span', 'a-price') + "[not(contains(@class, 'a-text-price'))]",
+        'basis_price': './/' + has_class('span', 'a-text-price'),
+        'offscreen': './/' + has_class('span', 'a-offscreen'),
+    },
+    'Carrefour UAE': {
+        'tile': "//div[@data-testid='product_card']",
+        'link': ".//a[contains(@href, '/p/')]",
+        'price': ".//*[@data-testid='product_card_selling_price']",
+        'original_price': ".//*[@data-testid='product_card_original_price']",
+    },
+    'DubaiStore': {
+        'tile': '//' + has_class('div', 'product-thumb'),
+        'link': './/' + has_class('div', 'caption') + '//a[@href]',
+        'price_box': './/' + has_class('p', 'price'),
+        'price_old': './/' + has_class('span', 'price-old'),
+        'price_new': './/' + has_class('span', 'price-new'),
+        'price_tax': './/' + has_class('span', 'price-tax'),
+    },
+}
+
+SHOP_LISTING_XPATHS: dict[ShopName, dict[str, etree.XPath]] = {
+    shop_name: {
+        # every tile of the page is wanted, not only the first one
+        name: etree.XPath(selector if name == 'tile' else f'({selector})[1]')
+        for name, selector in selectors.items()
+    } for shop_name, selectors in SHOP_LISTING_SELECTORS.items()
+}
+
+# elements that close the price block of a product page: once one of them
+# is parsed the extractor has everything it needs and the rest of the page is not read
+SHOP_STREAM_STOPS: dict[ShopName, tuple[tuple[str, str, str], ...]] = {
+    # the subscribe & save price of the buy box outranks the price of the center column
+    'Amazon.ae': (
+        ('div', 'id', 'rightCol'),
+    ),
+    'Carrefour UAE': (
+        ('h2', 'class', 'css-17ctnp'),
+        ('h2', 'class', 'css-1i90gmp'),
+    ),
+    'DubaiStore': (
+        ('h3', 'class', 'main-price'),
+    ),
+}
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+TEXT_XPATH = etree.XPath('.//text()[not(parent::script or parent::style)]')
+
+
+def find(xpaths: dict[str, etree.XPath], name: str, node: etree._Element) -> etree._Element | None:
+    if found := xpaths[name](node):
+        return found[0]
+    return None
+
+
+def get_text(element: etree._Element) -> str:
+    return ''.join(TEXT_XPATH(element))
 
 
 def form_prices(selling_price: str, net_price: str):
@@ -26,95 +160,444 @@ def form_prices(selling_price: str, net_price: str):
     )
 
 
-def get_prices_from_dubai_store_product_card(soup: BeautifulSoup):
-    if price_box := soup.find('h3', class_='main-price'):
-        if price_old := price_box.find('span', class_='price-old'):
-            price_old = 'AED' + ' ' + price_old.text[3:]
+def get_prices_from_dubai_store_product_card(page: etree._Element):
+    xpaths = SHOP_XPATHS['DubaiStore']
+
+    if (price_box := find(xpaths, 'price_box', page)) is not None:
+        if (price_old := find(xpaths, 'price_old', price_box)) is not None:
+            price_old = 'AED' + ' ' + get_text(price_old)[3:]
         else:
             price_old = None
 
-        if current_price := price_box.find('span', class_='price-new'):
-            current_price = 'AED' + ' ' + current_price.text[3:]
+        if (current_price := find(xpaths, 'price_new', price_box)) is not None:
+            current_price = 'AED' + ' ' + get_text(current_price)[3:]
         else:
             current_price = None
-        
+
         return form_prices(current_price, price_old)
 
     return form_prices(None, None)
 
 
+def get_prices_from_carrefour_product_card(page: etree._Element) -> ScrappedPrices:
+    xpaths = SHOP_XPATHS['Carrefour UAE']
 
+    if (price := find(xpaths, 'price', page)) is not None:
+        price_text = get_text(price)
+        if bracket_indx := price_text.find('('):
+            return form_prices(price_text[:bracket_indx].strip(), None)
+        return form_prices(price_text.strip(), None)
 
-def get_prices_from_carrefour_product_card(soup: BeautifulSoup) -> ScrappedPrices:
-    if price := soup.find('h2', class_='css-17ctnp'):
-        if bracket_indx := price.text.find('('):
-            return form_prices(price.text[:bracket_indx].strip(), None)
-        return form_prices(price.text.strip(), None)
-
-    if price := soup.find('h2', class_='css-1i90gmp'):
-        if bracket_indx := price.text.find('('):
-            row_price = price.text[:bracket_indx].strip()
+    if (price := find(xpaths, 'discount_price', page)) is not None:
+        price_text = get_text(price)
+        if bracket_indx := price_text.find('('):
+            row_price = price_text[:bracket_indx].strip()
             prices = row_price.split('AED')
             return form_prices('AED' + prices[1], 'AED' + prices[2])
-    
+
     return form_prices(None, None)
 
 
-def get_prices_from_amazon_product_card(soup: BeautifulSoup) -> ScrappedPrices:
-    if price := find_span_by_class(soup, 'basisPrice'):
-        row_net_price = price.find('span', class_='a-offscreen').text.strip()
+def get_prices_from_amazon_product_card(page: etree._Element) -> ScrappedPrices:
+    xpaths = SHOP_XPATHS['Amazon.ae']
+
+    if (price := find(xpaths, 'basis_price', page)) is not None:
+        row_net_price = get_text(find(xpaths, 'offscreen', price)).strip()
         net_price = row_net_price[:3] + ' ' + row_net_price[3:]
     else:
         net_price = None
 
-    if price := soup.find('span', id='sns-base-price'):
-        if bracket_indx := price.text.find('('):
-            return form_prices(price.text[:bracket_indx].strip(), net_price)
-        return form_prices(price.text.strip(), net_price)
+    if (price := find(xpaths, 'sns_base_price', page)) is not None:
+        price_text = get_text(price)
+        if bracket_indx := price_text.find('('):
+            return form_prices(price_text[:bracket_indx].strip(), net_price)
+        return form_prices(price_text.strip(), net_price)
 
-    if price := find_span_by_class(soup, 'a-price'):
-        row_price = price.find('span', class_='a-offscreen').text.strip()
+    if (price := find(xpaths, 'price', page)) is not None:
+        row_price = get_text(find(xpaths, 'offscreen', price)).strip()
         return form_prices(row_price[:3] + ' ' + row_price[3:], net_price)
 
-    if price_whole := find_span_by_class(soup, 'a-price-whole'):
-        price_fractions = tuple(i.text.strip()
-                                for i in price_whole.parent.findChildren())
+    if (price_whole := find(xpaths, 'price_whole', page)) is not None:
+        price_fractions = tuple(
+            get_text(i).strip()
+            for i in price_whole.getparent().iterdescendants(etree.Element)
+        )
         selling_price = f'{price_fractions[0]} {price_fractions[1].strip(".")}.{price_fractions[3]}'
         return form_prices(selling_price, net_price)
 
-    if price := find_span_by_class(soup, 'a-color-price'):
-        return form_prices(price.text.strip(), net_price)
+    if (price := find(xpaths, 'color_price', page)) is not None:
+        return form_prices(get_text(price).strip(), net_price)
 
     return form_prices(None, None)
 
 
-def get_prices_from_shop(soup: BeautifulSoup, shop_name: ShopName) -> ScrappedPrices:
+def get_prices_from_shop(page: etree._Element, shop_name: ShopName) -> ScrappedPrices:
     match shop_name:
         case 'Amazon.ae':
-            return get_prices_from_amazon_product_card(soup)
+            return get_prices_from_amazon_product_card(page)
         case 'Carrefour UAE':
-            return get_prices_from_carrefour_product_card(soup)
+            return get_prices_from_carrefour_product_card(page)
         case 'DubaiStore':
-            return get_prices_from_dubai_store_product_card(soup)
+            return get_prices_from_dubai_store_product_card(page)
         case _:
             pass
 
 
-async def get_prices_for_product_item(
+def add_currency_space(price_text: str | None) -> str | None:
+    # 'AED299.00' as the product cards give it
+    if price_text and price_text[:3].isalpha() and not price_text[3:4].isspace():
+        return price_text[:3] + ' ' + price_text[3:]
+    return price_text
+
+
+def form_listing_price(page_url: str, shop_name: ShopName, href: str | None, selling_price, net_price):
+    if not href or not selling_price:
+        return None
+    return ListingPrice(
+        url=canonicalize_url(shop_name, urljoin(page_url, href)),
+        selling_price=selling_price,
+        net_price=net_price,
+    )
+
+
+def get_prices_from_amazon_listing(page: etree._Element, page_url: str) -> list[ListingPrice]:
+    xpaths = SHOP_LISTING_XPATHS['Amazon.ae']
+    listing_prices = []
+
+    for tile in xpaths['tile'](page):
+        selling_price = net_price = None
+        if (price := find(xpaths, 'price', tile)) is not None:
+            selling_price = add_currency_space(get_text(find(xpaths, 'offscreen', price)).strip())
+        if (price := find(xpaths, 'basis_price', tile)) is not None:
+            net_price = add_currency_space(get_text(find(xpaths, 'offscreen', price)).strip())
+
+        # the asin of the tile is the whole canonical link
+        href = f'/dp/{asin}' if (asin := tile.get('data-asin')) else None
+        if listing_price := form_listing_price(page_url, 'Amazon.ae', href, selling_price, net_price):
+            listing_prices.append(listing_price)
+
+    return listing_prices
+
+
+def get_prices_from_carrefour_listing(page: etree._Element, page_url: str) -> list[ListingPrice]:
+    xpaths = SHOP_LISTING_XPATHS['Carrefour UAE']
+    listing_prices = []
+
+    for tile in xpaths['tile'](page):
+        if (link := find(xpaths, 'link', tile)) is None:
+            continue
+
+        selling_price = net_price = None
+        if (price := find(xpaths, 'price', tile)) is not None:
+            selling_price = add_currency_space(get_text(price).strip())
+        if (price := find(xpaths, 'original_price', tile)) is not None:
+            net_price = add_currency_space(get_text(price).strip())
+
+        if listing_price := form_listing_price(
+            page_url, 'Carrefour UAE', link.get('href'), selling_price, net_price
+        ):
+            listing_prices.append(listing_price)
+
+    return listing_prices
+
+
+def get_prices_from_dubai_store_listing(page: etree._Element, page_url: str) -> list[ListingPrice]:
+    xpaths = SHOP_LISTING_XPATHS['DubaiStore']
+    listing_prices = []
+
+    for tile in xpaths['tile'](page):
+        if (link := find(xpaths, 'link', tile)) is None:
+            continue
+        if (price_box := find(xpaths, 'price_box', tile)) is None:
+            continue
+
+        net_price = None
+        if (price_new := find(xpaths, 'price_new', price_box)) is not None:
+            selling_price = add_currency_space(get_text(price_new).strip())
+            if (price_old := find(xpaths, 'price_old', price_box)) is not None:
+                net_price = add_currency_space(get_text(price_old).strip())
+        else:
+            # a price without a discount is the text of the box, less its 'Ex Tax' line
+            price_tax = find(xpaths, 'price_tax', price_box)
+            price_text = get_text(price_box)
+            if price_tax is not None:
+                price_text = price_text.replace(get_text(price_tax), '')
+            selling_price = add_currency_space(price_text.strip())
+
+        if listing_price := form_listing_price(
+            page_url, 'DubaiStore', link.get('href'), selling_price, net_price
+        ):
+            listing_prices.append(listing_price)
+
+    return listing_prices
+
+
+def get_prices_from_listing(page: etree._Element, shop_name: ShopName, page_url: str) -> list[ListingPrice]:
+    match shop_name:
+        case 'Amazon.ae':
+            return get_prices_from_amazon_listing(page, page_url)
+        case 'Carrefour UAE':
+            return get_prices_from_carrefour_listing(page, page_url)
+        case 'DubaiStore':
+            return get_prices_from_dubai_store_listing(page, page_url)
+        case _:
+            return []
+
+
+def parse_html(html_page: str) -> etree._Element:
+    if (page := etree.HTML(html_page)) is None:
+        page = etree.Element('html')
+    return page
+
+
+def parse_prices(html_page: str, shop_name: ShopName) -> ScrappedPrices | None:
+    return get_prices_from_shop(parse_html(html_page), shop_name)
+
+
+def parse_prices_timed(html_page: str, shop_name: ShopName) -> tuple[ScrappedPrices | None, float, float]:
+    # the stages are timed where they run, the parse processes can not reach the metrics
+    started_at = time.perf_counter()
+    page = parse_html(html_page)
+    parsed_at = time.perf_counter()
+    prices = get_prices_from_shop(page, shop_name)
+    return prices, parsed_at - started_at, time.perf_counter() - parsed_at
+
+
+def parse_listing_prices(html_page: str, shop_name: ShopName, page_url: str) -> list[ListingPrice]:
+    return get_prices_from_listing(parse_html(html_page), shop_name, page_url)
+
+
+def observe_parse(shop_name: ShopName, parse_time: float, extract_time: float) -> None:
+    PARSE_SECONDS.observe(parse_time, shop_name)
+    EXTRACT_SECONDS.observe(extract_time, shop_name)
+
+
+def is_stop_element(element: etree._Element, stops: tuple[tuple[str, str, str], ...]) -> bool:
+    for tag, attribute, value in stops:
+        if element.tag != tag:
+            continue
+        if attribute == 'class' and value in (element.get('class') or '').split():
+            return True
+        if attribute != 'class' and element.get(attribute) == value:
+            return True
+    return False
+
+
+def make_pull_parser(charset: str | None) -> etree.HTMLPullParser:
+    # no tag filter here: with one the pull parser keeps every matched element alive
+    try:
+        return etree.HTMLPullParser(events=('end',), encoding=charset)
+    except LookupError:
+        # libxml2 falls back to the meta charset of the page
+        return etree.HTMLPullParser(events=('end',))
+
+
+async def read_prices_streaming(
+    resp: ClientResponse,
+    shop_name: ShopName,
+    max_bytes: int,
+) -> ScrappedPrices | None:
+    stops = SHOP_STREAM_STOPS.get(shop_name, ())
+    parser = make_pull_parser(resp.charset)
+    received = 0
+    parse_time = 0.0
+    body_started_at = time.perf_counter()
+
+    async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+        received += len(chunk)
+        fed_at = time.perf_counter()
+        parser.feed(chunk)
+        found = any(is_stop_element(element, stops) for _, element in parser.read_events())
+        parse_time += time.perf_counter() - fed_at
+
+        if found or received >= max_bytes:
+            # the rest of the body is dropped together with the connection
+            resp.close()
+            break
+
+    FETCH_SECONDS.observe(time.perf_counter() - body_started_at - parse_time, shop_name, 'body')
+    RESPONSE_BYTES.inc(shop_name, amount=received)
+
+    closed_at = time.perf_counter()
+    try:
+        page = parser.close()
+    except etree.XMLSyntaxError:
+        page = etree.Element('html')
+    parsed_at = time.perf_counter()
+    prices = get_prices_from_shop(page, shop_name)
+    observe_parse(shop_name, parse_time + parsed_at - closed_at, time.perf_counter() - parsed_at)
+    return prices
+
+
+async def fetch_prices_streaming(
     session: ClientSession,
     scrap_item: ItemForScrap,
-    user_agent: UserAgent
-) -> PricesForSave:
-    html_page = await get_html_page(session=session, url=scrap_item.url, user_agent=user_agent)
-    page_soup = BeautifulSoup(html_page, 'lxml')
+    user_agent: UserAgentPool,
+    settings: FetchSettings,
+    rate_limiter: HostRateLimiter | None = None,
+) -> ScrappedPrices | None:
+    return await request_with_retries(
+        session=session,
+        url=scrap_item.url,
+        user_agent=user_agent,
+        read_response=partial(
+            read_prices_streaming, shop_name=scrap_item.shop_name, max_bytes=settings.max_bytes
+        ),
+        settings=settings,
+        rate_limiter=rate_limiter,
+        shop_name=scrap_item.shop_name,
+    )
+
+
+class ParsePool:
+    def __init__(self, workers: int = PARSE_WORKERS, backlog: int = PARSE_BACKLOG) -> None:
+        self.workers = workers
+        self.backlog = backlog
+        self._executor: ProcessPoolExecutor | None = None
+        self._pending: asyncio.Semaphore | None = None
+
+    def __enter__(self) -> 'ParsePool':
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        # fetch workers wait here with their page instead of fetching new ones
+        # while the parsing processes are behind
+        self._pending = asyncio.Semaphore(self.backlog)
+        return self
 
-    if not (scrapped_prices := get_prices_from_shop(page_soup, scrap_item.shop_name)):
-        with open('./logs.txt', 'a', encoding='utf-8') as log_file:
-            log_file.write(f"{scrap_item.id}\n")
-        return
+    def __exit__(self, *exc_info) -> None:
+        self._executor.shutdown(cancel_futures=True)
 
+    async def parse(self, html_page: str, shop_name: ShopName) -> ScrappedPrices | None:
+        async with self._pending:
+            prices, parse_time, extract_time = await asyncio.get_running_loop().run_in_executor(
+                self._executor, parse_prices_timed, html_page, shop_name
+            )
+        observe_parse(shop_name, parse_time, extract_time)
+        return prices
+
+    async def parse_listing(self, html_page: str, shop_name: ShopName, page_url: str) -> list[ListingPrice]:
+        async with self._pending:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, parse_listing_prices, html_page, shop_name, page_url
+            )
 
 
+async def get_prices_for_product_item(
+    sessions: ClientSessions,
+    scrap_item: ItemForScrap,
+    user_agent: UserAgentPool,
+    rate_limiters: RateLimiters | None = None,
+    page_cache: PageCache | None = None,
+    parse_pool: ParsePool | None = None,
+    stream_pages: bool = False,
+    page_archive: PageArchive | None = None,
+) -> PricesForSave | UnchangedPrices | ScrapFailure:
+    settings = get_fetch_settings(scrap_item.shop_name)
+    session = sessions.for_shop(scrap_item.shop_name)
+    rate_limiter = rate_limiters.for_url(scrap_item.url, settings) if rate_limiters else None
+    page = None
+    try:
+        if stream_pages:
+            scrapped_prices = await fetch_prices_streaming(
+                session, scrap_item, user_agent, settings, rate_limiter
+            )
+        else:
+            page = await fetch_page(
+                session=session,
+                url=scrap_item.url,
+                user_agent=user_agent,
+                settings=settings,
+                rate_limiter=rate_limiter,
+                page_cache=page_cache,
+                shop_name=scrap_item.shop_name,
+            )
+    except PageFetchError as error:
+        return ScrapFailure(
+            id=scrap_item.id,
+            shop_name=scrap_item.shop_name,
+            stage='fetch',
+            reason=error.reason,
+            status=error.status,
+            received_bytes=error.received_bytes,
+            transient=error.transient,
+        )
+    except Exception as error:
+        # streamed pages are parsed while they download
+        if not stream_pages:
+            raise
+        return ScrapFailure(
+            id=scrap_item.id,
+            shop_name=scrap_item.shop_name,
+            stage='parse',
+            reason=repr(error),
+        )
+
+    # an unchanged page keeps the prices extracted when it was cached and is not parsed again;
+    # the writer saves them anyway if the run that cached the page ended before it did
+    if page and not page.modified and page.prices is not None:
+        if page.prices == (None, None):
+            EXTRACTION_MISSES.inc(scrap_item.shop_name)
+        return UnchangedPrices(
+            id=scrap_item.id,
+            selling_price=page.prices.selling_price,
+            net_price=page.prices.net_price,
+        )
+
+    # a 304 of a page cached without its prices leaves only the cached body to extract them from
+    if page and page.text is None:
+        if (cached_text := await page_cache.get_body(scrap_item.url)) is None:
+            return ScrapFailure(
+                id=scrap_item.id,
+                shop_name=scrap_item.shop_name,
+                stage='fetch',
+                reason='cached page evicted',
+                transient=True,
+            )
+        page = page._replace(text=cached_text)
+
+    # archived before the extraction, the pages it misses on are the ones replayed after a fix
+    if page and page.modified and page_archive:
+        await page_archive.put(scrap_item, page.text)
+
+    # a page the extractor trips over fails its item, not the run
+    try:
+        if page and parse_pool:
+            scrapped_prices = await parse_pool.parse(page.text, scrap_item.shop_name)
+        elif page:
+            scrapped_prices, parse_time, extract_time = parse_prices_timed(page.text, scrap_item.shop_name)
+            observe_parse(scrap_item.shop_name, parse_time, extract_time)
+    except Exception as error:
+        return ScrapFailure(
+            id=scrap_item.id,
+            shop_name=scrap_item.shop_name,
+            stage='parse',
+            reason=repr(error),
+            received_bytes=page.size,
+        )
+
+    if not scrapped_prices:
+        return ScrapFailure(
+            id=scrap_item.id,
+            shop_name=scrap_item.shop_name,
+            stage='extract',
+            reason='no extractor for the shop',
+            received_bytes=page.size if page else None,
+        )
+
+    if scrapped_prices == (None, None):
+        EXTRACTION_MISSES.inc(scrap_item.shop_name)
+
+    # the writer only skips the prices of an unchanged page when they are the saved ones
+    if page and not page.modified:
+        await page_cache.set_prices(scrap_item.url, scrapped_prices)
+        return UnchangedPrices(
+            id=scrap_item.id,
+            selling_price=scrapped_prices.selling_price,
+            net_price=scrapped_prices.net_price,
+        )
+
+    if page and page_cache:
+        await page_cache.put(scrap_item.url, page.text, page.etag, page.last_modified, scrapped_prices)
+
     return PricesForSave(
         id=scrap_item.id,
         selling_price=scrapped_prices.selling_price,
@@ -122,17 +605,62 @@ async def get_prices_for_product_item(
     )
 
 
+def load_listing_pages(path: str) -> list[ListingPage]:
+    try:
+        with open(path, encoding='utf-8') as listing_pages_file:
+            lines = listing_pages_file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+    listing_pages = []
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        shop_name, url = line.split('\t', 1)
+        listing_pages.append(ListingPage(shop_name=shop_name.strip(), url=url.strip()))
+    return listing_pages
+
+
+async def get_prices_from_listing_page(
+    sessions: ClientSessions,
+    listing_page: ListingPage,
+    user_agent: UserAgentPool,
+    rate_limiters: RateLimiters | None = None,
+    parse_pool: ParsePool | None = None,
+) -> list[ListingPrice]:
+    # a listing page that fails leaves its items to their product pages
+    settings = get_fetch_settings(listing_page.shop_name)
+    try:
+        page = await fetch_page(
+            session=sessions.for_shop(listing_page.shop_name),
+            url=listing_page.url,
+            user_agent=user_agent,
+            settings=settings,
+            rate_limiter=rate_limiters.for_url(listing_page.url, settings) if rate_limiters else None,
+            shop_name=listing_page.shop_name,
+        )
+        if parse_pool:
+            listing_prices = await parse_pool.parse_listing(page.text, listing_page.shop_name, listing_page.url)
+        else:
+            listing_prices = parse_listing_prices(page.text, listing_page.shop_name, listing_page.url)
+    except Exception:
+        LISTING_PAGES.inc(listing_page.shop_name, 'failed')
+        return []
+
+    LISTING_PAGES.inc(listing_page.shop_name, 'parsed' if listing_prices else 'empty')
+    return listing_prices
+
+
 if __name__ == "__main__":
     async def main():
-        ua = UserAgent()
+        ua = load_user_agents()
         async with aiohttp.ClientSession() as session:
             html_page = await get_html_page(
                 session=session,
                 url='https://www.carrefouruae.com/mafuae/en/root-maf-category/nonfood-navigation-category/electronics-appliances/tvs-projectors/receiver-satellite-accessories/xiaomi-mi-box-s-black-with-4k-hdr-android-tv-streaming-media-player-google-assistant-remote-official-international-version/p/6941059603283?offerCode=2383113',
                 user_agent=ua,
             )
-            page_soup = BeautifulSoup(html_page, 'lxml')
             print('Done!')
-            print(get_prices_from_carrefour_product_card(page_soup))
+            print(get_prices_from_carrefour_product_card(parse_html(html_page)))
     
     asyncio.run(main())
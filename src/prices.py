@@ -0,0 +1,119 @@
+import re
+
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
+from typing import Iterable
+
+from data_types import Price
+from config import DEFAULT_CURRENCY
+
+
+# arabic-indic and extended arabic-indic digits with the arabic decimal and thousands separators
+ARABIC_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹٫٬', '01234567890123456789.,')
+
+CURRENCY_ALIASES = {
+    'aed': 'AED',
+    'dhs': 'AED',
+    'dh': 'AED',
+    'د.إ': 'AED',
+    'درهم': 'AED',
+    'sar': 'SAR',
+    'ر.س': 'SAR',
+    'qar': 'QAR',
+    'kwd': 'KWD',
+    'bhd': 'BHD',
+    'omr': 'OMR',
+    'usd': 'USD',
+    '$': 'USD',
+    'eur': 'EUR',
+    '€': 'EUR',
+    'gbp': 'GBP',
+    '£': 'GBP',
+}
+
+# currencies with other than two digits after the point
+CURRENCY_MINOR_DIGITS = {
+    'KWD': 3,
+    'BHD': 3,
+    'OMR': 3,
+    'JPY': 0,
+}
+
+# longer aliases go first, so 'dhs' is not read as 'dh'
+CURRENCY_PATTERN = re.compile(
+    r'(?<![a-z])(?:'
+    + '|'.join(re.escape(alias) for alias in sorted(CURRENCY_ALIASES, key=len, reverse=True))
+    + r')(?![a-z])',
+    re.IGNORECASE,
+)
+
+# spaces are not taken as thousands separators, they part the numbers of '299.00 399.00',
+# only the no-break spaces put into numbers by formatting are
+NUMBER_PATTERN = re.compile(r'\d+(?:[.,\u00a0\u202f]\d+)*')
+
+
+def get_minor_digits(currency: str) -> int:
+    return CURRENCY_MINOR_DIGITS.get(currency, 2)
+
+
+def to_decimal_text(number: str, minor_digits: int) -> str:
+    number = number.replace('\u00a0', '').replace('\u202f', '')
+    separator_at = max(number.rfind('.'), number.rfind(','))
+    if separator_at < 0:
+        return number
+
+    separator = number[separator_at]
+    other_separator = ',' if separator == '.' else '.'
+    fraction = number[separator_at + 1:]
+
+    # the only kind of separator groups thousands when it repeats or when three digits
+    # follow it in a currency with two digits after the point: '1,299', '1.299.000'
+    if other_separator not in number and not number.startswith('0') and (
+        number.count(separator) > 1 or (len(fraction) == 3 and minor_digits != 3)
+    ):
+        return number.replace(separator, '')
+
+    return number[:separator_at].replace('.', '').replace(',', '') + '.' + fraction
+
+
+@lru_cache(maxsize=65536)
+def parse_price(text: str | None, default_currency: str = DEFAULT_CURRENCY) -> Price | None:
+    # the same few price texts repeat across items, so they are parsed once
+    if not text:
+        return None
+
+    text = text.translate(ARABIC_DIGITS)
+    if (number := NUMBER_PATTERN.search(text)) is None:
+        return None
+
+    # a range like 'AED 10 - 25' gives its lower bound, the price the item starts at
+    currency = default_currency
+    if (alias := CURRENCY_PATTERN.search(text)) is not None:
+        currency = CURRENCY_ALIASES[alias.group().lower()]
+
+    minor_digits = get_minor_digits(currency)
+    try:
+        amount = Decimal(to_decimal_text(number.group(), minor_digits))
+    except InvalidOperation:
+        return None
+
+    return Price(
+        amount=int(amount.scaleb(minor_digits).to_integral_value(ROUND_HALF_UP)),
+        currency=currency,
+    )
+
+
+def normalize_prices(texts: Iterable[str | None]) -> list[Price | None]:
+    return [parse_price(text) for text in texts]
+
+
+def get_amount(text: str | None) -> int | None:
+    return price.amount if (price := parse_price(text)) is not None else None
+
+
+def get_currency(text: str | None) -> str | None:
+    return price.currency if (price := parse_price(text)) is not None else None
+
+
+def to_major_units(amount: int, currency: str) -> float:
+    return amount / 10 ** get_minor_digits(currency)
@@ -0,0 +1,294 @@
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterator
+from sqlite3 import Connection, complete_statement, connect
+
+from aiosqlite import (
+        Connection as ConnectionAsync,
+        connect as connect_async
+    )
+
+from prices import get_amount, get_currency
+from urls import canonicalize_url
+from config import DB_PATH, DB_BUSY_TIMEOUT, DB_CACHE_SIZE, DB_MMAP_SIZE
+
+
+# set on every connection, journal_mode is kept by the database file
+# but the others only last as long as the connection
+CONNECTION_PRAGMAS = (
+    'pragma journal_mode = wal;',
+    'pragma synchronous = normal;',
+    f'pragma cache_size = -{DB_CACHE_SIZE};',
+    f'pragma mmap_size = {DB_MMAP_SIZE};',
+    'pragma temp_store = memory;',
+)
+
+# the tables the database was first shipped with
+BASE_SCHEMA = '''
+create table if not exists shop(id integer primary key, name text not null unique);
+create table if not exists product(id integer primary key, name text not null unique);
+create table if not exists product_item(id integer primary key, product_id integer,
+shop_id integer, url text, selling_price text, net_price text,
+foreign key (shop_id) references shop (id) on delete cascade,
+foreign key (product_id) references product (id) on delete cascade);
+'''
+
+# earlier appends could store the same product twice for one shop,
+# only the latest of such rows is kept before the index is created
+PRODUCT_ITEM_INDEX_SCHEMA = '''
+delete from product_item
+where id not in (
+    select max(id) from product_item group by product_id, shop_id
+);
+create unique index if not exists product_item_product_shop on product_item(product_id, shop_id);
+'''
+
+SCRAP_STATE_COLUMNS = {
+    'last_scraped_at': 'integer',
+    'last_changed_at': 'integer',
+    'failure_count': 'integer not null default 0',
+}
+
+# prices are kept as integer minor units (fils) and times as unix seconds,
+# the primary key doubles as the covering index for per-item lookups
+PRICE_HISTORY_SCHEMA = '''
+create table if not exists price_observation(
+    product_item_id integer not null,
+    scraped_at integer not null,
+    selling_price integer,
+    net_price integer,
+    primary key (product_item_id, scraped_at)
+) without rowid;
+create index if not exists price_observation_scraped_at on price_observation(scraped_at);
+'''
+
+SCRAP_RUN_SCHEMA = '''
+create table if not exists scrap_run(
+    id integer primary key,
+    started_at integer not null,
+    finished_at integer
+);
+'''
+
+# a job is owned by the worker holding an unexpired lease on it,
+# expired jobs are claimed again by any worker
+SCRAP_JOB_SCHEMA = '''
+create table if not exists scrap_job(
+    product_item_id integer primary key,
+    priority integer not null,
+    attempts integer not null default 0,
+    lease_owner text,
+    lease_expires_at real
+);
+create index if not exists scrap_job_priority on scrap_job(priority, product_item_id);
+create index if not exists scrap_job_lease_owner on scrap_job(lease_owner);
+'''
+
+# the price texts of the shop pages stay for display,
+# the amounts in minor units with their currency are what gets compared and summed
+PRICE_COLUMNS = {
+    'selling_price_minor': 'integer',
+    'net_price_minor': 'integer',
+    'currency': 'text',
+}
+
+# fills the amounts of the prices stored before the columns existed in one statement
+BACKFILL_PRICES_QUERY = '''
+update product_item
+set
+    selling_price_minor = price_amount(selling_price),
+    net_price_minor = price_amount(net_price),
+    currency = price_currency(coalesce(selling_price, net_price))
+where selling_price is not null or net_price is not null;
+'''
+
+# every claim drops the jobs that ran out of attempts
+SCRAP_JOB_ATTEMPTS_SCHEMA = '''
+create index if not exists scrap_job_attempts on scrap_job(attempts);
+'''
+
+# one row per failed attempt to scrape an item, kept for SCRAP_FAILURE_RETENTION
+SCRAP_FAILURE_SCHEMA = '''
+create table if not exists scrap_failure(
+    id integer primary key,
+    product_item_id integer not null,
+    shop_name text not null,
+    failed_at integer not null,
+    stage text not null,
+    reason text not null,
+    status integer,
+    received_bytes integer,
+    attempt integer not null default 1
+);
+create index if not exists scrap_failure_product_item on scrap_failure(product_item_id, failed_at);
+create index if not exists scrap_failure_failed_at on scrap_failure(failed_at);
+'''
+
+# links that differ only in tracking parameters share their canonical url
+CANONICAL_URL_SCHEMA = '''
+create index if not exists product_item_canonical_url on product_item(canonical_url);
+'''
+
+BACKFILL_CANONICAL_URLS_QUERY = '''
+update product_item
+set canonical_url = canonical_url((select name from shop where shop.id = product_item.shop_id), url)
+where url is not null;
+'''
+
+
+# the due items of a shop are read in the order of their priority straight from this index,
+# a desc column keeps the items never changed after the changed ones
+DUE_ORDER_SCHEMA = '''
+create index if not exists product_item_due on product_item(shop_id, last_scraped_at is not null, last_changed_at desc);
+'''
+
+# the due items are read in batches, each batch seeks on one of these indexes from the row
+# the previous batch stopped at, so no read stays open while the run writes its results
+DUE_KEYSET_SCHEMA = '''
+drop index if exists product_item_due;
+create index if not exists product_item_last_scraped_at on product_item(last_scraped_at);
+create index if not exists product_item_last_changed_at on product_item(last_changed_at);
+'''
+
+
+def add_columns(table: str, columns: dict[str, str]) -> Callable[[Connection], None]:
+    # databases made before the migrations got some of these columns without a version
+    def migrate(connection: Connection) -> None:
+        existing = {i[1] for i in connection.execute(f'pragma table_info({table});')}
+        for column, column_type in columns.items():
+            if column not in existing:
+                connection.execute(f'alter table {table} add column {column} {column_type};')
+
+    return migrate
+
+
+def iter_statements(script: str) -> Iterator[str]:
+    # executescript commits first, so the statements of a migration
+    # are run one by one to keep them in its transaction
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if complete_statement(statement):
+            yield statement
+            statement = ''
+
+
+def backfill_canonical_urls(connection: Connection) -> None:
+    connection.create_function('canonical_url', 2, canonicalize_url, deterministic=True)
+    connection.execute(BACKFILL_CANONICAL_URLS_QUERY)
+
+
+def backfill_prices(connection: Connection) -> None:
+    connection.create_function('price_amount', 1, get_amount, deterministic=True)
+    connection.create_function('price_currency', 1, get_currency, deterministic=True)
+    connection.execute(BACKFILL_PRICES_QUERY)
+
+
+# the version of a database is its pragma user_version, the number of migrations applied to it;
+# migrations are only ever appended
+MIGRATIONS: tuple[tuple[str | Callable[[Connection], None], ...], ...] = (
+    (BASE_SCHEMA,),
+    (PRODUCT_ITEM_INDEX_SCHEMA,),
+    (add_columns('product_item', SCRAP_STATE_COLUMNS), PRICE_HISTORY_SCHEMA, SCRAP_RUN_SCHEMA, SCRAP_JOB_SCHEMA),
+    (add_columns('product_item', PRICE_COLUMNS), backfill_prices),
+    (SCRAP_JOB_ATTEMPTS_SCHEMA,),
+    (SCRAP_FAILURE_SCHEMA,),
+    (add_columns('product_item', {'canonical_url': 'text'}), backfill_canonical_urls, CANONICAL_URL_SCHEMA),
+    (DUE_ORDER_SCHEMA,),
+    (DUE_KEYSET_SCHEMA,),
+    # amazon links keep the seller of their offer in the canonical url
+    (backfill_canonical_urls,),
+    (add_columns('scrap_run', {'downsampled_before': 'integer'}),),
+)
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+_migrated_paths: set[str] = set()
+
+
+def get_schema_version(connection: Connection) -> int:
+    return connection.execute('pragma user_version;').fetchone()[0]
+
+
+def migrate(connection: Connection) -> int:
+    # begin immediate keeps two processes from applying the same migration,
+    # the second one finds the version already raised
+    connection.execute('begin immediate;')
+    try:
+        version = get_schema_version(connection)
+        for version, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+            for step in steps:
+                if isinstance(step, str):
+                    for statement in iter_statements(step):
+                        connection.execute(statement)
+                else:
+                    step(connection)
+            connection.execute(f'pragma user_version = {version};')
+    except BaseException:
+        connection.execute('rollback;')
+        raise
+
+    connection.execute('commit;')
+    return version
+
+
+def migrate_db(path: str = DB_PATH) -> None:
+    if path in _migrated_paths:
+        return
+
+    connection = connect(path, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
+    try:
+        connection.execute(CONNECTION_PRAGMAS[0])
+        migrate(connection)
+    finally:
+        connection.close()
+    _migrated_paths.add(path)
+
+
+def connect_db(path: str = DB_PATH) -> Connection:
+    migrate_db(path)
+    connection = connect(path, timeout=DB_BUSY_TIMEOUT)
+    for pragma in CONNECTION_PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+
+async def open_db_async(path: str = DB_PATH) -> ConnectionAsync:
+    # the migrations run once per process, before the first connection is handed out
+    if path not in _migrated_paths:
+        await asyncio.to_thread(migrate_db, path)
+
+    connection = await connect_async(path, timeout=DB_BUSY_TIMEOUT)
+    for pragma in CONNECTION_PRAGMAS:
+        await connection.execute(pragma)
+    return connection
+
+
+@asynccontextmanager
+async def connect_db_async(path: str = DB_PATH) -> AsyncIterator[ConnectionAsync]:
+    connection = await open_db_async(path)
+    try:
+        yield connection
+    finally:
+        await connection.close()
+
+
+def find_full_scans(
+    connection: Connection,
+    query: str,
+    params: tuple | dict = (),
+    allowed_scans: tuple[str, ...] = (),
+) -> list[str]:
+    # a scan step of explain query plan reads the whole table or index,
+    # scans of table valued functions and subquery results are not table reads
+    plan = connection.execute('explain query plan ' + query, params).fetchall()
+    full_scans = []
+    for *_, detail in plan:
+        if not detail.startswith('SCAN ') or 'VIRTUAL TABLE' in detail:
+            continue
+        table = detail.split()[1]
+        if table.startswith('(') or table == 'CONSTANT' or table in allowed_scans:
+            continue
+        full_scans.append(detail)
+    return full_scans
@@ -1,31 +1,25 @@
-import asyncio
-
-from main_funcs import (
-    add_new_products_for_monitoring,
-    save_prices_to_db,
-    create_result_execel_sheet,
-)
-
-from config import ROOT_DIR
+from config import ROOT_DIR, EXPORT_PATH
 
 
 def print_menu():
     print('Выберите действие:')
     print('1. добавить товары для мониторинга цен')
     print('2. спарсить актуальные цены')
-    print('3. создать excel c ценами\n')
+    print('3. создать excel c ценами')
+    print('4. выгрузить цены в csv, jsonl, parquet или arrow\n')
 
 
 def get_action():
     print_menu()
     action = input('Введите номер действия: ')
 
-    if action not in ('1', '2', '3'):
+    if action not in ('1', '2', '3', '4'):
         get_action()
 
     return int(action)
 
 
+# the actions import their modules when chosen, so the menu shows up right away
 def execute_action():
         action = get_action()
 
@@ -37,18 +31,39 @@ def execute_action():
                     path = ROOT_DIR + 'src/assets/test_product_links.xlsx'
                 print(path)
                 mode = input('Если нужно удалить уже существующие товары, введите "r": ')
+                from main_funcs import add_new_products_for_monitoring
                 add_new_products_for_monitoring(path, mode)
 
             case 2:
                 print("Парсинг начат")
+                import asyncio
+                from main_funcs import save_prices_to_db
+                from metrics import format_summary
                 asyncio.run(save_prices_to_db())
+                print(format_summary())
                 print('Данные сохранены\n')
 
             case 3:
                 print('Файл создается')
+                import asyncio
+                from main_funcs import create_result_execel_sheet
                 asyncio.run(create_result_execel_sheet())
                 print('Файл готов\n')
 
+            case 4:
+                file_format = input('Формат (csv, jsonl, parquet, arrow), по умолчанию csv: ') or 'csv'
+                layout = input('Строка на товар в магазине (long) или на товар (wide), по умолчанию long: ') or 'long'
+                path = input('Укажите путь к файлу: ') or f'{EXPORT_PATH}_{layout}.{file_format}'
+                import asyncio
+                from main_funcs import export_prices
+                from exporters import ExportError
+                try:
+                    rows = asyncio.run(export_prices(path, file_format, layout))
+                except ExportError as error:
+                    print(f'Ошибка: {error}\n')
+                else:
+                    print(f'Выгружено строк: {rows}, файл {path}\n')
+
             case _:
                 pass 
 
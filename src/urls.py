@@ -0,0 +1,81 @@
+import re
+
+from typing import Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit, SplitResult
+
+from data_types import ShopName
+
+
+# query parameters that only tell the shop where the visitor came from
+TRACKING_PARAMS = frozenset((
+    'ref', 'ref_', 'tag', 'linkcode', 'psc', 'th', 'qid', 'sr', 'crid', 'keywords', 'sprefix',
+    'coliid', 'colid', 'language', 'offercode', 'list_name', 'ln', 'o', 'gclid', 'fbclid',
+))
+
+TRACKING_PARAM_PREFIXES = ('utm_', 'pd_rd_', 'hv', 'pf_rd_')
+
+AMAZON_ASIN_PATTERN = re.compile(r'/(?:dp|gp/product|gp/aw/d)/([A-Z0-9]{10})(?:[/?]|$)', re.IGNORECASE)
+
+# the seller whose offer the page shows, links to two sellers of one ASIN are two prices
+AMAZON_OFFER_PARAMS = frozenset(('smid',))
+
+
+def is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def canonicalize_query(query: str) -> str:
+    return urlencode(sorted(
+        (name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+        if not is_tracking_param(name)
+    ))
+
+
+def canonicalize_generic_url(parts: SplitResult) -> str:
+    # the scheme and host are case insensitive, the fragment never reaches the shop
+    return urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path or '/',
+        canonicalize_query(parts.query),
+        '',
+    ))
+
+
+def canonicalize_amazon_url(parts: SplitResult) -> str:
+    # the slug and the /ref= path segments are decoration, the product is its ASIN
+    # and the offer parameters
+    if asin := AMAZON_ASIN_PATTERN.search(parts.path):
+        query = urlencode(sorted(
+            (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+            if name.lower() in AMAZON_OFFER_PARAMS
+        ))
+        return urlunsplit(('https', parts.netloc.lower(), f'/dp/{asin.group(1).upper()}', query, ''))
+    return canonicalize_generic_url(parts)
+
+
+def canonicalize_path_url(parts: SplitResult) -> str:
+    # the product page is the path alone, every query parameter is for analytics
+    return canonicalize_generic_url(parts._replace(query=''))
+
+
+SHOP_URL_CANONICALIZERS: dict[ShopName, Callable[[SplitResult], str]] = {
+    'Amazon.ae': canonicalize_amazon_url,
+    'Carrefour UAE': canonicalize_path_url,
+    'DubaiStore': canonicalize_path_url,
+}
+
+
+def canonicalize_url(shop_name: ShopName | None, url: str | None) -> str | None:
+    if not url:
+        return None
+
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url
+
+    if not parts.scheme or not parts.netloc:
+        return url
+    return SHOP_URL_CANONICALIZERS.get(shop_name, canonicalize_generic_url)(parts)
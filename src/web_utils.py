@@ -1,11 +1,407 @@
-from aiohttp import ClientSession
-from fake_useragent import UserAgent
+import asyncio
+import random
+import time
 
+from contextlib import asynccontextmanager
+from functools import cache
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+from urllib.parse import urlsplit
 
-async def get_html_page(session: ClientSession, url: str, user_agent: UserAgent, headers: dict = {}) -> str:
-    async with session.get(
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from aiohttp.compression_utils import HAS_BROTLI
+
+from data_types import CachedPage, ClientProfile, FetchedPage, FetchSettings, ShopName
+from page_cache import PageCache, hash_page
+from metrics import FETCH_SECONDS, RESPONSE_BYTES, RESPONSES, RETRIES
+from config import (
+    DEFAULT_CLIENT_PROFILE,
+    DEFAULT_FETCH_SETTINGS,
+    SHOP_CLIENT_PROFILES,
+    SHOP_FETCH_SETTINGS,
+    USER_AGENTS_PATH,
+)
+
+
+T = TypeVar('T')
+
+THROTTLE_STATUSES = frozenset((429, 503))
+
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+# several in-flight requests usually get throttled together,
+# so they should count as one congestion signal
+DECREASE_COOLDOWN = 1.0
+
+# brotli is only offered when a decoder for it is installed
+ACCEPT_ENCODING = 'gzip, deflate, br' if HAS_BROTLI else 'gzip, deflate'
+
+
+class UserAgentPool:
+    def __init__(self, user_agents: tuple[str, ...]) -> None:
+        self.user_agents = user_agents
+
+    @property
+    def random(self) -> str:
+        return random.choice(self.user_agents)
+
+
+# the list is bundled with the app, so scraping never waits for a user agent download
+@cache
+def load_user_agents(path: str = USER_AGENTS_PATH) -> UserAgentPool:
+    with open(path, encoding='utf-8') as user_agents_file:
+        return UserAgentPool(tuple(
+            line.strip() for line in user_agents_file if line.strip() and not line.startswith('#')
+        ))
+
+
+class PageFetchError(Exception):
+    def __init__(
+        self,
+        url: str,
+        reason: str,
+        status: int | None = None,
+        transient: bool = False,
+        received_bytes: int | None = None,
+    ) -> None:
+        super().__init__(f'{url}: {reason}')
+        self.url = url
+        self.reason = reason
+        self.status = status
+        # a transient error may pass if the page is requested again later
+        self.transient = transient
+        self.received_bytes = received_bytes
+
+
+def get_fetch_settings(shop_name: ShopName | None) -> FetchSettings:
+    return SHOP_FETCH_SETTINGS.get(shop_name, DEFAULT_FETCH_SETTINGS)
+
+
+def make_trace_config() -> TraceConfig:
+    # shop names reach the trace through trace_request_ctx of every request
+    trace_config = TraceConfig()
+
+    def get_shop(trace_config_ctx) -> str:
+        return (trace_config_ctx.trace_request_ctx or {}).get('shop_name', '')
+
+    async def on_request_start(session, trace_config_ctx, params):
+        trace_config_ctx.request_started_at = time.perf_counter()
+
+    async def on_dns_resolvehost_start(session, trace_config_ctx, params):
+        trace_config_ctx.dns_started_at = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, trace_config_ctx, params):
+        FETCH_SECONDS.observe(
+            time.perf_counter() - trace_config_ctx.dns_started_at, get_shop(trace_config_ctx), 'dns'
+        )
+
+    async def on_connection_create_start(session, trace_config_ctx, params):
+        trace_config_ctx.connect_started_at = time.perf_counter()
+
+    async def on_connection_create_end(session, trace_config_ctx, params):
+        FETCH_SECONDS.observe(
+            time.perf_counter() - trace_config_ctx.connect_started_at, get_shop(trace_config_ctx), 'connect'
+        )
+
+    async def on_request_end(session, trace_config_ctx, params):
+        FETCH_SECONDS.observe(
+            time.perf_counter() - trace_config_ctx.request_started_at, get_shop(trace_config_ctx), 'ttfb'
+        )
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def get_client_profile(shop_name: ShopName | None) -> ClientProfile:
+    return SHOP_CLIENT_PROFILES.get(shop_name, DEFAULT_CLIENT_PROFILE)
+
+
+# one session with its own connection pool per shop, kept open for the whole run
+# so that connections and resolved addresses are reused between product pages
+class ClientSessions:
+    def __init__(self, trace_configs: list[TraceConfig] | None = None) -> None:
+        self.trace_configs = trace_configs or []
+        self._sessions: dict[ShopName | None, ClientSession] = {}
+
+    async def __aenter__(self) -> 'ClientSessions':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def for_shop(self, shop_name: ShopName | None) -> ClientSession:
+        key = shop_name if shop_name in SHOP_CLIENT_PROFILES else None
+        if key not in self._sessions:
+            profile = get_client_profile(key)
+            self._sessions[key] = ClientSession(
+                connector=TCPConnector(
+                    limit=profile.limit,
+                    limit_per_host=profile.limit_per_host,
+                    keepalive_timeout=profile.keepalive_timeout,
+                    ttl_dns_cache=profile.ttl_dns_cache,
+                ),
+                headers={'accept-encoding': ACCEPT_ENCODING, **profile.headers},
+                trace_configs=self.trace_configs,
+            )
+        return self._sessions[key]
+
+    async def close(self) -> None:
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+# token bucket for the request rate plus an AIMD window for requests in flight:
+# both grow additively while the host answers and are halved on throttling
+class HostRateLimiter:
+    def __init__(self, settings: FetchSettings) -> None:
+        self.settings = settings
+        self.rate = settings.rate
+        self.concurrency = float(settings.concurrency)
+        self._tokens = float(settings.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._in_flight < int(self.concurrency)
+            )
+            self._in_flight += 1
+
+        try:
+            await self._take_token()
+            yield
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    async def _take_token(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._tokens = min(
+                self.settings.burst,
+                self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.concurrency = min(
+            self.settings.max_concurrency,
+            self.concurrency + 1 / self.concurrency
+        )
+        self.rate = min(
+            self.settings.max_rate,
+            self.rate + self.settings.min_rate / self.rate
+        )
+
+    def on_throttle(self, retry_after: float | None = None) -> None:
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+
+        self.rate = max(self.settings.min_rate, self.rate / 2)
+        self.concurrency = max(1.0, self.concurrency / 2)
+
+
+class RateLimiters:
+    def __init__(self) -> None:
+        self._limiters: dict[str, HostRateLimiter] = {}
+
+    def for_url(self, url: str, settings: FetchSettings) -> HostRateLimiter:
+        host = urlsplit(url).hostname or ''
+        if host not in self._limiters:
+            self._limiters[host] = HostRateLimiter(settings)
+        return self._limiters[host]
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if value and value.strip().isdigit():
+        return float(value.strip())
+    return None
+
+
+def get_backoff_delay(settings: FetchSettings, attempt: int) -> float:
+    return random.uniform(
+        0, min(settings.backoff_max, settings.backoff_base * 2 ** attempt)
+    )
+
+
+def decode_page(body: bytes, charset: str | None) -> str:
+    try:
+        return body.decode(charset or 'utf-8')
+    except (LookupError, UnicodeDecodeError):
+        return body.decode('utf-8', errors='replace')
+
+
+def get_conditional_headers(cached_page: CachedPage | None) -> dict:
+    headers = {}
+    if cached_page and cached_page.etag:
+        headers['if-none-match'] = cached_page.etag
+    if cached_page and cached_page.last_modified:
+        headers['if-modified-since'] = cached_page.last_modified
+    return headers
+
+
+@asynccontextmanager
+async def no_rate_limit() -> AsyncIterator[None]:
+    yield
+
+
+async def request_with_retries(
+    session: ClientSession,
+    url: str,
+    user_agent: UserAgentPool,
+    read_response: Callable[[ClientResponse], Awaitable[T]],
+    headers: dict = {},
+    settings: FetchSettings = DEFAULT_FETCH_SETTINGS,
+    rate_limiter: HostRateLimiter | None = None,
+    shop_name: ShopName | None = None,
+) -> T:
+    deadline = time.monotonic() + settings.deadline
+    timeout = ClientTimeout(total=settings.timeout)
+
+    for attempt in range(settings.retries + 1):
+        retry_after = None
+
+        async with rate_limiter.slot() if rate_limiter else no_rate_limit():
+            try:
+                async with session.get(
+                    url=url,
+                    timeout=timeout,
+                    headers={'user-agent': user_agent.random, **headers},
+                    trace_request_ctx={'shop_name': shop_name},
+                ) as resp:
+                    RESPONSES.inc(shop_name, str(resp.status))
+                    if resp.status < 400:
+                        result = await read_response(resp)
+                        if rate_limiter:
+                            rate_limiter.on_success()
+                        return result
+
+                    error = PageFetchError(
+                        url,
+                        f'HTTP {resp.status}',
+                        resp.status,
+                        transient=resp.status in RETRY_STATUSES,
+                        received_bytes=resp.content_length,
+                    )
+                    if resp.status not in RETRY_STATUSES:
+                        raise error
+
+                    if resp.status in THROTTLE_STATUSES:
+                        retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                        if rate_limiter:
+                            rate_limiter.on_throttle(retry_after)
+
+            except asyncio.TimeoutError:
+                error = PageFetchError(url, 'timeout', transient=True)
+                RESPONSES.inc(shop_name, 'timeout')
+                if rate_limiter:
+                    rate_limiter.on_throttle()
+
+            except ClientError as client_error:
+                error = PageFetchError(url, repr(client_error), transient=True)
+                RESPONSES.inc(shop_name, 'client error')
+
+        if attempt == settings.retries:
+            break
+
+        delay = max(get_backoff_delay(settings, attempt), retry_after or 0)
+        if time.monotonic() + delay > deadline:
+            break
+        RETRIES.inc(shop_name)
+        await asyncio.sleep(delay)
+
+    raise error
+
+
+async def fetch_page(
+    session: ClientSession,
+    url: str,
+    user_agent: UserAgentPool,
+    headers: dict = {},
+    settings: FetchSettings = DEFAULT_FETCH_SETTINGS,
+    rate_limiter: HostRateLimiter | None = None,
+    page_cache: PageCache | None = None,
+    shop_name: ShopName | None = None,
+) -> FetchedPage:
+    cached_page = await page_cache.get(url) if page_cache else None
+
+    async def read_page(resp: ClientResponse) -> FetchedPage:
+        if resp.status == 304 and cached_page:
+            return FetchedPage(
+                text=None,
+                modified=False,
+                etag=cached_page.etag,
+                last_modified=cached_page.last_modified,
+                prices=cached_page.prices,
+            )
+
+        body_started_at = time.perf_counter()
+        body = await resp.read()
+        html_page = decode_page(body, resp.charset)
+        FETCH_SECONDS.observe(time.perf_counter() - body_started_at, shop_name, 'body')
+        RESPONSE_BYTES.inc(shop_name, amount=len(body))
+        modified = not cached_page or cached_page.body_hash != hash_page(html_page)
+        return FetchedPage(
+            text=html_page,
+            modified=modified,
+            etag=resp.headers.get('ETag'),
+            last_modified=resp.headers.get('Last-Modified'),
+            size=len(body),
+            prices=None if modified else cached_page.prices,
+        )
+
+    return await request_with_retries(
+        session=session,
+        url=url,
+        user_agent=user_agent,
+        read_response=read_page,
+        headers={**get_conditional_headers(cached_page), **headers},
+        settings=settings,
+        rate_limiter=rate_limiter,
+        shop_name=shop_name,
+    )
+
+
+async def get_html_page(
+    session: ClientSession,
+    url: str,
+    user_agent: UserAgentPool,
+    headers: dict = {},
+    settings: FetchSettings = DEFAULT_FETCH_SETTINGS,
+    rate_limiter: HostRateLimiter | None = None,
+) -> str:
+    page = await fetch_page(
+        session=session,
         url=url,
-        # timeout=1,
-        headers={'user-agent': user_agent.random, **headers},
-    ) as resp:
-        return await resp.text(encoding="utf-8")
+        user_agent=user_agent,
+        headers=headers,
+        settings=settings,
+        rate_limiter=rate_limiter,
+    )
+    return page.text
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import os
+import socket
+import uuid
+
+from contextlib import suppress
+from multiprocessing import Process
+from typing import AsyncIterator
+
+from aiosqlite import Connection as ConnectionAsync
+
+from db_handlers import (
+    PriceWriter,
+    claim_scrap_jobs,
+    count_scrap_jobs,
+    enqueue_scrap_jobs,
+    finish_scrap_run,
+    heartbeat_scrap_jobs,
+    prune_price_history,
+    prune_scrap_failures,
+    release_scrap_jobs,
+    select_lease_hosts,
+    start_scrap_run,
+)
+from main_funcs import fetch_listing_prices, get_prices, save_queued_listing_prices
+from schema import connect_db_async
+from data_types import ItemForScrap
+from config import (
+    LISTING_MODE,
+    PARSE_WORKERS,
+    SCRAP_JOB_BATCH_SIZE,
+    SCRAP_JOB_LEASE,
+    SCRAP_WORKERS,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Scrape product items from the shared job queue')
+    parser.add_argument('--processes', type=int, default=SCRAP_WORKERS, help='worker processes on this host')
+    # the database is in wal mode, its readers and writers share memory, so every
+    # process of a run has to be on the host that keeps the database file
+    parser.add_argument(
+        '--join',
+        action='store_true',
+        help='only help with the queued jobs of a run started by another process on this host',
+    )
+    parser.add_argument('--batch-size', type=int, default=SCRAP_JOB_BATCH_SIZE)
+    return parser.parse_args()
+
+
+async def iter_claimed_items(
+    connection: ConnectionAsync,
+    worker_id: str,
+    batch_size: int,
+) -> AsyncIterator[ItemForScrap]:
+    while items := await claim_scrap_jobs(connection, worker_id, batch_size, SCRAP_JOB_LEASE):
+        for item in items:
+            yield item
+
+
+async def keep_leases(worker_id: str) -> None:
+    async with connect_db_async() as connection:
+        while True:
+            await asyncio.sleep(SCRAP_JOB_LEASE / 3)
+            await heartbeat_scrap_jobs(connection, worker_id, SCRAP_JOB_LEASE)
+
+
+async def run_worker(worker_id: str, batch_size: int, parse_workers: int) -> None:
+    heartbeat = asyncio.create_task(keep_leases(worker_id))
+    try:
+        async with (
+            PriceWriter(worker_id=worker_id) as writer,
+            connect_db_async() as connection,
+        ):
+            items = iter_claimed_items(connection, worker_id, batch_size)
+            # a short queue keeps one worker from claiming the jobs the others could take,
+            # the listings were already read by the process that started the run
+            async for result in get_prices(items, parse_workers, queue_size=1, listing_mode=False):
+                await writer.write(result)
+    finally:
+        heartbeat.cancel()
+        with suppress(asyncio.CancelledError):
+            await heartbeat
+
+        # jobs left unfinished go back to the queue right away instead of waiting for the lease
+        async with connect_db_async() as connection:
+            await release_scrap_jobs(connection, worker_id)
+
+
+def start_worker(worker_id: str, batch_size: int, parse_workers: int) -> None:
+    asyncio.run(run_worker(worker_id, batch_size, parse_workers))
+
+
+async def start_run() -> int:
+    async with connect_db_async() as connection:
+        run_started_at = await start_scrap_run(connection)
+        jobs = await enqueue_scrap_jobs(connection, run_started_at)
+
+    if LISTING_MODE:
+        listed = await save_queued_listing_prices(await fetch_listing_prices())
+        jobs -= listed
+        print(f'Цены {listed} товаров взяты со страниц категорий')
+
+    print(f'В очереди {jobs} товаров')
+    return run_started_at
+
+
+async def finish_run(run_started_at: int) -> None:
+    async with connect_db_async() as connection:
+        if jobs := await count_scrap_jobs(connection):
+            print(f'Не обработано {jobs} товаров, они будут спарсены при следующем запуске')
+            return
+
+        await finish_scrap_run(connection, run_started_at)
+        await prune_price_history(connection)
+        await prune_scrap_failures(connection)
+
+
+async def check_lease_hosts() -> bool:
+    async with connect_db_async() as connection:
+        hosts = await select_lease_hosts(connection)
+
+    if other_hosts := set(hosts) - {socket.gethostname()}:
+        print(f'Задания парсинга заняты процессами на {", ".join(sorted(other_hosts))}, '
+              'подключиться можно только на той же машине, где лежит база')
+        return False
+    return True
+
+
+def run_workers(processes: int, batch_size: int) -> None:
+    host = socket.gethostname()
+    # parse processes of all workers share the cores of the host
+    parse_workers = max(1, PARSE_WORKERS // processes)
+    workers = [
+        Process(
+            target=start_worker,
+            args=(f'{host}:{os.getpid()}:{i}:{uuid.uuid4().hex[:8]}', batch_size, parse_workers),
+        ) for i in range(processes)
+    ]
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.join:
+        if asyncio.run(check_lease_hosts()):
+            run_workers(args.processes, args.batch_size)
+    else:
+        run_started_at = asyncio.run(start_run())
+        run_workers(args.processes, args.batch_size)
+        asyncio.run(finish_run(run_started_at))
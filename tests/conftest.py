@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+
+# modules in src import each other by bare name, as when run from inside src
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
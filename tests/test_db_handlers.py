@@ -0,0 +1,502 @@
+import asyncio
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+
+from db_handlers import (
+    PriceWriter,
+    claim_scrap_jobs,
+    clear_db,
+    count_scrap_jobs,
+    enqueue_scrap_jobs,
+    heartbeat_scrap_jobs,
+    iter_due_product_items,
+    load_product_items_to_db,
+    load_products_to_db,
+    load_shops_to_db,
+    prune_price_history,
+    prune_scrap_failures,
+    release_scrap_jobs,
+    select_latest_price,
+    select_lease_hosts,
+)
+from schema import connect_db, connect_db_async
+from data_types import PricesForSave, ProductItem, ScrapFailure, UnchangedPrices
+from config import (
+    PRICE_HISTORY_DOWNSAMPLE_AFTER,
+    SCRAP_FAILURE_RETENTION,
+    SCRAP_JOB_MAX_ATTEMPTS,
+    SCRAP_MIN_INTERVAL,
+)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / 'goods_scrapper.db')
+    connection = connect_db(db_path)
+    connection.execute("insert into shop(id, name) values (1, 'DubaiStore');")
+    connection.executemany(
+        'insert into product(id, name) values (?, ?);', [(i, f'Product {i}') for i in range(1, 4)]
+    )
+    connection.executemany(
+        'insert into product_item(id, product_id, shop_id, url, canonical_url) values (?, ?, 1, ?, ?);',
+        [(i, i, f'https://shop.example/{i}', f'https://shop.example/{i}') for i in range(1, 4)]
+    )
+    connection.commit()
+    connection.close()
+    return db_path
+
+
+def write_results(db_path: str, *results) -> None:
+    async def write():
+        async with PriceWriter(db_path=db_path) as writer:
+            for result in results:
+                await writer.write(result)
+
+    asyncio.run(write())
+
+
+def select(db_path: str, query: str, params: tuple = ()) -> list[tuple]:
+    connection = connect_db(db_path)
+    try:
+        return connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+
+
+def execute(db_path: str, query: str, params: tuple = ()) -> None:
+    connection = connect_db(db_path)
+    try:
+        connection.execute(query, params)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def test_unchanged_page_saves_prices_missing_from_db(db_path):
+    write_results(db_path, PricesForSave('AED 10.00', None, 1))
+    # as if the prices were saved on an earlier run
+    execute(db_path, 'update price_observation set scraped_at = scraped_at - 3600;')
+    write_results(
+        db_path,
+        UnchangedPrices(1, 'AED 10.00', None),
+        UnchangedPrices(2, 'AED 20.00', 'AED 25.00'),
+    )
+
+    assert select(db_path, 'select id, selling_price, net_price_minor from product_item where id < 3;') == [
+        (1, 'AED 10.00', None),
+        (2, 'AED 20.00', 2500),
+    ]
+    # the item that kept its saved prices gets no second observation
+    assert select(
+        db_path, 'select product_item_id, count(*) from price_observation group by product_item_id;'
+    ) == [(1, 1), (2, 1)]
+
+
+def fail_price_writes(db_path: str) -> None:
+    # the price updates abort while the table has a row
+    connection = connect_db(db_path)
+    try:
+        connection.executescript('''
+            create table fail_writes(id integer);
+            insert into fail_writes values (1);
+            create trigger fail_price_writes before update on product_item when exists (select 1 from fail_writes)
+            begin select raise(abort, 'writes disabled'); end;
+        ''')
+    finally:
+        connection.close()
+
+
+def test_failed_flush_keeps_the_batch(db_path):
+    fail_price_writes(db_path)
+
+    async def write():
+        async with PriceWriter(db_path=db_path, batch_size=100) as writer:
+            await writer.write(PricesForSave('AED 10.00', None, 1))
+            with pytest.raises(sqlite3.IntegrityError, match='writes disabled'):
+                await writer.flush()
+            assert not writer._connection.in_transaction
+
+            await writer.write(PricesForSave('AED 20.00', None, 2))
+            execute(db_path, 'delete from fail_writes;')
+
+    asyncio.run(write())
+    assert select(db_path, 'select id, selling_price from product_item where selling_price is not null;') == [
+        (1, 'AED 10.00'), (2, 'AED 20.00'),
+    ]
+    assert select(db_path, 'select count(*) from price_observation;') == [(2,)]
+
+
+def test_periodic_flush_error_is_raised_by_next_write(db_path):
+    fail_price_writes(db_path)
+
+    async def write():
+        async with PriceWriter(db_path=db_path, batch_size=100, flush_interval=0.01) as writer:
+            await writer.write(PricesForSave('AED 10.00', None, 1))
+            await asyncio.sleep(0.2)
+            with pytest.raises(sqlite3.IntegrityError, match='writes disabled'):
+                await writer.write(PricesForSave('AED 20.00', None, 2))
+            # raised once, the writer goes on without the periodic flusher
+            await writer.write(PricesForSave('AED 30.00', None, 3))
+            execute(db_path, 'delete from fail_writes;')
+
+    asyncio.run(write())
+    assert select(db_path, 'select id from product_item where selling_price is not null;') == [(1,), (3,)]
+
+
+def test_periodic_flush_error_is_raised_on_close(db_path):
+    fail_price_writes(db_path)
+
+    async def write():
+        async with PriceWriter(db_path=db_path, batch_size=100, flush_interval=0.01) as writer:
+            await writer.write(PricesForSave('AED 10.00', None, 1))
+            await asyncio.sleep(0.2)
+            execute(db_path, 'delete from fail_writes;')
+
+    with pytest.raises(sqlite3.IntegrityError, match='writes disabled'):
+        asyncio.run(write())
+    # the batch the flusher failed to write is written on close
+    assert select(db_path, 'select id, selling_price from product_item where selling_price is not null;') == [
+        (1, 'AED 10.00'),
+    ]
+
+
+def test_every_failed_attempt_is_recorded(db_path):
+    write_results(
+        db_path,
+        ScrapFailure(1, 'DubaiStore', 'fetch', 'HTTP 503', 503, transient=True),
+        ScrapFailure(2, 'DubaiStore', 'extract', 'no price found', 200, received_bytes=512),
+        ScrapFailure(1, 'DubaiStore', 'fetch', 'timeout', transient=True, attempt=2),
+    )
+
+    assert select(
+        db_path, 'select product_item_id, stage, reason, status, received_bytes, attempt from scrap_failure order by id;'
+    ) == [
+        (1, 'fetch', 'HTTP 503', 503, None, 1),
+        (2, 'extract', 'no price found', 200, 512, 1),
+        (1, 'fetch', 'timeout', None, None, 2),
+    ]
+    # both attempts of item 1 fall in one batch, its state is set once by the latest
+    assert select(db_path, 'select id, failure_count from product_item order by id;') == [(1, 1), (2, 1), (3, 0)]
+
+    now = int(time.time())
+    execute(
+        db_path, 'update scrap_failure set failed_at = ? where product_item_id is 1;', (now - SCRAP_FAILURE_RETENTION - 1,)
+    )
+    run_with_db(db_path, prune_scrap_failures)
+    assert select(db_path, 'select product_item_id from scrap_failure;') == [(2,)]
+
+
+def load_catalog(db_path: str, product_items: list[ProductItem]) -> None:
+    connection = connect_db(db_path)
+    try:
+        cursor = connection.cursor()
+        shop_ids = load_shops_to_db(cursor, (item.shop_name for item in product_items))
+        product_ids = load_products_to_db(cursor, (item.product_name for item in product_items))
+        load_product_items_to_db(cursor, product_items, shop_ids, product_ids)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def test_catalog_import_is_idempotent(db_path):
+    write_results(db_path, PricesForSave('AED 10.00', None, 1), PricesForSave('AED 20.00', None, 2))
+    catalog = [
+        # a link differing only in tracking parameters keeps the prices
+        ProductItem('DubaiStore', 'Product 1', 'https://shop.example/1?utm_source=sheet'),
+        # another product page drops them
+        ProductItem('DubaiStore', 'Product 2', 'https://shop.example/22'),
+        ProductItem('Amazon.ae', 'Product 1', 'https://www.amazon.ae/Air-Fryer/dp/B09NVMZS3X/ref=zg_bs_1'),
+        ProductItem('Amazon.ae', 'New product', '-'),
+    ]
+
+    load_catalog(db_path, catalog)
+    # importing the same sheet again changes nothing
+    load_catalog(db_path, catalog)
+
+    assert select(db_path, '''
+        select shop.name, product.name, url, canonical_url, selling_price
+        from product_item join shop on shop.id = shop_id join product on product.id = product_id
+        order by product_item.id;
+    ''') == [
+        ('DubaiStore', 'Product 1', 'https://shop.example/1?utm_source=sheet', 'https://shop.example/1', 'AED 10.00'),
+        ('DubaiStore', 'Product 2', 'https://shop.example/22', 'https://shop.example/22', None),
+        ('DubaiStore', 'Product 3', 'https://shop.example/3', 'https://shop.example/3', None),
+        (
+            'Amazon.ae', 'Product 1', 'https://www.amazon.ae/Air-Fryer/dp/B09NVMZS3X/ref=zg_bs_1',
+            'https://www.amazon.ae/dp/B09NVMZS3X', None,
+        ),
+        ('Amazon.ae', 'New product', None, None, None),
+    ]
+    assert select(db_path, 'select count(*) from shop;') == [(2,)]
+    assert select(db_path, 'select count(*) from product;') == [(4,)]
+
+
+def test_relinked_item_is_due_at_once(db_path):
+    write_results(db_path, PricesForSave('AED 10.00', None, 1), PricesForSave('AED 20.00', None, 2))
+    execute(db_path, 'update product_item set failure_count = 3 where id is 2;')
+
+    load_catalog(db_path, [
+        ProductItem('DubaiStore', 'Product 1', 'https://shop.example/1?utm_source=sheet'),
+        ProductItem('DubaiStore', 'Product 2', 'https://shop.example/22'),
+    ])
+
+    assert iter_due_ids(db_path, int(time.time())) == [2, 3]
+    assert select(db_path, 'select id, last_scraped_at is null, failure_count from product_item where id < 3;') == [
+        (1, 0, 0), (2, 1, 0),
+    ]
+
+
+def test_clear_db_leaves_nothing_to_reused_ids(db_path):
+    write_results(db_path, PricesForSave('AED 999.00', None, 1), ScrapFailure(2, 'DubaiStore', 'fetch', 'HTTP 404', 404))
+    execute(db_path, 'insert into scrap_job(product_item_id, priority) values (3, 0);')
+
+    connection = connect_db(db_path)
+    try:
+        clear_db(connection.cursor())
+        connection.execute("insert into shop(id, name) values (1, 'DubaiStore');")
+        connection.execute("insert into product(id, name) values (1, 'New product');")
+        connection.execute("insert into product_item(product_id, shop_id, url) values (1, 1, 'https://shop.example/new');")
+        connection.commit()
+    finally:
+        connection.close()
+
+    async def select_latest():
+        async with connect_db_async(db_path) as connection:
+            return await select_latest_price(connection, 1)
+
+    assert select(db_path, 'select id from product_item;') == [(1,)]
+    assert asyncio.run(select_latest()) is None
+    assert select(db_path, 'select count(*) from scrap_failure;') == [(0,)]
+    assert select(db_path, 'select count(*) from scrap_job;') == [(0,)]
+
+
+def test_due_items_in_priority_order(db_path):
+    execute(db_path, "insert into shop(id, name) values (2, 'Amazon.ae');")
+    connection = connect_db(db_path)
+    try:
+        connection.executemany(
+            'insert into product_item(id, product_id, shop_id, url, canonical_url, last_scraped_at, last_changed_at) '
+            'values (?, ?, 2, ?, ?, ?, ?);',
+            [
+                (4, 1, 'https://a.example/4', 'https://a.example/4', 1, 1),
+                # both rows of the same product page are fetched once, through the lower id
+                (5, 2, 'https://a.example/5?ref=x', 'https://a.example/5', None, None),
+                (6, 3, 'https://a.example/5?tag=y', 'https://a.example/5', None, None),
+            ]
+        )
+        connection.execute("insert into shop(id, name) values (3, 'Carrefour UAE');")
+        connection.executemany(
+            'insert into product_item(id, product_id, shop_id, url, canonical_url, last_scraped_at, last_changed_at) '
+            'values (?, ?, 3, ?, ?, 1, 1);',
+            [
+                # changed in the same second as item 4, a batch ends inside the group
+                (7, 1, 'https://c.example/7', 'https://c.example/7'),
+                (8, 2, 'https://c.example/8', 'https://c.example/8'),
+            ]
+        )
+        connection.execute('update product_item set last_scraped_at = 1, last_changed_at = 0 where id is 1;')
+        connection.commit()
+    finally:
+        connection.close()
+
+    async def iter_due():
+        async with connect_db_async(db_path) as connection:
+            return [(item.id, item.url) async for item in iter_due_product_items(connection, 100, batch_size=2)]
+
+    assert asyncio.run(iter_due()) == [
+        (2, 'https://shop.example/2'),
+        (3, 'https://shop.example/3'),
+        (5, 'https://a.example/5'),
+        (8, 'https://c.example/8'),
+        (7, 'https://c.example/7'),
+        (4, 'https://a.example/4'),
+        (1, 'https://shop.example/1'),
+    ]
+
+
+def iter_due_ids(db_path: str, run_started_at: int) -> list[int]:
+    async def iter_due():
+        async with connect_db_async(db_path) as connection:
+            return [item.id async for item in iter_due_product_items(connection, run_started_at)]
+
+    return asyncio.run(iter_due())
+
+
+def test_due_items_follow_staleness_and_failures(db_path):
+    now = int(time.time())
+    connection = connect_db(db_path)
+    try:
+        connection.executemany(
+            'update product_item set last_scraped_at = ?, last_changed_at = ?, failure_count = ? where id is ?;',
+            [
+                # changed long ago, its interval is half of the time it kept its prices
+                (now - 3 * 24 * 3600, now - 9 * 24 * 3600, 0, 1),
+                # changed a day before its last scrape an hour ago, not due before the min interval
+                (now - 3600, now - 25 * 3600, 0, 2),
+                # failed twice, its backoff is four times the min interval
+                (now - 3 * SCRAP_MIN_INTERVAL, now - 30 * 24 * 3600, 2, 3),
+            ]
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    assert iter_due_ids(db_path, now) == [1]
+    # a run interrupted after the scrape of item 1 resumes without it
+    assert iter_due_ids(db_path, now - 3 * 24 * 3600) == []
+
+    write_results(db_path, ScrapFailure(1, 'DubaiStore', 'fetch', 'HTTP 503', 503))
+    write_results(db_path, UnchangedPrices(3, None, None))
+    assert select(db_path, 'select id, failure_count from product_item order by id;') == [(1, 1), (2, 0), (3, 0)]
+
+
+def run_with_db(db_path: str, scenario) -> object:
+    async def run():
+        async with connect_db_async(db_path) as connection:
+            return await scenario(connection)
+
+    return asyncio.run(run())
+
+
+def test_claim_scrap_jobs_in_priority_order(db_path):
+    async def scenario(connection):
+        assert await enqueue_scrap_jobs(connection, 100) == 3
+        # a second run start finds the jobs already queued
+        assert await enqueue_scrap_jobs(connection, 100) == 0
+
+        claimed = await claim_scrap_jobs(connection, 'worker-1', 2, 60)
+        rest = await claim_scrap_jobs(connection, 'worker-2', 2, 60)
+        nothing = await claim_scrap_jobs(connection, 'worker-3', 2, 60)
+        return claimed, rest, nothing
+
+    claimed, rest, nothing = run_with_db(db_path, scenario)
+    assert [(item.id, item.url, item.shop_name) for item in claimed] == [
+        (1, 'https://shop.example/1', 'DubaiStore'),
+        (2, 'https://shop.example/2', 'DubaiStore'),
+    ]
+    assert [item.id for item in rest] == [3]
+    assert nothing == ()
+    assert select(db_path, 'select product_item_id, lease_owner, attempts from scrap_job order by 1;') == [
+        (1, 'worker-1', 1), (2, 'worker-1', 1), (3, 'worker-2', 1),
+    ]
+
+
+def test_lease_hosts_come_from_the_worker_ids(db_path):
+    async def scenario(connection):
+        await enqueue_scrap_jobs(connection, 100)
+        await claim_scrap_jobs(connection, 'host-a:100:0:1f2e3d4c', 1, 60)
+        await claim_scrap_jobs(connection, 'host-a:100:1:5b6a7988', 1, 60)
+        await claim_scrap_jobs(connection, 'host-b:200:0:0a1b2c3d', 1, 60)
+        return await select_lease_hosts(connection)
+
+    assert sorted(run_with_db(db_path, scenario)) == ['host-a', 'host-b']
+
+
+def test_expired_and_released_leases_are_claimed_again(db_path):
+    async def scenario(connection):
+        await enqueue_scrap_jobs(connection, 100)
+        await claim_scrap_jobs(connection, 'worker-1', 1, 60)
+        # the lease of worker-2 has already run out, as if it died
+        await claim_scrap_jobs(connection, 'worker-2', 1, -1)
+        # the heartbeat keeps the lease of worker-1 from running out
+        await heartbeat_scrap_jobs(connection, 'worker-1', 600)
+        requeued = await claim_scrap_jobs(connection, 'worker-3', 3, 60)
+
+        await release_scrap_jobs(connection, 'worker-3')
+        released = await claim_scrap_jobs(connection, 'worker-4', 3, 60)
+        return requeued, released
+
+    requeued, released = run_with_db(db_path, scenario)
+    assert sorted(item.id for item in requeued) == [2, 3]
+    assert sorted(item.id for item in released) == [2, 3]
+    assert select(db_path, 'select product_item_id, lease_owner, attempts from scrap_job order by 1;') == [
+        (1, 'worker-1', 1), (2, 'worker-4', 3), (3, 'worker-4', 2),
+    ]
+
+
+def test_job_is_dropped_once_its_attempts_run_out(db_path):
+    async def scenario(connection):
+        await enqueue_scrap_jobs(connection, 100)
+        await connection.execute('delete from scrap_job where product_item_id is not 1;')
+        await connection.commit()
+
+        claims = []
+        for i in range(SCRAP_JOB_MAX_ATTEMPTS + 1):
+            claims.append(await claim_scrap_jobs(connection, f'worker-{i}', 1, -1))
+        return claims, await count_scrap_jobs(connection)
+
+    claims, jobs = run_with_db(db_path, scenario)
+    assert [len(claimed) for claimed in claims] == [1] * SCRAP_JOB_MAX_ATTEMPTS + [0]
+    assert jobs == 0
+
+
+def claim_all_jobs(db_path: str, worker_id: str, claimed_ids) -> None:
+    async def scenario(connection):
+        while items := await claim_scrap_jobs(connection, worker_id, 3, 600):
+            claimed_ids.extend([item.id for item in items])
+
+    run_with_db(db_path, scenario)
+
+
+def test_workers_never_claim_the_same_job(db_path):
+    connection = connect_db(db_path)
+    try:
+        connection.executemany(
+            'insert into product(id, name) values (?, ?);', [(i, f'Product {i}') for i in range(4, 301)]
+        )
+        connection.executemany(
+            'insert into product_item(id, product_id, shop_id, url) values (?, ?, 1, ?);',
+            [(i, i, f'https://shop.example/{i}') for i in range(4, 301)]
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    async def enqueue(connection):
+        return await enqueue_scrap_jobs(connection, 100)
+
+    assert run_with_db(db_path, enqueue) == 300
+
+    # separate processes, as the workers run
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        claimed_ids = manager.list()
+        workers = [
+            context.Process(target=claim_all_jobs, args=(db_path, f'worker-{i}', claimed_ids)) for i in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        claimed_ids = list(claimed_ids)
+
+    assert all(worker.exitcode == 0 for worker in workers)
+    assert sorted(claimed_ids) == list(range(1, 301))
+
+
+def test_price_history_is_downsampled_once_per_window(db_path):
+    day = 24 * 3600
+    execute(db_path, 'insert into scrap_run(started_at, finished_at) values (1, 2);')
+    connection = connect_db(db_path)
+    try:
+        connection.executemany(
+            'insert into price_observation(product_item_id, scraped_at, selling_price) values (1, ?, 100);',
+            [(d * day + s,) for d in (10, 11, 12) for s in (100, 200)]
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    def observations() -> list[int]:
+        return [i for i, in select(db_path, 'select scraped_at from price_observation order by 1;')]
+
+    run_with_db(db_path, lambda connection: prune_price_history(connection, 11 * day + PRICE_HISTORY_DOWNSAMPLE_AFTER))
+    assert observations() == [10 * day + 200, 11 * day + 100, 11 * day + 200, 12 * day + 100, 12 * day + 200]
+
+    # a day downsampled before is not read again
+    execute(db_path, 'insert into price_observation(product_item_id, scraped_at) values (1, ?);', (10 * day + 50,))
+    run_with_db(db_path, lambda connection: prune_price_history(connection, 12 * day + PRICE_HISTORY_DOWNSAMPLE_AFTER))
+    assert observations() == [10 * day + 50, 10 * day + 200, 11 * day + 200, 12 * day + 100, 12 * day + 200]
@@ -0,0 +1,98 @@
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+
+import excel_handlers
+from excel_handlers import append_result_sheet_row, create_result_sheet_header, parce_excell_file
+from data_types import ProductItem, ProductItemForResultSheet, Shop
+
+
+PRODUCT_LINKS_PATH = str(Path(__file__).parent / 'fixtures' / 'product_links.xlsx')
+
+
+def test_parce_excell_file():
+    info_for_db = parce_excell_file(PRODUCT_LINKS_PATH)
+
+    # the column without a shop name holds notes, the rows without a title are skipped
+    assert list(info_for_db.shop_names) == ['Amazon.ae', 'Carrefour UAE', 'DubaiStore']
+    assert list(info_for_db.product_names) == ['Air fryer', 'Kettle', 'Toaster']
+    assert list(info_for_db.product_item_links) == [
+        ProductItem('Amazon.ae', 'Air fryer', 'https://www.amazon.ae/dp/B08H7RKSM7'),
+        ProductItem(
+            'Carrefour UAE', 'Air fryer', 'https://www.carrefouruae.com/mafuae/en/fryer/philips-airfryer/p/8710103951766'
+        ),
+        ProductItem('DubaiStore', 'Air fryer', '-'),
+        # a product without links still gets its items, they have no url
+        ProductItem('Amazon.ae', 'Kettle', None),
+        ProductItem('Carrefour UAE', 'Kettle', None),
+        ProductItem('DubaiStore', 'Kettle', None),
+        ProductItem('Amazon.ae', 'Toaster', 'https://www.amazon.ae/dp/B0B6GLQJMV'),
+        ProductItem('Carrefour UAE', 'Toaster', None),
+        ProductItem('DubaiStore', 'Toaster', None),
+    ]
+
+
+def test_sheet_without_shops_gives_products_without_items(tmp_path):
+    path = str(tmp_path / 'product_links.xlsx')
+    workbook = Workbook()
+    for row in (('Title',), ('Air fryer',), ('Kettle',)):
+        workbook.active.append(row)
+    workbook.save(path)
+
+    info_for_db = parce_excell_file(path)
+
+    assert (list(info_for_db.shop_names), list(info_for_db.product_names), list(info_for_db.product_item_links)) == (
+        [], ['Air fryer', 'Kettle'], []
+    )
+
+
+def test_workbook_is_read_once(monkeypatch):
+    opened = 0
+
+    def count_load_workbook(*args, **kwargs):
+        nonlocal opened
+        opened += 1
+        return load_workbook(*args, **kwargs)
+
+    load_workbook = excel_handlers.load_workbook
+    monkeypatch.setattr(excel_handlers, 'load_workbook', count_load_workbook)
+
+    info_for_db = parce_excell_file(PRODUCT_LINKS_PATH)
+    list(info_for_db.shop_names), list(info_for_db.product_names), list(info_for_db.product_item_links)
+
+    assert opened == 1
+
+
+def test_result_sheet(tmp_path):
+    path = str(tmp_path / 'result_sheet.xlsx')
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+
+    shop_columns = create_result_sheet_header(worksheet, (Shop(1, 'Amazon.ae'), Shop(2, 'Carrefour UAE')))
+    append_result_sheet_row(worksheet, shop_columns, [
+        ProductItemForResultSheet(
+            'Amazon.ae', 'Air fryer', 'https://a.example/1', 'AED 299.00', 'AED 399.00', 29900, 39900, 'AED'
+        ),
+        ProductItemForResultSheet(
+            'Carrefour UAE', 'Air fryer', 'https://c.example/1', 'AED 318.00', None, 31800, None, 'AED'
+        ),
+    ])
+    append_result_sheet_row(worksheet, shop_columns, [
+        ProductItemForResultSheet('Amazon.ae', 'Kettle', 'https://a.example/2', 'Call for price', None, None, None, None),
+    ])
+    workbook.save(path)
+
+    worksheet = load_workbook(path).active
+
+    assert shop_columns == {'Amazon.ae': 2, 'Carrefour UAE': 5}
+    # every shop has a url and two price columns under its merged name
+    assert sorted(str(cell_range) for cell_range in worksheet.merged_cells.ranges) == ['A1:A2', 'B1:D1', 'E1:G1']
+    assert [[cell.value for cell in row] for row in worksheet.iter_rows()] == [
+        ['Title', 'Amazon.ae', None, None, 'Carrefour UAE', None, None],
+        [None, 'URL', 'Selling price', 'Price before discount', 'URL', 'Selling price', 'Price before discount'],
+        ['Air fryer', 'https://a.example/1', 299, 399, 'https://c.example/1', 318, '-'],
+        ['Kettle', 'https://a.example/2', 'Call for price', '-', None, None, None],
+    ]
+    # prices with a known amount are numbers in the currency of the shop
+    assert [worksheet[coordinate].number_format for coordinate in ('C3', 'D3', 'F3')] == ['#,##0.00 "AED"'] * 3
+    assert worksheet['G3'].data_type == 's'
@@ -0,0 +1,105 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+from exporters import ExportError, export_rows, get_columns, iter_long_rows, iter_wide_rows
+from main_funcs import export_prices
+from data_types import Shop
+
+
+SHOPS = (Shop(1, 'Amazon.ae'), Shop(2, 'Carrefour UAE'))
+
+# rows of the result sheet query
+RESULT_SHEET_ROWS = [
+    ('Amazon.ae', 'Air fryer', 'https://a.example/1', 'AED 299.00', 'AED 399.00', 29900, 39900, 'AED'),
+    ('Carrefour UAE', 'Air fryer', 'https://c.example/1', 'AED 318.00', None, 31800, None, 'AED'),
+    ('Amazon.ae', 'Kettle', 'https://a.example/2', None, None, None, None, None),
+    (None, 'Toaster', None, None, None, None, None, None),
+]
+
+
+async def iter_batches(rows: list[tuple], batch_size: int = 2):
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+
+def export(tmp_path, layout: str, file_format: str, read_batch_size: int = 2, batch_size: int = 2) -> str:
+    path = str(tmp_path / f'prices.{file_format}')
+    batches = iter_batches(RESULT_SHEET_ROWS, read_batch_size)
+    rows = iter_long_rows(batches) if layout == 'long' else iter_wide_rows(batches, SHOPS)
+    exported = asyncio.run(export_rows(rows, path, file_format, get_columns(layout, SHOPS), batch_size=batch_size))
+    assert exported == (len(RESULT_SHEET_ROWS) if layout == 'long' else 3)
+    return path
+
+
+def test_export_long_csv(tmp_path):
+    with open(export(tmp_path, 'long', 'csv'), encoding='utf-8', newline='') as export_file:
+        rows = list(csv.reader(export_file))
+
+    assert rows[0] == [
+        'product_name', 'shop_name', 'url', 'selling_price', 'net_price',
+        'selling_price_minor', 'net_price_minor', 'currency',
+    ]
+    assert rows[1] == ['Air fryer', 'Amazon.ae', 'https://a.example/1', 'AED 299.00', 'AED 399.00', '29900', '39900', 'AED']
+    assert len(rows) == 1 + len(RESULT_SHEET_ROWS)
+
+
+def test_export_wide_jsonl(tmp_path):
+    # the rows of a product are split across the read batches
+    with open(export(tmp_path, 'wide', 'jsonl', read_batch_size=1), encoding='utf-8') as export_file:
+        rows = [json.loads(line) for line in export_file]
+
+    assert [row['product_name'] for row in rows] == ['Air fryer', 'Kettle', 'Toaster']
+    assert rows[0]['Amazon.ae selling_price_minor'] == 29900
+    assert rows[0]['Carrefour UAE selling_price'] == 'AED 318.00'
+    assert rows[1]['Amazon.ae url'] == 'https://a.example/2'
+    assert rows[2]['Amazon.ae url'] is None
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+@pytest.mark.parametrize('layout', ['long', 'wide'])
+def test_export_arrow_types(tmp_path, layout, file_format):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    path = export(tmp_path, layout, file_format)
+    if file_format == 'parquet':
+        table = pa.parquet.read_table(path)
+    else:
+        with pa.ipc.open_file(path) as reader:
+            table = reader.read_all()
+    for field in table.schema:
+        if field.name.endswith('_minor'):
+            assert field.type == pa.int64()
+        else:
+            assert field.type == pa.string()
+
+    if layout == 'wide':
+        assert table.column('product_name').to_pylist() == ['Air fryer', 'Kettle', 'Toaster']
+        assert table.column('Amazon.ae selling_price_minor').to_pylist() == [29900, None, None]
+        assert table.column('Carrefour UAE selling_price_minor').to_pylist() == [31800, None, None]
+        assert table.column('Carrefour UAE currency').to_pylist() == ['AED', None, None]
+    else:
+        assert table.column('net_price_minor').to_pylist() == [39900, None, None, None]
+
+
+def test_export_joins_read_batches(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+
+    path = export(tmp_path, 'long', 'parquet', read_batch_size=1, batch_size=3)
+    metadata = pa.parquet.ParquetFile(path).metadata
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [3, 1]
+
+
+def test_export_of_unknown_format(tmp_path):
+    with pytest.raises(ExportError, match='unknown export format'):
+        export(tmp_path, 'long', 'xlsx')
+
+
+def test_export_of_unknown_layout(tmp_path):
+    with pytest.raises(ExportError, match='unknown export layout'):
+        asyncio.run(export_prices(str(tmp_path / 'prices.csv'), 'csv', 'tall'))
@@ -0,0 +1,180 @@
+import asyncio
+
+import pytest
+
+import main_funcs
+import parsers
+from main_funcs import get_prices, iter_items, iter_scrap_results, save_queued_listing_prices
+from db_handlers import enqueue_scrap_jobs
+from schema import connect_db, connect_db_async
+from data_types import ItemForScrap, PricesForSave, ScrapFailure, ScrappedPrices
+
+
+def make_items(count: int, shop_names: tuple[str, ...] = ('Amazon.ae',)) -> list[ItemForScrap]:
+    return [
+        ItemForScrap(id=i, url=f'https://shop.example/{i}', shop_id=1, shop_name=shop_names[i % len(shop_names)])
+        for i in range(count)
+    ]
+
+
+async def scrap_prices(scrap_item: ItemForScrap) -> PricesForSave:
+    # later items come back sooner, so the order would show if results were not kept per worker
+    await asyncio.sleep(0.001 * (10 - scrap_item.id % 10))
+    return PricesForSave(selling_price=f'AED {scrap_item.id}.00', net_price=None, id=scrap_item.id)
+
+
+async def collect(scrap, items, queue_size: int = 100) -> list:
+    return [result async for result in iter_scrap_results(scrap, iter_items(items), queue_size)]
+
+
+def test_pipeline_keeps_the_feed_order_of_a_shop_worker(monkeypatch):
+    monkeypatch.setattr(main_funcs, 'get_shop_concurrency', lambda shop_name: 1)
+    items = make_items(30, ('Amazon.ae', 'DubaiStore'))
+
+    results = asyncio.run(collect(scrap_prices, items))
+
+    for shop_name in ('Amazon.ae', 'DubaiStore'):
+        shop_ids = [item.id for item in items if item.shop_name == shop_name]
+        assert [result.id for result in results if result.id in shop_ids] == shop_ids
+
+
+def test_pipeline_scrapes_every_item_once():
+    items = make_items(50, ('Amazon.ae', 'Carrefour UAE', 'DubaiStore'))
+    results = asyncio.run(collect(scrap_prices, items))
+    assert sorted(result.id for result in results) == list(range(50))
+
+
+def test_pipeline_reads_the_feed_at_the_pace_of_the_consumer(monkeypatch):
+    monkeypatch.setattr(main_funcs, 'get_shop_concurrency', lambda shop_name: 1)
+    pulled = 0
+
+    async def iter_counted(items):
+        nonlocal pulled
+        for item in items:
+            pulled += 1
+            yield item
+
+    async def run():
+        results = iter_scrap_results(scrap_prices, iter_counted(make_items(1000)), queue_size=1)
+        await anext(results)
+        await asyncio.sleep(0.05)
+        await results.aclose()
+
+    asyncio.run(run())
+    # the item of the worker, one in each queue and the one the feed waits to put
+    assert pulled <= 5
+
+
+def test_pipeline_does_not_hold_a_shop_behind_a_stretch_of_another(monkeypatch):
+    monkeypatch.setattr(main_funcs, 'get_shop_concurrency', lambda shop_name: 1)
+    items = make_items(10) + [
+        ItemForScrap(id=i, url=f'https://shop.example/{i}', shop_id=2, shop_name='DubaiStore') for i in range(10, 13)
+    ]
+
+    async def scrap(scrap_item: ItemForScrap) -> PricesForSave:
+        await asyncio.sleep(0.05 if scrap_item.shop_name == 'Amazon.ae' else 0)
+        return PricesForSave(selling_price=None, net_price=None, id=scrap_item.id)
+
+    results = asyncio.run(collect(scrap, items, queue_size=5))
+
+    # the items of the second shop pass the full queue of the first one
+    assert [result.id for result in results][:3] == [10, 11, 12]
+
+
+def test_pipeline_is_cancelled_when_the_consumer_stops():
+    started = 0
+    cancelled = 0
+
+    async def scrap_slowly(scrap_item: ItemForScrap) -> PricesForSave:
+        nonlocal started, cancelled
+        started += 1
+        try:
+            await asyncio.sleep(0 if scrap_item.id == 0 else 10)
+        except asyncio.CancelledError:
+            cancelled += 1
+            raise
+        return PricesForSave(selling_price=None, net_price=None, id=scrap_item.id)
+
+    async def run():
+        results = iter_scrap_results(scrap_slowly, iter_items(make_items(20)))
+        assert (await anext(results)).id == 0
+        await results.aclose()
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(asyncio.wait_for(run(), 5)) == []
+    assert started > 1
+    assert cancelled == started - 1
+
+
+def test_worker_exception_reaches_the_consumer():
+    async def scrap_failing(scrap_item: ItemForScrap) -> PricesForSave:
+        if scrap_item.id == 3:
+            raise ValueError('broken extractor')
+        return await scrap_prices(scrap_item)
+
+    with pytest.raises(ValueError, match='broken extractor'):
+        asyncio.run(asyncio.wait_for(collect(scrap_failing, make_items(10)), 5))
+
+
+def test_transient_failures_are_retried_at_the_end_of_a_run(monkeypatch):
+    monkeypatch.setattr(main_funcs, 'SCRAP_RETRY_ROUNDS', 2)
+    monkeypatch.setattr(main_funcs, 'SCRAP_RETRY_DELAY', 0)
+    monkeypatch.setattr(main_funcs, 'PAGE_CACHE_ENABLED', False)
+    monkeypatch.setattr(main_funcs, 'PAGE_ARCHIVE_ENABLED', False)
+    attempts = {}
+
+    async def scrap_flaky(scrap_item: ItemForScrap, **kwargs) -> PricesForSave | ScrapFailure:
+        attempts[scrap_item.id] = attempts.get(scrap_item.id, 0) + 1
+        if scrap_item.id == 1 and attempts[1] == 3:
+            return PricesForSave(selling_price='AED 1.00', net_price=None, id=1)
+        if scrap_item.id in (1, 3):
+            return ScrapFailure(scrap_item.id, scrap_item.shop_name, 'fetch', 'HTTP 503', 503, transient=True)
+        if scrap_item.id == 2:
+            return ScrapFailure(scrap_item.id, scrap_item.shop_name, 'fetch', 'HTTP 404', 404)
+        return await scrap_prices(scrap_item)
+
+    monkeypatch.setattr(parsers, 'get_prices_for_product_item', scrap_flaky)
+
+    async def run():
+        return [result async for result in get_prices(iter_items(make_items(5)), listing_mode=False)]
+
+    results = asyncio.run(asyncio.wait_for(run(), 10))
+
+    assert attempts == {0: 1, 1: 3, 2: 1, 3: 3, 4: 1}
+    # every failed attempt is kept, numbered by its round
+    assert sorted(
+        (result.id, result.attempt) for result in results if isinstance(result, ScrapFailure)
+    ) == [(1, 1), (1, 2), (2, 1), (3, 1), (3, 2), (3, 3)]
+    assert sorted(result.id for result in results if isinstance(result, PricesForSave)) == [0, 1, 4]
+
+
+def test_listing_prices_of_a_worker_run_are_saved_once(tmp_path):
+    db_path = str(tmp_path / 'goods_scrapper.db')
+    connection = connect_db(db_path)
+    connection.execute("insert into shop(id, name) values (1, 'DubaiStore');")
+    connection.executemany('insert into product(id, name) values (?, ?);', [(i, f'Product {i}') for i in range(1, 4)])
+    connection.executemany(
+        'insert into product_item(id, product_id, shop_id, url, canonical_url) values (?, ?, 1, ?, ?);',
+        [(i, i, f'https://shop.example/{i}', f'https://shop.example/{i}') for i in range(1, 4)]
+    )
+    connection.commit()
+    connection.close()
+
+    async def run():
+        async with connect_db_async(db_path) as connection:
+            await enqueue_scrap_jobs(connection, 100)
+        return await save_queued_listing_prices(
+            {('DubaiStore', 'https://shop.example/2'): ScrappedPrices('AED 10.00', None)}, db_path=db_path
+        )
+
+    assert asyncio.run(run()) == 1
+
+    connection = connect_db(db_path)
+    try:
+        # the workers only get the jobs of the items the listings do not show
+        assert connection.execute('select product_item_id from scrap_job order by 1;').fetchall() == [(1,), (3,)]
+        assert connection.execute('select id, selling_price from product_item order by 1;').fetchall() == [
+            (1, None), (2, 'AED 10.00'), (3, None),
+        ]
+    finally:
+        connection.close()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import socket
+
+import aiohttp
+import pytest
+
+from aiohttp import web
+
+import metrics
+from metrics import Counter, Histogram, METRICS, format_summary, save_snapshot, serve_metrics
+
+
+@pytest.fixture
+def reset_metrics():
+    METRICS.reset()
+    yield
+    METRICS.reset()
+
+
+def test_counter_to_prometheus():
+    counter = Counter('scrap_test_total', 'Test counter', ('shop', 'status'))
+    counter.inc('Amazon.ae', 200)
+    counter.inc('Amazon.ae', 200, amount=2)
+
+    assert counter.to_prometheus() == [
+        '# HELP scrap_test_total Test counter',
+        '# TYPE scrap_test_total counter',
+        'scrap_test_total{shop="Amazon.ae",status="200"} 3.0',
+    ]
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram('scrap_test_seconds', 'Test histogram', ('shop',), buckets=(0.1, 1.0, float('inf')))
+    for value in (0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value, 'Amazon.ae')
+
+    assert histogram.get_quantile(0.5, 'Amazon.ae') == 0.1
+    assert histogram.get_quantile(0.75, 'Amazon.ae') == 1.0
+    assert histogram.get_quantile(0.99, 'Amazon.ae') == float('inf')
+    assert histogram.get_quantile(0.5, 'Noon') is None
+    assert histogram.to_prometheus()[2:] == [
+        'scrap_test_seconds_bucket{shop="Amazon.ae",le="0.1"} 2',
+        'scrap_test_seconds_bucket{shop="Amazon.ae",le="1.0"} 3',
+        'scrap_test_seconds_bucket{shop="Amazon.ae",le="+Inf"} 4',
+        'scrap_test_seconds_sum{shop="Amazon.ae"} 5.6',
+        'scrap_test_seconds_count{shop="Amazon.ae"} 4',
+    ]
+
+
+def reject_constant(constant: str):
+    raise ValueError(f'{constant} is not valid json')
+
+
+def test_snapshot_of_a_sample_above_the_last_bucket_is_valid_json(tmp_path, reset_metrics):
+    snapshot_path = tmp_path / 'metrics.json'
+    metrics.FETCH_SECONDS.observe(0.2, 'Amazon.ae', 'ttfb')
+    metrics.FETCH_SECONDS.observe(60.0, 'Amazon.ae', 'ttfb')
+
+    save_snapshot(str(snapshot_path))
+
+    snapshot = json.loads(snapshot_path.read_text(encoding='utf-8'), parse_constant=reject_constant)
+    [fetch_seconds] = snapshot['scrap_fetch_seconds']
+    assert (fetch_seconds['p50'], fetch_seconds['p99']) == (0.25, None)
+
+
+def test_format_summary(reset_metrics):
+    metrics.ITEMS.inc('Amazon.ae', 'saved', amount=9)
+    metrics.ITEMS.inc('Amazon.ae', 'failed')
+    metrics.RESPONSES.inc('Amazon.ae', 503, amount=2)
+    metrics.RETRIES.inc('Amazon.ae', amount=2)
+    metrics.FETCH_SECONDS.observe(0.2, 'Amazon.ae', 'ttfb')
+
+    summary = format_summary()
+    assert '- Amazon.ae: failed 1, saved 9' in summary
+    assert 'HTTP 503: 2; retries 2;' in summary
+    assert 'ttfb p50 250ms' in summary
+
+
+def get_free_port() -> int:
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def test_metrics_are_served_to_the_local_machine(monkeypatch, reset_metrics):
+    hosts = []
+
+    class RecordedSite(web.TCPSite):
+        def __init__(self, runner, host, port, **kwargs):
+            hosts.append(host)
+            super().__init__(runner, host, port, **kwargs)
+
+    monkeypatch.setattr(web, 'TCPSite', RecordedSite)
+    metrics.RETRIES.inc('Amazon.ae')
+    port = get_free_port()
+
+    async def fetch():
+        async with serve_metrics(port):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as resp:
+                    return await resp.text()
+
+    assert 'scrap_retries_total{shop="Amazon.ae"} 1' in asyncio.run(fetch())
+    assert hosts == ['127.0.0.1']
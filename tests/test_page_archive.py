@@ -0,0 +1,54 @@
+import asyncio
+
+from pathlib import Path
+
+from page_archive import PageArchive, clear_page_archive, iter_archived_pages, iter_replayed_prices
+from data_types import ItemForScrap, ScrappedPrices
+
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+ARCHIVED_FIXTURES = [
+    ('amazon_sns_base_price.html', 'Amazon.ae', ScrappedPrices('AED 299.00', 'AED 399.00')),
+    ('carrefour_discount.html', 'Carrefour UAE', ScrappedPrices('AED 179.00', 'AED 229.00')),
+    ('dubai_store_price.html', 'DubaiStore', ScrappedPrices('AED 189.00', None)),
+]
+
+
+def archive_fixtures(path: str, segment_size: int) -> None:
+    async def archive():
+        async with PageArchive(path, segment_size=segment_size) as page_archive:
+            for i, (fixture, shop_name, _) in enumerate(ARCHIVED_FIXTURES, start=1):
+                await page_archive.put(
+                    ItemForScrap(id=i, url=f'https://shop.example/{i}', shop_id=i, shop_name=shop_name),
+                    (FIXTURES_DIR / fixture).read_text(encoding='utf-8'),
+                )
+
+    asyncio.run(archive())
+
+
+def test_replay_archived_pages(tmp_path):
+    # every record gets a segment of its own
+    archive_fixtures(str(tmp_path), segment_size=1)
+
+    assert len({page.segment for page in iter_archived_pages(str(tmp_path))}) == len(ARCHIVED_FIXTURES)
+    replayed = sorted(iter_replayed_prices(str(tmp_path), processes=2))
+    assert [(r.id, r.latest, r.prices) for r in replayed] == [
+        (i, True, expected) for i, (_, _, expected) in enumerate(ARCHIVED_FIXTURES, start=1)
+    ]
+
+
+def test_replay_archived_pages_of_shop(tmp_path):
+    archive_fixtures(str(tmp_path), segment_size=1024 * 1024)
+
+    assert len({page.segment for page in iter_archived_pages(str(tmp_path))}) == 1
+    replayed = list(iter_replayed_prices(str(tmp_path), shop_name='DubaiStore', processes=1))
+    assert [(r.id, r.prices) for r in replayed] == [(3, ScrappedPrices('AED 189.00', None))]
+
+
+def test_clear_page_archive(tmp_path):
+    archive_fixtures(str(tmp_path), segment_size=1)
+    clear_page_archive(str(tmp_path))
+
+    assert list(iter_archived_pages(str(tmp_path))) == []
+    assert [path.name for path in tmp_path.iterdir() if path.name.endswith('.warc.gz')] == []
@@ -0,0 +1,232 @@
+import asyncio
+import socket
+import sqlite3
+
+from pathlib import Path
+
+import pytest
+
+from aiohttp import web
+
+import parsers
+from parsers import (
+    STREAM_CHUNK_SIZE,
+    ParsePool,
+    get_prices_for_product_item,
+    parse_listing_prices,
+    parse_prices,
+    read_prices_streaming,
+)
+from page_cache import PageCache
+from web_utils import ClientSessions, UserAgentPool
+from metrics import PARSE_SECONDS
+from data_types import ItemForScrap, ListingPrice, PricesForSave, ScrappedPrices, UnchangedPrices
+
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+FIXTURE_PRICES = [
+    ('amazon_sns_base_price.html', 'Amazon.ae', ScrappedPrices('AED 299.00', 'AED 399.00')),
+    ('amazon_a_price.html', 'Amazon.ae', ScrappedPrices('AED 349.00', None)),
+    ('amazon_price_whole.html', 'Amazon.ae', ScrappedPrices('AED 189.50', 'AED 249.00')),
+    ('amazon_color_price.html', 'Amazon.ae', ScrappedPrices('AED 75.00', None)),
+    ('amazon_unavailable.html', 'Amazon.ae', ScrappedPrices(None, None)),
+    ('amazon_right_col.html', 'Amazon.ae', ScrappedPrices('AED 329.00', 'AED 399.00')),
+    ('carrefour_price.html', 'Carrefour UAE', ScrappedPrices('AED 318.00', None)),
+    ('carrefour_price_no_vat_note.html', 'Carrefour UAE', ScrappedPrices('AED 299.00', None)),
+    ('carrefour_discount.html', 'Carrefour UAE', ScrappedPrices('AED 179.00', 'AED 229.00')),
+    ('dubai_store_discount.html', 'DubaiStore', ScrappedPrices('AED 318.00', 'AED 399.00')),
+    ('dubai_store_price.html', 'DubaiStore', ScrappedPrices('AED 189.00', None)),
+    ('dubai_store_unavailable.html', 'DubaiStore', ScrappedPrices(None, None)),
+]
+
+LISTING_FIXTURE_PRICES = [
+    ('amazon_listing.html', 'Amazon.ae', 'https://www.amazon.ae/s?k=air+fryer', [
+        ListingPrice('https://www.amazon.ae/dp/B09NVMZS3X', 'AED 299.00', 'AED 399.00'),
+        ListingPrice('https://www.amazon.ae/dp/B08H7RKSM7', 'AED 349.00', None),
+    ]),
+    ('carrefour_listing.html', 'Carrefour UAE', 'https://www.carrefouruae.com/mafuae/en/c/NFUAE1', [
+        ListingPrice(
+            'https://www.carrefouruae.com/mafuae/en/fryer/philips-airfryer/p/8710103951766', 'AED 318.00', None
+        ),
+        ListingPrice(
+            'https://www.carrefouruae.com/mafuae/en/streaming/xiaomi-mi-box-s/p/6941059603283',
+            'AED 179.00',
+            'AED 229.00',
+        ),
+    ]),
+    ('dubai_store_listing.html', 'DubaiStore', 'https://www.dubaistore.com/kitchen-appliances', [
+        ListingPrice(
+            'https://www.dubaistore.com/kitchen-appliances/philips-air-fryer/6825703290', 'AED 318.00', 'AED 399.00'
+        ),
+        ListingPrice('https://www.dubaistore.com/kitchen-appliances/tefal-easy-fry/6825703291', 'AED 189.00', None),
+    ]),
+]
+
+
+class StreamedResponse:
+    def __init__(self, body: bytes, chunk_size: int) -> None:
+        self.charset = 'utf-8'
+        self.content = self
+        self.body = body
+        self.chunk_size = chunk_size
+        self.sent = 0
+        self.closed = False
+
+    async def iter_chunked(self, size: int):
+        while self.sent < len(self.body):
+            chunk = self.body[self.sent:self.sent + self.chunk_size]
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def stream_prices(html_page: str, shop_name: str, chunk_size: int = 64, max_bytes: int = 10 ** 7):
+    resp = StreamedResponse(html_page.encode('utf-8'), chunk_size)
+    return asyncio.run(read_prices_streaming(resp, shop_name, max_bytes)), resp
+
+
+@pytest.mark.parametrize('fixture, shop_name, expected', FIXTURE_PRICES)
+def test_parse_prices(fixture, shop_name, expected):
+    html_page = (FIXTURES_DIR / fixture).read_text(encoding='utf-8')
+    assert parse_prices(html_page, shop_name) == expected
+
+
+def test_parse_prices_of_empty_page():
+    assert parse_prices('', 'Amazon.ae') == ScrappedPrices(None, None)
+
+
+@pytest.mark.parametrize('fixture, shop_name, page_url, expected', LISTING_FIXTURE_PRICES)
+def test_parse_listing_prices(fixture, shop_name, page_url, expected):
+    html_page = (FIXTURES_DIR / fixture).read_text(encoding='utf-8')
+    assert parse_listing_prices(html_page, shop_name, page_url) == expected
+
+
+def test_parse_listing_prices_of_unknown_shop():
+    assert parse_listing_prices('<html></html>', 'Noon', 'https://www.noon.com/uae-en/') == []
+
+
+def test_parse_prices_of_unknown_shop():
+    assert parse_prices('<html></html>', 'Noon') is None
+
+
+def test_parse_pool():
+    pages = [
+        ((FIXTURES_DIR / fixture).read_text(encoding='utf-8'), shop_name) for fixture, shop_name, _ in FIXTURE_PRICES
+    ]
+    listing_fixture, listing_shop_name, page_url, listing_prices = LISTING_FIXTURE_PRICES[0]
+
+    async def parse():
+        # fewer backlog slots than pages, the rest wait for them
+        with ParsePool(workers=2, backlog=2) as parse_pool:
+            prices = await asyncio.gather(*(parse_pool.parse(*page) for page in pages))
+            listing = await parse_pool.parse_listing(
+                (FIXTURES_DIR / listing_fixture).read_text(encoding='utf-8'), listing_shop_name, page_url
+            )
+        return prices, listing
+
+    PARSE_SECONDS.reset()
+    prices, listing = asyncio.run(parse())
+
+    assert prices == [expected for _, _, expected in FIXTURE_PRICES]
+    assert listing == listing_prices
+    # the stages timed in the parse processes reach the metrics of the main one
+    assert sum(sum(counts) for counts in PARSE_SECONDS.counts.values()) == len(pages)
+
+
+@pytest.mark.parametrize('fixture, shop_name, expected', FIXTURE_PRICES)
+def test_read_prices_streaming(fixture, shop_name, expected):
+    html_page = (FIXTURES_DIR / fixture).read_text(encoding='utf-8')
+    assert stream_prices(html_page, shop_name)[0] == expected
+
+
+def test_read_prices_streaming_stops_after_price_block():
+    html_page = (FIXTURES_DIR / 'carrefour_discount.html').read_text(encoding='utf-8')
+    html_page = html_page.replace('</body>', '<p>related products</p>' * 10_000 + '</body>')
+
+    prices, resp = stream_prices(html_page, 'Carrefour UAE', chunk_size=STREAM_CHUNK_SIZE)
+
+    assert prices == ScrappedPrices('AED 179.00', 'AED 229.00')
+    assert resp.closed
+    assert resp.sent == STREAM_CHUNK_SIZE
+
+
+def test_read_prices_streaming_stops_after_right_column():
+    html_page = (FIXTURES_DIR / 'amazon_right_col.html').read_text(encoding='utf-8')
+
+    prices, resp = stream_prices(html_page, 'Amazon.ae', chunk_size=256)
+
+    # the buy box price of the right column is read, the carousel and reviews after it are not
+    assert prices == ScrappedPrices('AED 329.00', 'AED 399.00')
+    assert resp.closed
+    assert resp.sent < html_page.index('similarities_feature_div') + 256
+
+
+def test_read_prices_streaming_stops_at_max_bytes():
+    html_page = '<html><body>' + '<p>related products</p>' * 10_000 + '</body></html>'
+
+    prices, resp = stream_prices(html_page, 'DubaiStore', chunk_size=1024, max_bytes=4096)
+
+    assert prices == ScrappedPrices(None, None)
+    assert resp.closed
+    assert resp.sent == 4096
+
+
+def get_free_port() -> int:
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def test_unchanged_page_is_not_parsed_again(tmp_path, monkeypatch):
+    html_page = (FIXTURES_DIR / 'amazon_sns_base_price.html').read_text(encoding='utf-8')
+    cache_path = str(tmp_path / 'page_cache.db')
+    parsed = 0
+
+    def count_parse(html_page, shop_name):
+        nonlocal parsed
+        parsed += 1
+        return parse_prices_timed(html_page, shop_name)
+
+    parse_prices_timed = parsers.parse_prices_timed
+    monkeypatch.setattr(parsers, 'parse_prices_timed', count_parse)
+
+    async def handle(request: web.Request) -> web.Response:
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text=html_page, content_type='text/html', headers={'ETag': '"v1"'})
+
+    async def scrap(port: int):
+        scrap_item = ItemForScrap(id=1, url=f'http://127.0.0.1:{port}/dp/1', shop_id=1, shop_name='Amazon.ae')
+        async with ClientSessions() as sessions, PageCache(cache_path) as page_cache:
+            return await get_prices_for_product_item(
+                sessions, scrap_item, UserAgentPool(('test-agent',)), page_cache=page_cache
+            )
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/dp/1', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        port = get_free_port()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        try:
+            results = [(await scrap(port), parsed), (await scrap(port), parsed)]
+            # a page cached before its prices were kept is parsed once more, then not again
+            connection = sqlite3.connect(cache_path)
+            connection.execute('update page set prices = null;')
+            connection.commit()
+            connection.close()
+            results += [(await scrap(port), parsed), (await scrap(port), parsed)]
+            return results
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == [
+        (PricesForSave('AED 299.00', 'AED 399.00', 1), 1),
+        (UnchangedPrices(1, 'AED 299.00', 'AED 399.00'), 1),
+        (UnchangedPrices(1, 'AED 299.00', 'AED 399.00'), 2),
+        (UnchangedPrices(1, 'AED 299.00', 'AED 399.00'), 2),
+    ]
@@ -0,0 +1,25 @@
+import pytest
+
+from prices import parse_price
+from data_types import Price
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('AED 449.00', Price(44900, 'AED')),
+    ('AED 1,299.00', Price(129900, 'AED')),
+    ('AED 1,299', Price(129900, 'AED')),
+    ('1.299,50 €', Price(129950, 'EUR')),
+    ('12,5 AED', Price(1250, 'AED')),
+    ('AED 1\u00a0299.00', Price(129900, 'AED')),
+    ('د.إ ١٬٢٩٩٫٥٠', Price(129950, 'AED')),
+    ('AED 10 - 25', Price(1000, 'AED')),
+    ('Dhs 12', Price(1200, 'AED')),
+    ('KWD 1.250', Price(1250, 'KWD')),
+    ('AED 0.125', Price(13, 'AED')),
+    ('189.50', Price(18950, 'AED')),
+    ('n/a', None),
+    ('', None),
+    (None, None),
+])
+def test_parse_price(text, expected):
+    assert parse_price(text) == expected
@@ -0,0 +1,33 @@
+import sqlite3
+
+from db_handlers import check_query_plans
+from schema import BASE_SCHEMA, SCHEMA_VERSION, connect_db, get_schema_version
+
+
+def test_migrate_shipped_database(tmp_path):
+    db_path = str(tmp_path / 'goods_scrapper.db')
+    connection = sqlite3.connect(db_path)
+    connection.executescript(BASE_SCHEMA)
+    connection.executemany(
+        'insert into product_item(product_id, shop_id, url, selling_price) values (?, ?, ?, ?)',
+        [(1, 1, 'old', 'AED 10.00'), (1, 1, 'new', 'AED 1,299.50'), (2, 1, None, None)]
+    )
+    connection.commit()
+    connection.close()
+
+    connection = connect_db(db_path)
+    try:
+        assert get_schema_version(connection) == SCHEMA_VERSION
+        assert connection.execute(
+            'select url, selling_price_minor, currency, failure_count from product_item order by id'
+        ).fetchall() == [('new', 129950, 'AED', 0), (None, None, None, 0)]
+    finally:
+        connection.close()
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    connection = connect_db(str(tmp_path / 'goods_scrapper.db'))
+    try:
+        assert check_query_plans(connection) == {}
+    finally:
+        connection.close()
@@ -0,0 +1,50 @@
+import pytest
+
+from urls import canonicalize_url
+
+
+@pytest.mark.parametrize('shop_name, url, expected', [
+    (
+        'Amazon.ae',
+        'https://www.amazon.ae/Blu-Ionic-Shower-Filter-Generation/dp/B09NVMZS3X/ref=zg_bs_1/258-0483112?pd_rd_i=B09HHGPQ5F&psc=1',
+        'https://www.amazon.ae/dp/B09NVMZS3X',
+    ),
+    (
+        'Amazon.ae',
+        'https://www.amazon.ae/dp/B08H7RKSM7/?coliid=I30WTU30LFP6A9&psc=1&ref_=lv_ov_lig_dp_it_im',
+        'https://www.amazon.ae/dp/B08H7RKSM7',
+    ),
+    (
+        'Amazon.ae',
+        'https://www.amazon.ae/Philips-Airfryer/dp/B08H7RKSM7/ref=sr_1_3?smid=A2KKU8J8O8784X&psc=1&qid=1656503203',
+        'https://www.amazon.ae/dp/B08H7RKSM7?smid=A2KKU8J8O8784X',
+    ),
+    (
+        'Carrefour UAE',
+        'https://www.carrefouruae.com/mafuae/en/fryer/philips-airfryer/p/8710103951766?offerCode=2383113',
+        'https://www.carrefouruae.com/mafuae/en/fryer/philips-airfryer/p/8710103951766',
+    ),
+    (
+        'DubaiStore',
+        'https://www.dubaistore.com/kitchen-appliances/philips-air-fryer/6825703290?ln=Search%20Result%20Page',
+        'https://www.dubaistore.com/kitchen-appliances/philips-air-fryer/6825703290',
+    ),
+    (
+        'Noon',
+        'HTTPS://WWW.NOON.COM/uae-en/air-fryer/N44225872A/p/?utm_source=x&b=2&a=1#reviews',
+        'https://www.noon.com/uae-en/air-fryer/N44225872A/p/?a=1&b=2',
+    ),
+    ('Amazon.ae', 'not a link', 'not a link'),
+    ('Amazon.ae', None, None),
+])
+def test_canonicalize_url(shop_name, url, expected):
+    assert canonicalize_url(shop_name, url) == expected
+
+
+def test_amazon_offers_of_two_sellers_stay_apart():
+    urls = [
+        'https://www.amazon.ae/dp/B08H7RKSM7?smid=A2KKU8J8O8784X',
+        'https://www.amazon.ae/dp/B08H7RKSM7/?smid=A1FL0S2XWK6XS9&psc=1',
+        'https://www.amazon.ae/dp/B08H7RKSM7',
+    ]
+    assert len({canonicalize_url('Amazon.ae', url) for url in urls}) == 3
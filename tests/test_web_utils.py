@@ -0,0 +1,204 @@
+import asyncio
+import socket
+
+import pytest
+
+from aiohttp import ClientSession, web
+
+from web_utils import (
+    ACCEPT_ENCODING,
+    ClientSessions,
+    HostRateLimiter,
+    PageFetchError,
+    UserAgentPool,
+    get_backoff_delay,
+    parse_retry_after,
+    request_with_retries,
+)
+from data_types import ItemForScrap
+from config import DEFAULT_CLIENT_PROFILE, DEFAULT_FETCH_SETTINGS, SHOP_CLIENT_PROFILES
+
+
+SETTINGS = DEFAULT_FETCH_SETTINGS._replace(
+    rate=100.0, min_rate=1.0, max_rate=200.0, burst=1, concurrency=2, max_concurrency=3,
+    backoff_base=0.001, backoff_max=0.01,
+)
+
+USER_AGENT = UserAgentPool(('test-agent',))
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('5', 5.0),
+    (' 120 ', 120.0),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', None),
+    (None, None),
+])
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == expected
+
+
+def test_backoff_delay_is_capped():
+    settings = DEFAULT_FETCH_SETTINGS._replace(backoff_base=1.0, backoff_max=5.0)
+    assert all(0 <= get_backoff_delay(settings, 0) <= 1.0 for _ in range(100))
+    assert all(0 <= get_backoff_delay(settings, 10) <= 5.0 for _ in range(100))
+
+
+def test_client_sessions_follow_the_shop_profiles():
+    async def run():
+        async with ClientSessions() as sessions:
+            amazon = sessions.for_shop('Amazon.ae')
+            carrefour = sessions.for_shop('Carrefour UAE')
+            noon = sessions.for_shop('Noon')
+            return [
+                (session.connector.limit, session.connector.limit_per_host, dict(session.headers))
+                for session in (amazon, carrefour, noon)
+            ]
+
+    settings = asyncio.run(run())
+
+    amazon_profile = SHOP_CLIENT_PROFILES['Amazon.ae']
+    assert settings[0] == (
+        amazon_profile.limit,
+        amazon_profile.limit_per_host,
+        {'accept-encoding': ACCEPT_ENCODING, **amazon_profile.headers},
+    )
+    assert settings[1][2]['accept-language'] == 'en-AE,en;q=0.9,ar;q=0.8'
+    # a shop without a profile of its own gets the default one
+    assert settings[2] == (
+        DEFAULT_CLIENT_PROFILE.limit,
+        DEFAULT_CLIENT_PROFILE.limit_per_host,
+        {'accept-encoding': ACCEPT_ENCODING, **DEFAULT_CLIENT_PROFILE.headers},
+    )
+
+
+def test_items_of_one_shop_share_a_session():
+    items = [
+        ItemForScrap(id=i, url=f'https://www.amazon.ae/dp/B08H7RKSM{i}', shop_id=1, shop_name='Amazon.ae')
+        for i in range(2)
+    ]
+
+    async def run():
+        async with ClientSessions() as sessions:
+            first, second = (sessions.for_shop(item.shop_name) for item in items)
+            other = sessions.for_shop('Carrefour UAE')
+        return first, second, other
+
+    first, second, other = asyncio.run(run())
+
+    assert first is second
+    assert other is not first
+    # the sessions are closed with the pool
+    assert first.closed and other.closed
+
+
+def test_rate_limiter_halves_on_throttle_and_grows_on_success():
+    rate_limiter = HostRateLimiter(SETTINGS)
+
+    rate_limiter.on_throttle()
+    assert (rate_limiter.rate, rate_limiter.concurrency) == (50.0, 1.0)
+    # requests throttled together count once
+    rate_limiter.on_throttle()
+    assert (rate_limiter.rate, rate_limiter.concurrency) == (50.0, 1.0)
+
+    for _ in range(100):
+        rate_limiter.on_success()
+    assert 50.0 < rate_limiter.rate < SETTINGS.max_rate
+    assert rate_limiter.concurrency == SETTINGS.max_concurrency
+
+    rate_limiter.rate = SETTINGS.max_rate - 0.001
+    rate_limiter.on_success()
+    assert rate_limiter.rate == SETTINGS.max_rate
+
+
+def test_rate_limiter_keeps_concurrency_window():
+    rate_limiter = HostRateLimiter(SETTINGS)
+    in_flight = peak = 0
+
+    async def request():
+        nonlocal in_flight, peak
+        async with rate_limiter.slot():
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(10)))
+
+    asyncio.run(run())
+    assert peak == 2
+
+
+def test_rate_limiter_pauses_for_retry_after():
+    rate_limiter = HostRateLimiter(SETTINGS)
+
+    async def run():
+        rate_limiter.on_throttle(retry_after=0.2)
+        started_at = asyncio.get_running_loop().time()
+        async with rate_limiter.slot():
+            return asyncio.get_running_loop().time() - started_at
+
+    assert asyncio.run(run()) >= 0.19
+
+
+def get_free_port() -> int:
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def fetch_from_server(statuses: list[int]) -> tuple[str | Exception, int, HostRateLimiter]:
+    requests = 0
+
+    async def handle(request: web.Request) -> web.Response:
+        nonlocal requests
+        status = statuses[min(requests, len(statuses) - 1)]
+        requests += 1
+        return web.Response(text=f'page {requests}', status=status, headers={'Retry-After': '0'})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/page', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        port = get_free_port()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        rate_limiter = HostRateLimiter(SETTINGS)
+        try:
+            async with ClientSession() as session:
+                try:
+                    result = await request_with_retries(
+                        session, f'http://127.0.0.1:{port}/page', USER_AGENT,
+                        read_response=lambda resp: resp.text(), settings=SETTINGS, rate_limiter=rate_limiter,
+                    )
+                except PageFetchError as error:
+                    result = error
+        finally:
+            await runner.cleanup()
+        return result, requests, rate_limiter
+
+    return asyncio.run(run())
+
+
+def test_request_is_retried_on_throttling():
+    result, requests, rate_limiter = fetch_from_server([503, 503, 200])
+
+    assert result == 'page 3'
+    assert requests == 3
+    assert rate_limiter.rate < SETTINGS.rate
+
+
+def test_request_gives_up_after_retries():
+    result, requests, _ = fetch_from_server([503])
+
+    assert isinstance(result, PageFetchError)
+    assert (result.status, result.transient) == (503, True)
+    assert requests == SETTINGS.retries + 1
+
+
+def test_request_is_not_retried_on_client_error():
+    result, requests, _ = fetch_from_server([404])
+
+    assert isinstance(result, PageFetchError)
+    assert (result.status, result.transient) == (404, False)
+    assert requests == 1